@@ -1,8 +1,20 @@
 from django.contrib import admin
 
-from book.models import Book
+from book.models import Book, BookStats
 
 
 @admin.register(Book)
 class BookAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(BookStats)
+class BookStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        "book",
+        "active_loans",
+        "overdue_loans",
+        "lifetime_loans",
+        "revenue",
+    )
+    list_select_related = ("book",)
@@ -0,0 +1,351 @@
+import logging
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from versioning import bump_versions, get_version, get_version_cache
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_VERSION_KEY = "book:autocomplete:version"
+# Processes further behind than this, or missing an expired change,
+# rebuild their index instead of applying the logged changes.
+CHANGE_LOG_LENGTH = 1000
+CHANGE_LOG_TIMEOUT = 60 * 60
+# Share of a misspelt word's trigrams its correction must contain.
+FUZZY_THRESHOLD = 0.5
+# Corrections sharing the most trigrams, of which the most used one wins.
+FUZZY_CANDIDATES = 5
+MIN_FUZZY_LENGTH = 3
+# Sort keys are cut to this many characters to bound memory.
+KEY_LENGTH = 24
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+
+def normalize(text: str) -> str:
+    """Lowercase, drop accents and collapse punctuation to single spaces"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def trigrams(normalized: str) -> set:
+    """Trigrams of every word padded like pg_trgm: "  w", " wo", ..."""
+    result = set()
+    for word in normalized.split():
+        padded = f"  {word} "
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class AutocompleteIndex:
+    """
+    In-memory prefix and trigram index of distinct titles and authors.
+
+    Prefix lookups bisect two sorted key lists: whole strings first, then
+    strings starting at a later word ("hobbit" finds "the hobbit").
+    When that finds too little, misspelt query words are replaced by the
+    closest vocabulary word by shared trigrams and the prefix lookup runs
+    again. Entries beyond max_entries are not indexed.
+
+    Lookups and changes hold the index's lock, as requests in other
+    threads may be reading it while a change is applied.
+    """
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries or settings.AUTOCOMPLETE_MAX_ENTRIES
+        self.version = None
+        self.lock = threading.RLock()
+        # book id -> (title entry id, author entry id)
+        self.books = {}
+        # entry id -> (field, text, normalized)
+        self.entries = {}
+        self.entry_ids = {}
+        self.book_counts = Counter()
+        # Parallel sorted lists of truncated keys and their entry ids.
+        self.starts = ([], [])
+        self.words = ([], [])
+        # Distinct words with the number of entries using them, and the
+        # words containing each trigram.
+        self.vocabulary = Counter()
+        self.postings = {}
+        self.next_id = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, rows, max_entries: int = None):
+        """Index an iterable of (book_id, title, author) rows"""
+        index = cls(max_entries)
+        unsorted = {"starts": [], "words": []}
+        for book_id, title, author in rows:
+            index.add(book_id, title, author, unsorted)
+        for name, keys in unsorted.items():
+            keys.sort()
+            setattr(
+                index,
+                name,
+                ([key for key, _ in keys], [entry_id for _, entry_id in keys]),
+            )
+        if index.dropped:
+            logger.warning(
+                "Autocomplete index is full: %s entries, %s not indexed",
+                len(index),
+                index.dropped,
+            )
+        return index
+
+    def add(self, book_id: int, title: str, author: str, unsorted=None) -> None:
+        self.books[book_id] = (
+            self._add_entry("title", title, unsorted),
+            self._add_entry("author", author, unsorted),
+        )
+
+    def remove(self, book_id: int) -> None:
+        with self.lock:
+            for entry_id in self.books.pop(book_id, ()):
+                if entry_id is not None:
+                    self._remove_entry(entry_id)
+
+    def update(self, book_id: int, title: str, author: str) -> bool:
+        """Reindex a book; return False when its title and author are unchanged"""
+        with self.lock:
+            texts = tuple(
+                None if entry_id is None else self.entries[entry_id][1]
+                for entry_id in self.books.get(book_id, ())
+            )
+            if book_id in self.books and texts == (title, author):
+                return False
+            self.remove(book_id)
+            self.add(book_id, title, author)
+            return True
+
+    def apply(self, book_id: int, title: str = None, author: str = None) -> bool:
+        """Apply a saved (or, without title, deleted) book; False if a no-op"""
+        if title is not None:
+            return self.update(book_id, title, author)
+        with self.lock:
+            if book_id not in self.books:
+                return False
+            self.remove(book_id)
+            return True
+
+    def _add_entry(self, field: str, text: str, unsorted):
+        entry_id = self.entry_ids.get((field, text))
+        if entry_id is not None:
+            self.book_counts[entry_id] += 1
+            return entry_id
+        normalized = normalize(text)
+        if not normalized:
+            return None
+        if len(self.entries) >= self.max_entries:
+            self.dropped += 1
+            return None
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entry_ids[(field, text)] = entry_id
+        self.entries[entry_id] = (field, text, normalized)
+        self.book_counts[entry_id] = 1
+        for name, key in self._keys(normalized):
+            if unsorted is not None:
+                unsorted[name].append((key, entry_id))
+            else:
+                keys, entry_ids = getattr(self, name)
+                position = bisect_left(keys, key)
+                keys.insert(position, key)
+                entry_ids.insert(position, entry_id)
+        for word in set(normalized.split()):
+            self.vocabulary[word] += 1
+            if self.vocabulary[word] == 1:
+                for trigram in trigrams(word):
+                    self.postings.setdefault(trigram, []).append(word)
+        return entry_id
+
+    def _remove_entry(self, entry_id: int) -> None:
+        self.book_counts[entry_id] -= 1
+        if self.book_counts[entry_id] > 0:
+            return
+
+        field, text, normalized = self.entries.pop(entry_id)
+        del self.entry_ids[(field, text)]
+        del self.book_counts[entry_id]
+        for name, key in self._keys(normalized):
+            keys, entry_ids = getattr(self, name)
+            position = bisect_left(keys, key)
+            while entry_ids[position] != entry_id:
+                position += 1
+            del keys[position]
+            del entry_ids[position]
+        for word in set(normalized.split()):
+            self.vocabulary[word] -= 1
+            if self.vocabulary[word] > 0:
+                continue
+            del self.vocabulary[word]
+            for trigram in trigrams(word):
+                posting = self.postings[trigram]
+                posting.remove(word)
+                if not posting:
+                    del self.postings[trigram]
+
+    @staticmethod
+    def _keys(normalized: str):
+        yield "starts", normalized[:KEY_LENGTH]
+        for match in re.finditer(" ", normalized):
+            yield "words", normalized[match.end() : match.end() + KEY_LENGTH]
+
+    def suggest(self, prefix: str, limit: int) -> list:
+        query = normalize(prefix)
+        if not query:
+            return []
+        found = []
+        with self.lock:
+            for name in ("starts", "words"):
+                self._scan_prefix(getattr(self, name), query, limit, found)
+            if len(found) < limit and len(query) >= MIN_FUZZY_LENGTH:
+                self._scan_fuzzy(query, limit, found)
+            return [self._suggestion(entry_id) for entry_id in found]
+
+    def _scan_prefix(self, sorted_keys, query: str, limit: int, found: list) -> None:
+        keys, entry_ids = sorted_keys
+        key_prefix = query[:KEY_LENGTH]
+        position = bisect_left(keys, key_prefix)
+        while len(found) < limit and position < len(keys):
+            if not keys[position].startswith(key_prefix):
+                return
+            entry_id = entry_ids[position]
+            position += 1
+            if entry_id in found:
+                continue
+            # Keys are truncated, so longer queries are checked in full.
+            if len(query) > KEY_LENGTH:
+                normalized = self.entries[entry_id][2]
+                if not (normalized.startswith(query) or f" {query}" in normalized):
+                    continue
+            found.append(entry_id)
+
+    def _scan_fuzzy(self, query: str, limit: int, found: list) -> None:
+        words = query.split()
+        corrected = [
+            word if word in self.vocabulary else self._closest_word(word)
+            for word in words[:-1]
+        ]
+        # The last word may still be being typed.
+        last = words[-1]
+        if not self._has_prefix(last):
+            last = self._closest_word(last)
+        corrected.append(last)
+        if None in corrected or corrected == words:
+            return
+        corrected_query = " ".join(corrected)
+        for name in ("starts", "words"):
+            self._scan_prefix(getattr(self, name), corrected_query, limit, found)
+
+    def _has_prefix(self, word: str) -> bool:
+        for name in ("starts", "words"):
+            keys, _ = getattr(self, name)
+            position = bisect_left(keys, word)
+            if position < len(keys) and keys[position].startswith(word):
+                return True
+        return False
+
+    def _closest_word(self, word: str):
+        """The vocabulary word sharing most trigrams with a misspelt one"""
+        if len(word) < MIN_FUZZY_LENGTH:
+            return None
+        word_trigrams = trigrams(word)
+        shared = Counter()
+        for trigram in word_trigrams:
+            shared.update(self.postings.get(trigram, ()))
+        if not shared:
+            return None
+        needed = FUZZY_THRESHOLD * len(word_trigrams)
+        count, _, closest = max(
+            (count, self.vocabulary[candidate], candidate)
+            for candidate, count in shared.most_common(FUZZY_CANDIDATES)
+        )
+        return closest if count >= needed else None
+
+    def _suggestion(self, entry_id: int) -> dict:
+        field, text, _ = self.entries[entry_id]
+        return {"text": text, "field": field, "books": self.book_counts[entry_id]}
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def _change_key(version: int) -> str:
+    return f"{AUTOCOMPLETE_VERSION_KEY}:{version}"
+
+
+def _catch_up(index: AutocompleteIndex, version: int) -> bool:
+    """
+    Apply the changes other processes logged since the index's version;
+    False when some of them are no longer logged.
+    """
+    if index.version >= version:
+        return True
+    if version - index.version > CHANGE_LOG_LENGTH:
+        return False
+    keys = [_change_key(logged) for logged in range(index.version + 1, version + 1)]
+    changes = get_version_cache().get_many(keys)
+    if len(changes) < len(keys):
+        return False
+    for key in keys:
+        index.apply(*changes[key])
+    index.version = version
+    return True
+
+
+def get_index() -> AutocompleteIndex:
+    """
+    The process-wide index, built from the database the first time it is
+    used. Changes made by other processes are applied from their change
+    log, and the index is rebuilt only when that log has a gap.
+    """
+    global _index
+    version = get_version(AUTOCOMPLETE_VERSION_KEY)
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    with _lock:
+        if _index is None or not _catch_up(_index, version):
+            from book.models import Book
+
+            rows = Book.objects.order_by().values_list("id", "title", "author")
+            _index = AutocompleteIndex.build(rows.iterator())
+            _index.version = version
+        return _index
+
+
+def book_changed(book_id: int, title: str = None, author: str = None) -> None:
+    """
+    Apply a saved (or, without title, deleted) book to this process's index
+    after commit, and log the change for every other process to apply.
+    """
+
+    def apply() -> None:
+        with _lock:
+            index = _index
+            if index is not None:
+                # A stale index may wrongly see the change as a no-op.
+                current = _catch_up(index, get_version(AUTOCOMPLETE_VERSION_KEY))
+                if not index.apply(book_id, title, author) and current:
+                    return
+            (version,) = bump_versions([AUTOCOMPLETE_VERSION_KEY])
+            get_version_cache().set(
+                _change_key(version), (book_id, title, author), CHANGE_LOG_TIMEOUT
+            )
+            if index is not None and index.version == version - 1:
+                index.version = version
+
+    transaction.on_commit(apply)
@@ -0,0 +1,103 @@
+import json
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from book.autocomplete import DEFAULT_LIMIT, AutocompleteIndex
+
+SYLLABLES = (
+    "ka ri to mo sa le an ber cor dan el fin gar hol in jor kel lin "
+    "mar nor or pel qua ros sil tor ul ven wil xan yor zel"
+).split()
+VOCABULARY_SIZE = 20_000
+
+
+def vocabulary(rng, size: int) -> tuple:
+    """Generated words with Zipf-like frequencies, as in real titles"""
+    words = ["".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(size)]
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    return words, cum_weights
+
+
+def misspell(rng, text: str) -> str:
+    position = rng.randrange(1, len(text) - 1)
+    return text[:position] + text[position + 1] + text[position] + text[position + 2 :]
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the autocomplete index from generated books and report its "
+        "build time, memory and prefix/fuzzy suggestion latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+        )
+        parser.add_argument("--queries", type=int, default=1000)
+        parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        report = []
+        for size in options["sizes"]:
+            rng = random.Random(options["seed"])
+            words, cum_weights = vocabulary(rng, VOCABULARY_SIZE)
+            authors = [
+                " ".join(rng.choices(words, cum_weights=cum_weights, k=2))
+                for _ in range(max(size // 20, 1))
+            ]
+            rows = [
+                (
+                    book_id,
+                    " ".join(
+                        rng.choices(words, cum_weights=cum_weights, k=rng.randint(1, 5))
+                    ),
+                    rng.choice(authors),
+                )
+                for book_id in range(size)
+            ]
+
+            start = time.perf_counter()
+            index = AutocompleteIndex.build(rows, max_entries=size * 2)
+            build_seconds = time.perf_counter() - start
+            del index
+            tracemalloc.start()
+            index = AutocompleteIndex.build(rows, max_entries=size * 2)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            samples = rng.sample(rows, min(options["queries"], size))
+            prefixes = [title[: rng.randint(2, 6)] for _, title, _ in samples]
+            typos = [misspell(rng, author.split()[-1]) for _, _, author in samples]
+            report.append(
+                {
+                    "books": size,
+                    "entries": len(index),
+                    "build_seconds": round(build_seconds, 2),
+                    "memory_mb": round(memory / 2**20, 1),
+                    "bytes_per_entry": memory // max(len(index), 1),
+                    "prefix": self.latency(index, prefixes, options["limit"]),
+                    "fuzzy": self.latency(index, typos, options["limit"]),
+                }
+            )
+        self.stdout.write(json.dumps(report))
+
+    @staticmethod
+    def latency(index, queries: list, limit: int) -> dict:
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            index.suggest(query, limit)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        return {
+            "p50_ms": round(timings[len(timings) // 2] * 1000, 3),
+            "p99_ms": round(timings[int(len(timings) * 0.99)] * 1000, 3),
+        }
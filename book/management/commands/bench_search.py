@@ -0,0 +1,100 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from book.models import Book
+
+WORDS = (
+    "ancient city river night garden winter silver shadow empire ocean "
+    "forest kingdom secret journey war peace glass stone fire storm "
+    "letters island mountain house dream machine history children light"
+).split()
+SURNAMES = (
+    "smith tolkien austen orwell tolstoy woolf dickens bronte hemingway "
+    "murakami atwood borges calvino eco rowling pratchett leguin asimov"
+).split()
+QUERIES = ("tolkien", "silver river", "storm island murakami", "xylophone")
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the catalogue with generated books and compare ranked full-text "
+        "search with icontains scans; every generated row is rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--page-size", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        report = {"vendor": connection.vendor, "sizes": []}
+        with transaction.atomic():
+            created = Book.objects.count()
+            for size in sorted(options["sizes"]):
+                self.generate_books(rng, size - created)
+                created = max(created, size)
+                Book.objects.rebuild_search_index()
+                report["sizes"].append(
+                    {
+                        "books": created,
+                        "queries": [
+                            self.measure(query, options["repeat"], options["page_size"])
+                            for query in QUERIES
+                        ],
+                    }
+                )
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report))
+
+    @staticmethod
+    def generate_books(rng, count: int) -> None:
+        for start in range(0, max(count, 0), BATCH_SIZE):
+            Book.objects.bulk_create(
+                Book(
+                    title=" ".join(rng.sample(WORDS, rng.randint(2, 4))),
+                    author=f"{rng.choice(WORDS)} {rng.choice(SURNAMES)}",
+                    cover=Book.CoverChoices.SOFT,
+                    inventory=1,
+                    daily_fee="0.50",
+                )
+                for _ in range(min(BATCH_SIZE, count - start))
+            )
+
+    @staticmethod
+    def timed(queryset, repeat: int) -> tuple:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = len(queryset.all())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return rows, round(best * 1000, 3)
+
+    def measure(self, query: str, repeat: int, page_size: int) -> dict:
+        search = Book.objects.search(query)[:page_size]
+        scan = Q()
+        for term in query.split():
+            scan &= Q(title__icontains=term) | Q(author__icontains=term)
+        icontains = Book.objects.filter(scan).order_by("author", "title", "id")
+
+        search_rows, search_ms = self.timed(search, repeat)
+        scan_rows, scan_ms = self.timed(icontains[:page_size], repeat)
+        return {
+            "q": query,
+            "matches": icontains.count(),
+            "search_rows": search_rows,
+            "search_ms": search_ms,
+            "icontains_rows": scan_rows,
+            "icontains_ms": scan_ms,
+            "speedup": round(scan_ms / search_ms, 1) if search_ms else None,
+        }
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from book.models import BookStats
+
+
+class Command(BaseCommand):
+    help = "Recompute every book's loan stats from borrowings and payments"
+
+    def handle(self, *args, **options):
+        drifted = BookStats.objects.rebuild()
+        self.stdout.write(f"Rebuilt book stats, {drifted} books had drifted")
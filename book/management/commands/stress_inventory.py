@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from book.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        "Borrow the last copies of a throwaway book from many threads at once "
+        "and report whether inventory was oversold and the reservation throughput"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=32)
+        parser.add_argument("--copies", type=int, default=100)
+        parser.add_argument("--attempts", type=int, default=10)
+
+    def handle(self, *args, **options):
+        threads = options["threads"]
+        copies = options["copies"]
+        book = Book.objects.create(
+            title="stress-test",
+            author="stress-test",
+            cover=Book.CoverChoices.SOFT,
+            inventory=copies,
+            daily_fee="0.00",
+        )
+        barrier = threading.Barrier(threads)
+        lock = threading.Lock()
+        counters = {"reserved": 0, "rejected": 0, "lock_retries": 0}
+
+        def borrow() -> None:
+            barrier.wait()
+            try:
+                for _ in range(options["attempts"]):
+                    while True:
+                        try:
+                            reserved = Book.objects.reserve(book.id)
+                            break
+                        except OperationalError as error:
+                            # SQLite has no row locks and rejects concurrent
+                            # writers instead of queueing them.
+                            if "locked" not in str(error):
+                                raise
+                            with lock:
+                                counters["lock_retries"] += 1
+                    with lock:
+                        counters["reserved" if reserved else "rejected"] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=borrow) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        book.refresh_from_db()
+        report = {
+            "threads": threads,
+            "copies": copies,
+            "attempts": threads * options["attempts"],
+            **counters,
+            "inventory_left": book.inventory,
+            "oversold": max(counters["reserved"] - copies, 0),
+            "seconds": round(elapsed, 4),
+            "reservations_per_second": round(
+                (counters["reserved"] + counters["rejected"]) / elapsed, 1
+            ),
+        }
+        book.delete()
+        self.stdout.write(json.dumps(report))
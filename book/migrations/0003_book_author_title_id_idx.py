@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("book", "0002_alter_book_author"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="book",
+            name="daily_fee",
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["author", "title", "id"], name="book_author_title_id_idx"
+            ),
+        ),
+    ]
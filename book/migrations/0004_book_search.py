@@ -0,0 +1,77 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:02
+
+import book.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+SEARCH_TABLE = "book_search"
+SEARCH_INDEX = "book_search_idx"
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(title, author)"
+        )
+        # Rank title matches above author matches.
+        schema_editor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rank) "
+            f"VALUES ('rank', 'bm25(2.0, 1.0)')"
+        )
+        schema_editor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, author) "
+            f"SELECT id, title, author FROM book_book"
+        )
+    elif vendor == "postgresql":
+        from django.contrib.postgres.indexes import GinIndex
+        from django.contrib.postgres.search import SearchVector
+
+        schema_editor.add_index(
+            apps.get_model("book", "Book"),
+            GinIndex(
+                SearchVector("title", "author", config="simple"), name=SEARCH_INDEX
+            ),
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE {SEARCH_TABLE}")
+    elif vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {SEARCH_INDEX}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("book", "0003_book_author_title_id_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookSearch",
+            fields=[
+                (
+                    "book",
+                    models.OneToOneField(
+                        db_column="rowid",
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="search_row",
+                        serialize=False,
+                        to="book.book",
+                    ),
+                ),
+                ("title", models.TextField()),
+                ("author", models.TextField()),
+                ("book_search", book.search.FullTextField()),
+                ("rank", models.FloatField()),
+            ],
+            options={
+                "db_table": "book_search",
+                "managed": False,
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 4.0.4 on 2026-10-18 17:35
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Q, Sum
+import django.db.models.deletion
+
+
+def backfill_book_stats(apps, schema_editor):
+    Book = apps.get_model("book", "Book")
+    BookStats = apps.get_model("book", "BookStats")
+    Borrowing = apps.get_model("borrowing", "Borrowing")
+    Payment = apps.get_model("borrowing", "Payment")
+    today = datetime.date.today()
+    active = Q(actual_return_date=None)
+    loans = {
+        row["book_id"]: row
+        for row in Borrowing.objects.order_by()
+        .values("book_id")
+        .annotate(
+            active=Count("id", filter=active),
+            overdue=Count("id", filter=active & Q(expected_return_date__lt=today)),
+            lifetime=Count("id"),
+        )
+    }
+    # Regenerated payments repeat the bill of the expired one they replace.
+    first_payments = (
+        Payment.objects.order_by()
+        .values("borrowing_id")
+        .annotate(first_id=Min("id"))
+        .values("first_id")
+    )
+    revenue = dict(
+        Payment.objects.filter(pk__in=first_payments)
+        .order_by()
+        .values("borrowing__book_id")
+        .annotate(revenue=Sum("payment_amount"))
+        .values_list("borrowing__book_id", "revenue")
+    )
+    empty = {"active": 0, "overdue": 0, "lifetime": 0}
+    BookStats.objects.bulk_create(
+        (
+            BookStats(
+                book_id=book_id,
+                active_loans=loans.get(book_id, empty)["active"],
+                overdue_loans=loans.get(book_id, empty)["overdue"],
+                overdue_as_of=today,
+                lifetime_loans=loans.get(book_id, empty)["lifetime"],
+                revenue=revenue.get(book_id, 0),
+            )
+            for book_id in Book.objects.values_list("id", flat=True).iterator()
+        ),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("book", "0005_book_filter_indexes"),
+        ("borrowing", "0011_outstandingbalance"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookStats",
+            fields=[
+                (
+                    "book",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="stats",
+                        serialize=False,
+                        to="book.book",
+                    ),
+                ),
+                ("active_loans", models.IntegerField(default=0)),
+                ("overdue_loans", models.IntegerField(default=0)),
+                ("overdue_as_of", models.DateField(blank=True, null=True)),
+                ("lifetime_loans", models.IntegerField(default=0)),
+                ("revenue", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "verbose_name_plural": "book stats",
+            },
+        ),
+        migrations.RunPython(backfill_book_stats, migrations.RunPython.noop),
+    ]
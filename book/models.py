@@ -1,4 +1,81 @@
-from django.db import models
+import datetime
+from collections import Counter, defaultdict
+
+from django.db import models, transaction
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    IntegerField,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
+
+from book import search
+from book.cache import invalidate_books
+
+
+REBUILD_BATCH_SIZE = 2000
+
+
+def copies_per_book(counts: dict):
+    if len(counts) == 1:
+        return Value(next(iter(counts.values())))
+    return Case(
+        *(When(pk=book_id, then=Value(count)) for book_id, count in counts.items()),
+        output_field=IntegerField(),
+    )
+
+
+class BookQuerySet(models.QuerySet):
+    def reserve(self, book_id: int) -> bool:
+        """
+        Take one copy in a single conditional UPDATE.
+        Return False when no copies are left.
+        """
+        return self.reserve_many({book_id: 1})
+
+    def reserve_many(self, counts: dict) -> bool:
+        """
+        Take counts[book_id] copies of every book in one conditional UPDATE.
+        Nothing is taken and False is returned unless every book has enough.
+        """
+        enough_copies = Q()
+        for book_id, count in counts.items():
+            enough_copies |= Q(pk=book_id, inventory__gte=count)
+        with transaction.atomic():
+            reserved = self.filter(enough_copies).update(
+                inventory=F("inventory") - copies_per_book(counts)
+            )
+            if reserved != len(counts):
+                transaction.set_rollback(True)
+                return False
+        invalidate_books(counts)
+        return True
+
+    def release(self, book_id: int) -> None:
+        """Put one copy back"""
+        self.release_many({book_id: 1})
+
+    def release_many(self, counts: dict) -> None:
+        """Put counts[book_id] copies of every book back in one UPDATE"""
+        self.filter(pk__in=counts).update(
+            inventory=F("inventory") + copies_per_book(counts)
+        )
+        invalidate_books(counts)
+
+    def search(self, query: str):
+        """Books matching every term of the query, best match first"""
+        return search.search(self, query).order_by("search_rank", "id")
+
+    def rebuild_search_index(self) -> None:
+        search.rebuild_search_index()
 
 
 class Book(models.Model):
@@ -14,8 +91,223 @@ class Book(models.Model):
     inventory = models.PositiveIntegerField()
     daily_fee = models.DecimalField(max_digits=10, decimal_places=2)
 
+    objects = BookQuerySet.as_manager()
+
     class Meta:
         ordering = ["author", "title"]
+        indexes = [
+            models.Index(
+                fields=["author", "title", "id"], name="book_author_title_id_idx"
+            ),
+            models.Index(fields=["title", "id"], name="book_title_id_idx"),
+            models.Index(fields=["daily_fee", "id"], name="book_daily_fee_id_idx"),
+            models.Index(
+                fields=["daily_fee", "id"],
+                condition=Q(inventory__gt=0),
+                name="book_in_stock_fee_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title}, {self.author})"
+
+
+class BookSearch(models.Model):
+    """
+    Read-only view of the SQLite FTS5 table created by migration 0004.
+    Rows are written by book.search; the table does not exist on PostgreSQL.
+    """
+
+    book = models.OneToOneField(
+        Book,
+        on_delete=models.DO_NOTHING,
+        primary_key=True,
+        db_column="rowid",
+        related_name="search_row",
+    )
+    title = models.TextField()
+    author = models.TextField()
+    book_search = search.FullTextField()
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = search.SEARCH_TABLE
+
+
+class BookStatsQuerySet(models.QuerySet):
+    def record_loans(self, counts: dict) -> None:
+        """Count counts[book_id] new loans of every book in one UPDATE"""
+        self.filter(pk__in=counts).update(
+            active_loans=F("active_loans") + copies_per_book(counts),
+            lifetime_loans=F("lifetime_loans") + copies_per_book(counts),
+        )
+
+    def record_returns(self, returns: list) -> None:
+        """
+        Count (book_id, expected_return_date, amount) returned loans in one
+        UPDATE. A loan leaves overdue_loans if it was overdue at the last
+        refresh_overdue(), which is when it was counted there.
+        """
+        if not returns:
+            return
+        amounts = Counter()
+        due_dates = defaultdict(Counter)
+        for book_id, expected_return_date, amount in returns:
+            amounts[book_id] += amount
+            due_dates[book_id][expected_return_date] += 1
+        counted_overdue = Case(
+            *(
+                When(
+                    pk=book_id,
+                    then=sum(
+                        Case(
+                            When(overdue_as_of__gt=due_date, then=Value(count)),
+                            default=Value(0),
+                        )
+                        for due_date, count in dates.items()
+                    ),
+                )
+                for book_id, dates in due_dates.items()
+            ),
+            output_field=IntegerField(),
+        )
+        loans = {book_id: sum(dates.values()) for book_id, dates in due_dates.items()}
+        self.filter(pk__in=loans).update(
+            active_loans=F("active_loans") - copies_per_book(loans),
+            overdue_loans=F("overdue_loans") - counted_overdue,
+            revenue=F("revenue") + copies_per_book(amounts),
+        )
+
+    def refresh_overdue(self, on_date: datetime.date = None) -> int:
+        """
+        Recount the active loans due before `on_date` (today by default):
+        loans turn overdue as days pass, without a write to count them.
+        """
+        from borrowing.models import Borrowing
+
+        on_date = on_date or datetime.date.today()
+        overdue = (
+            Borrowing.objects.filter(
+                book_id=OuterRef("pk"),
+                actual_return_date=None,
+                expected_return_date__lt=on_date,
+            )
+            .order_by()
+            .values("book_id")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        return self.update(
+            overdue_loans=Coalesce(Subquery(overdue), 0), overdue_as_of=on_date
+        )
+
+    def rebuild(self, on_date: datetime.date = None, book_ids: list = None) -> int:
+        """
+        Recompute the stats of the given books, or of every book, from
+        borrowings and payments. Return how many books had missing or
+        drifted stats.
+        """
+        from borrowing.models import Borrowing, Payment
+
+        on_date = on_date or datetime.date.today()
+        borrowings = Borrowing.objects.all()
+        payments = Payment.objects.all()
+        rows = self
+        books = Book.objects.all()
+        if book_ids is not None:
+            borrowings = borrowings.filter(book_id__in=book_ids)
+            payments = payments.filter(borrowing__book_id__in=book_ids)
+            rows = self.filter(book_id__in=book_ids)
+            books = books.filter(id__in=book_ids)
+        active = Q(actual_return_date=None)
+        expected = defaultdict(lambda: [0, 0, 0, 0])
+        for book_id, *loans in (
+            borrowings.order_by()
+            .values("book_id")
+            .annotate(
+                active=Count("id", filter=active),
+                overdue=Count(
+                    "id", filter=active & Q(expected_return_date__lt=on_date)
+                ),
+                lifetime=Count("id"),
+            )
+            .values_list("book_id", "active", "overdue", "lifetime")
+        ):
+            expected[book_id][:3] = loans
+        # Regenerated payments repeat the bill of the payment they replace,
+        # which the return counted once: count each borrowing's first one.
+        first_payments = (
+            Payment.objects.order_by()
+            .values("borrowing_id")
+            .annotate(first_id=Min("id"))
+            .values("first_id")
+        )
+        for book_id, revenue in (
+            payments.filter(pk__in=first_payments)
+            .order_by()
+            .values("borrowing__book_id")
+            .annotate(revenue=Sum("payment_amount"))
+            .values_list("borrowing__book_id", "revenue")
+        ):
+            expected[book_id][3] = revenue
+
+        with transaction.atomic():
+            current = {
+                book_id: list(stats)
+                for book_id, *stats in rows.select_for_update().values_list(
+                    "book_id",
+                    "active_loans",
+                    "overdue_loans",
+                    "lifetime_loans",
+                    "revenue",
+                )
+            }
+            drifted = [
+                book_id
+                for book_id in books.values_list("id", flat=True).iterator()
+                if current.get(book_id) != expected[book_id]
+            ]
+            self.filter(pk__in=drifted).delete()
+            self.bulk_create(
+                (
+                    BookStats(
+                        book_id=book_id,
+                        active_loans=expected[book_id][0],
+                        overdue_loans=expected[book_id][1],
+                        lifetime_loans=expected[book_id][2],
+                        revenue=expected[book_id][3],
+                    )
+                    for book_id in drifted
+                ),
+                batch_size=REBUILD_BATCH_SIZE,
+            )
+            rows.update(overdue_as_of=on_date)
+        return len(drifted)
+
+
+class BookStats(models.Model):
+    """
+    Loan counters per book, kept in step by the borrow and return paths
+    so dashboards never aggregate the borrowings; rebuilt by
+    rebuild_book_stats
+    """
+
+    book = models.OneToOneField(
+        Book, on_delete=models.CASCADE, primary_key=True, related_name="stats"
+    )
+    active_loans = models.IntegerField(default=0)
+    # Active loans due before overdue_as_of, recounted daily.
+    overdue_loans = models.IntegerField(default=0)
+    overdue_as_of = models.DateField(null=True, blank=True)
+    lifetime_loans = models.IntegerField(default=0)
+    # Amount charged for returned loans, in cents.
+    revenue = models.BigIntegerField(default=0)
+
+    objects = BookStatsQuerySet.as_manager()
+
+    class Meta:
+        verbose_name_plural = "book stats"
+
+    def __str__(self):
+        return f"{self.book_id}: {self.active_loans} out, {self.lifetime_loans} loans"
@@ -0,0 +1,138 @@
+import re
+
+from django.db import connection
+from django.db.models import (
+    ExpressionWrapper,
+    F,
+    FloatField,
+    Lookup,
+    Q,
+    TextField,
+    Value,
+)
+
+# SQLite keeps its own FTS5 copy of title and author, keyed by book id.
+SEARCH_TABLE = "book_search"
+# PostgreSQL matches against an expression GIN index on this vector.
+SEARCH_CONFIG = "simple"
+SEARCH_INDEX = "book_search_idx"
+# Title matches outrank author matches; SQLite sets the same weights
+# on its FTS5 table in migration 0004.
+TITLE_WEIGHT = 2.0
+AUTHOR_WEIGHT = 1.0
+
+
+class FullTextField(TextField):
+    """The hidden column of an FTS5 table named after the table itself"""
+
+
+@FullTextField.register_lookup
+class FullTextMatch(Lookup):
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
+
+
+def search_terms(query: str) -> list:
+    return re.findall(r"\w+", query.lower())
+
+
+def search_vector():
+    from django.contrib.postgres.search import SearchVector
+
+    return SearchVector("title", "author", config=SEARCH_CONFIG)
+
+
+def search(queryset, query: str):
+    """
+    Filter books matching every term of the query and annotate
+    `search_rank`, where a lower rank is a better match.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return queryset.annotate(
+            search_rank=Value(0.0, output_field=FloatField())
+        ).none()
+    if connection.vendor == "sqlite":
+        return _search_sqlite(queryset, terms)
+    if connection.vendor == "postgresql":
+        return _search_postgresql(queryset, terms)
+    return _search_scan(queryset, terms)
+
+
+def _search_sqlite(queryset, terms: list):
+    # The FTS5 table drives the join and yields its bm25 rank directly;
+    # the rank weights are configured when the table is created.
+    match = " ".join(f'"{term}"' for term in terms)
+    return queryset.filter(search_row__book_search__match=match).annotate(
+        search_rank=F("search_row__rank")
+    )
+
+
+def _search_postgresql(queryset, terms: list):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+    search_query = SearchQuery(" ".join(terms), config=SEARCH_CONFIG)
+    weighted_vector = SearchVector(
+        "title", config=SEARCH_CONFIG, weight="A"
+    ) + SearchVector("author", config=SEARCH_CONFIG, weight="B")
+    weights = [0.0, 0.0, AUTHOR_WEIGHT / TITLE_WEIGHT, 1.0]
+    return (
+        queryset.alias(search_vector=search_vector())
+        .filter(search_vector=search_query)
+        .annotate(
+            search_rank=ExpressionWrapper(
+                -SearchRank(weighted_vector, search_query, weights=weights),
+                output_field=FloatField(),
+            )
+        )
+    )
+
+
+def _search_scan(queryset, terms: list):
+    matches = Q()
+    for term in terms:
+        matches &= Q(title__icontains=term) | Q(author__icontains=term)
+    return queryset.filter(matches).annotate(
+        search_rank=Value(0.0, output_field=FloatField())
+    )
+
+
+def index_books(books) -> None:
+    """Write the search rows of the given books, replacing older ones"""
+    if connection.vendor != "sqlite":
+        return
+    rows = [(book.pk, book.title, book.author) for book in books]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk, *_ in rows]
+        )
+        cursor.executemany(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, author) VALUES (%s, %s, %s)",
+            rows,
+        )
+
+
+def unindex_books(book_ids) -> None:
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s",
+            [(book_id,) for book_id in book_ids],
+        )
+
+
+def rebuild_search_index() -> None:
+    """Reindex every book, e.g. after bulk_create() skipped the signals"""
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, title, author) "
+            f"SELECT id, title, author FROM book_book"
+        )
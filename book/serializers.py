@@ -1,9 +1,26 @@
+from django.db.models.functions import JSONObject
 from rest_framework import serializers
 
-from book.models import Book
+from book.models import Book, BookStats
+
+
+class BookStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BookStats
+        fields = (
+            "active_loans",
+            "overdue_loans",
+            "overdue_as_of",
+            "lifetime_loans",
+            "revenue",
+        )
 
 
 class BookSerializer(serializers.ModelSerializer):
+    """Fields in Meta.expandable are only sent when named in context["expand"]"""
+
+    stats = BookStatsSerializer(read_only=True)
+
     class Meta:
         model = Book
         fields = (
@@ -13,4 +30,36 @@ class BookSerializer(serializers.ModelSerializer):
             "cover",
             "inventory",
             "daily_fee",
+            "stats",
         )
+        expandable = ("stats",)
+        # values() sources of the fields LeanSerializer cannot read directly.
+        value_sources = {
+            "stats": JSONObject(
+                **{
+                    name: f"stats__{name}"
+                    for name in BookStatsSerializer.Meta.fields
+                }
+            ),
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        expand = self.context.get("expand", ())
+        for name in self.Meta.expandable:
+            if name not in expand:
+                self.fields.pop(name)
+
+
+class BookFilterSerializer(serializers.Serializer):
+    """Query parameters of the book list, named after the lookups they apply"""
+
+    author = serializers.CharField(required=False)
+    cover = serializers.ChoiceField(choices=Book.CoverChoices.choices, required=False)
+    inventory__gt = serializers.IntegerField(min_value=0, required=False)
+    daily_fee__gte = serializers.DecimalField(
+        max_digits=10, decimal_places=2, required=False
+    )
+    daily_fee__lte = serializers.DecimalField(
+        max_digits=10, decimal_places=2, required=False
+    )
@@ -0,0 +1,31 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from book.autocomplete import book_changed
+from book.cache import invalidate_books
+from book.models import Book, BookStats
+from book.search import index_books, unindex_books
+
+
+@receiver([post_save, post_delete], sender=Book)
+def invalidate_book_cache(sender, instance, **kwargs) -> None:
+    invalidate_books([instance.pk])
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, update_fields=None, **kwargs) -> None:
+    index_books([instance])
+    if update_fields is None or {"title", "author"} & set(update_fields):
+        book_changed(instance.pk, instance.title, instance.author)
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs) -> None:
+    unindex_books([instance.pk])
+    book_changed(instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def create_book_stats(sender, instance, created, **kwargs) -> None:
+    if created:
+        BookStats.objects.bulk_create([BookStats(book=instance)], ignore_conflicts=True)
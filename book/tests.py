@@ -1,15 +1,43 @@
-from django.test import TestCase
+import re
+import threading
+from base64 import b64encode
+from datetime import date, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
 from rest_framework import status
+from rest_framework.request import Request
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
 
-from book.models import Book
+from book import autocomplete
+from book.autocomplete import AUTOCOMPLETE_VERSION_KEY, AutocompleteIndex
+from book.models import Book, BookStats
 from book.serializers import BookSerializer
+from book.views import BookViewSet
+from borrowing import export
+from borrowing.models import Borrowing
+from instrumentation import QueryBudgetTestMixin, registry
+from pagination import BookPagination
+from readpool import ReadPoolASGIHandler
+from versioning import bump_versions
 
 BOOK_URL = reverse("book:book-list")
+AUTOCOMPLETE_URL = reverse("book:book-autocomplete")
+METRICS_URL = reverse("metrics")
 
 
 def detail_url(book_id: int):
@@ -97,5 +125,650 @@ class BookAdminApiTest(TestCase):
         serializer = BookSerializer(book_list, many=True)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response1.data[0], serializer.data[0])
+        self.assertEqual(response1.data["results"][0], serializer.data[0])
         self.assertEqual(book_list[0].inventory, payload["inventory"])
+
+
+class BookPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        for author in ("Orwell", "Atwood", "Kerouac"):
+            for title in ("B", "A", "A"):
+                sample_book(author=author, title=title)
+
+    def test_cursor_walks_every_book_once_in_order(self):
+        expected = list(
+            Book.objects.order_by("author", "title", "id").values_list("id", flat=True)
+        )
+        seen = []
+        url = BOOK_URL + "?page_size=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(book["id"] for book in response.data["results"])
+            url = response.data["next"]
+
+        self.assertEqual(seen, expected)
+
+    def test_previous_link_returns_previous_page(self):
+        first = self.client.get(BOOK_URL, {"page_size": 4})
+        second = self.client.get(first.data["next"])
+        back = self.client.get(second.data["previous"])
+
+        self.assertEqual(back.data["results"], first.data["results"])
+
+    @mock.patch.object(BookPagination, "max_page_size", 3)
+    def test_page_size_is_capped(self):
+        response = self.client.get(BOOK_URL, {"page_size": 1000})
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_invalid_cursor(self):
+        cursor = b64encode(b"p=not-a-position").decode()
+        response = self.client.get(BOOK_URL, {"cursor": cursor})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BookCatalogueCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.book = sample_book()
+
+    def test_repeated_list_is_served_from_cache(self):
+        self.client.get(BOOK_URL)
+        with self.assertNumQueries(0):
+            response = self.client.get(BOOK_URL)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["id"], self.book.id)
+
+    def test_repeated_detail_is_served_from_cache(self):
+        self.client.get(detail_url(self.book.id))
+        with self.assertNumQueries(0):
+            response = self.client.get(detail_url(self.book.id))
+
+        self.assertEqual(response.data["title"], self.book.title)
+
+    def test_conditional_get_returns_not_modified(self):
+        etag = self.client.get(BOOK_URL)["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(BOOK_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_book_save_invalidates_list_and_detail(self):
+        list_etag = self.client.get(BOOK_URL)["ETag"]
+        detail_etag = self.client.get(detail_url(self.book.id))["ETag"]
+        self.book.inventory = 1
+        self.book.save()
+
+        response = self.client.get(BOOK_URL, HTTP_IF_NONE_MATCH=list_etag)
+        detail = self.client.get(
+            detail_url(self.book.id), HTTP_IF_NONE_MATCH=detail_etag
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["inventory"], 1)
+        self.assertEqual(detail.data["inventory"], 1)
+
+    def test_save_keeps_other_books_detail_cached(self):
+        other = sample_book(title="Big Sur")
+        etag = self.client.get(detail_url(other.id))["ETag"]
+        self.book.save()
+
+        response = self.client.get(detail_url(other.id), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_book_delete_invalidates_list(self):
+        self.client.get(BOOK_URL)
+        self.book.delete()
+
+        response = self.client.get(BOOK_URL)
+        self.assertEqual(response.data["results"], [])
+
+    def test_borrowing_invalidates_inventory(self):
+        user = get_user_model().objects.create_user("cache@test.com", "test1234")
+        self.client.force_authenticate(user)
+        self.client.get(detail_url(self.book.id))
+        self.client.post(
+            reverse("borrowing:borrowing-list"),
+            {
+                "book": self.book.id,
+                "expected_return_date": date.today() + timedelta(days=3),
+            },
+        )
+
+        response = self.client.get(detail_url(self.book.id))
+        self.assertEqual(response.data["inventory"], 4)
+
+
+class BookSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.hobbit = sample_book(title="The Hobbit", author="J. R. R. Tolkien")
+        self.rings = sample_book(
+            title="The Lord of the Rings", author="J. R. R. Tolkien"
+        )
+        self.about = sample_book(title="Tolkien", author="Humphrey Carpenter")
+        self.road = sample_book()
+
+    def search(self, query: str, **params) -> list:
+        response = self.client.get(BOOK_URL, {"q": query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book["id"] for book in response.data["results"]]
+
+    def test_title_match_ranks_first(self):
+        ids = self.search("tolkien")
+        self.assertEqual(ids[0], self.about.id)
+        self.assertCountEqual(ids, [self.about.id, self.hobbit.id, self.rings.id])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self.search("Tolkien hobbit"), [self.hobbit.id])
+        self.assertEqual(self.search("tolkien kerouac"), [])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(self.search('hobbit" OR "road'), [])
+        self.assertEqual(self.search("*"), [])
+
+    def test_index_follows_save_and_delete(self):
+        self.hobbit.title = "There and Back Again"
+        self.hobbit.save()
+        self.rings.delete()
+
+        self.assertEqual(self.search("hobbit"), [])
+        self.assertEqual(self.search("back again"), [self.hobbit.id])
+        self.assertEqual(self.search("rings"), [])
+
+    def test_cursor_walks_ranked_results(self):
+        expected = list(Book.objects.search("tolkien").values_list("id", flat=True))
+        seen = []
+        response = self.client.get(BOOK_URL, {"q": "tolkien", "page_size": 1})
+        while True:
+            seen.extend(book["id"] for book in response.data["results"])
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+
+        self.assertEqual(seen, expected)
+
+    def test_rebuild_indexes_bulk_created_books(self):
+        Book.objects.bulk_create(
+            [
+                Book(
+                    title="Dune",
+                    author="Frank Herbert",
+                    cover="Soft",
+                    inventory=1,
+                    daily_fee=1,
+                )
+            ]
+        )
+        self.assertEqual(self.search("dune"), [])
+
+        Book.objects.rebuild_search_index()
+        cache.clear()
+        self.assertEqual(len(self.search("dune")), 1)
+
+
+class BookAutocompleteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        sample_book(title="The Hobbit", author="J. R. R. Tolkien")
+        sample_book(title="The Lord of the Rings", author="J. R. R. Tolkien")
+        self.book = sample_book(title="Tolkien", author="Humphrey Carpenter")
+
+    def suggest(self, prefix: str, **params) -> list:
+        response = self.client.get(AUTOCOMPLETE_URL, {"prefix": prefix, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(item["field"], item["text"]) for item in response.data]
+
+    def test_prefix_of_title_author_and_later_word(self):
+        self.assertEqual(
+            self.suggest("tol"),
+            [("title", "Tolkien"), ("author", "J. R. R. Tolkien")],
+        )
+        self.assertEqual(self.suggest("lord o"), [("title", "The Lord of the Rings")])
+
+    def test_suggestions_are_distinct_with_book_counts(self):
+        response = self.client.get(AUTOCOMPLETE_URL, {"prefix": "j r r"})
+        self.assertEqual(
+            response.data,
+            [{"text": "J. R. R. Tolkien", "field": "author", "books": 2}],
+        )
+
+    def test_misspelt_word_is_corrected(self):
+        self.assertEqual(self.suggest("hobit"), [("title", "The Hobbit")])
+        self.assertIn(("author", "J. R. R. Tolkien"), self.suggest("tolkein"))
+
+    def test_limit(self):
+        self.assertEqual(len(self.suggest("t", limit=1)), 1)
+        self.assertEqual(self.suggest("", limit=1), [])
+
+    def test_index_follows_save_and_delete(self):
+        self.suggest("tol")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.title = "Biography"
+            self.book.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("biog"), [("title", "Biography")])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.delete()
+        self.assertEqual(self.suggest("biog"), [])
+        self.assertEqual(self.suggest("humphrey"), [])
+
+    def test_other_process_change_is_applied_from_its_log(self):
+        self.suggest("tol")
+        Book.objects.filter(pk=self.book.pk).update(title="Biography")
+        with mock.patch.object(autocomplete, "_index", None):
+            with self.captureOnCommitCallbacks(execute=True):
+                autocomplete.book_changed(self.book.pk, "Biography", "Carpenter")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("biog"), [("title", "Biography")])
+        self.assertEqual(self.suggest("humphrey"), [])
+
+    def test_gap_in_change_log_triggers_rebuild(self):
+        self.suggest("tol")
+        Book.objects.filter(pk=self.book.pk).update(title="Biography")
+        self.assertEqual(self.suggest("biog"), [])
+
+        bump_versions([AUTOCOMPLETE_VERSION_KEY])
+        self.assertEqual(self.suggest("biog"), [("title", "Biography")])
+
+    def test_lookups_wait_for_changes(self):
+        index = AutocompleteIndex.build([(1, "Dune", "Frank Herbert")])
+        results = []
+        with index.lock:
+            reader = threading.Thread(
+                target=lambda: results.append(index.suggest("dune", 5))
+            )
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            index.apply(1)
+        reader.join()
+        self.assertEqual(results, [[]])
+
+    def test_entries_over_budget_are_not_indexed(self):
+        index = AutocompleteIndex.build(
+            [(1, "Dune", "Frank Herbert"), (2, "Emma", "Jane Austen")],
+            max_entries=3,
+        )
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.dropped, 1)
+        self.assertEqual(index.suggest("jane", 5), [])
+
+
+class BookFilterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.cheap = sample_book(title="Cheap", daily_fee="0.10", cover="Soft")
+        self.gone = sample_book(title="Gone", daily_fee="0.20", inventory=0)
+        self.dear = sample_book(title="Dear", daily_fee="2.00", author="Orwell")
+
+    def list_ids(self, **params) -> list:
+        response = self.client.get(BOOK_URL, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return [book["id"] for book in response.data["results"]]
+
+    def test_in_stock_cheapest_first(self):
+        with self.assertNumQueries(1):
+            ids = self.list_ids(inventory__gt=0, ordering="daily_fee")
+        self.assertEqual(ids, [self.cheap.id, self.dear.id])
+
+    def test_filters(self):
+        self.assertEqual(self.list_ids(cover="Soft"), [self.cheap.id])
+        self.assertEqual(self.list_ids(author="Orwell"), [self.dear.id])
+        self.assertEqual(
+            self.list_ids(daily_fee__gte="0.15", daily_fee__lte="1"), [self.gone.id]
+        )
+
+    def test_descending_ordering_walks_every_page(self):
+        sample_book(title="Even", daily_fee="2.00")
+        expected = list(
+            Book.objects.order_by("-daily_fee", "-id").values_list("id", flat=True)
+        )
+        seen = []
+        url = BOOK_URL + "?ordering=-daily_fee&page_size=1"
+        while url:
+            response = self.client.get(url)
+            seen.extend(book["id"] for book in response.data["results"])
+            url = response.data["next"]
+
+        self.assertEqual(seen, expected)
+
+    def test_invalid_parameters(self):
+        for params in (
+            {"ordering": "inventory"},
+            {"cover": "Paper"},
+            {"inventory__gt": "many"},
+            {"daily_fee__lte": "cheap"},
+        ):
+            response = self.client.get(BOOK_URL, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BookListQueryPlanTest(TestCase):
+    """Fail when a book list query scans the table or sorts it in memory."""
+
+    def setUp(self):
+        for index in range(20):
+            sample_book(
+                title=f"Book {index}", daily_fee=index / 10, inventory=index % 3
+            )
+
+    def assert_indexed(self, params: dict) -> None:
+        request = APIClient().get(BOOK_URL, params).wsgi_request
+        view = BookViewSet(request=Request(request), action="list", format_kwarg=None)
+        queryset = view.get_queryset()
+        ordering = BookPagination().get_ordering(view.request, queryset, view)
+        queryset = queryset.order_by(*ordering)[:21]
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        table = Book._meta.db_table
+        full_scan = re.compile(rf"(Seq Scan on {table}\b|\bSCAN {table}$|\bSort\b)")
+        self.assertIsNone(full_scan.search(plan), plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_default_list(self):
+        self.assert_indexed({})
+
+    def test_by_author(self):
+        self.assert_indexed({"author": "Jack Kerouac"})
+
+    def test_by_cover(self):
+        self.assert_indexed({"cover": "Hard"})
+
+    def test_in_stock_cheapest_first(self):
+        self.assert_indexed({"inventory__gt": 0, "ordering": "daily_fee"})
+
+    def test_fee_range_by_fee(self):
+        self.assert_indexed(
+            {"daily_fee__gte": "0.5", "daily_fee__lte": "1.5", "ordering": "-daily_fee"}
+        )
+
+    def test_by_title(self):
+        self.assert_indexed({"ordering": "title"})
+
+
+class BookFieldsetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        sample_book(title="The Hobbit", author="Tolkien", daily_fee="1.50")
+        sample_book(title="Dune", author="Herbert")
+
+    def test_lean_list_matches_serializer(self):
+        response = self.client.get(BOOK_URL)
+        books = Book.objects.order_by("author", "title", "id")
+        self.assertEqual(
+            response.data["results"], BookSerializer(books, many=True).data
+        )
+
+    def test_fields_and_omit(self):
+        response = self.client.get(BOOK_URL, {"fields": "title,daily_fee"})
+        self.assertEqual(
+            response.data["results"],
+            [
+                {"title": "Dune", "daily_fee": "0.77"},
+                {"title": "The Hobbit", "daily_fee": "1.50"},
+            ],
+        )
+
+        response = self.client.get(BOOK_URL, {"omit": "id,cover,inventory"})
+        self.assertEqual(
+            set(response.data["results"][0]), {"title", "author", "daily_fee"}
+        )
+
+    def test_fields_with_search(self):
+        response = self.client.get(BOOK_URL, {"q": "hobbit", "fields": "title"})
+        self.assertEqual(response.data["results"], [{"title": "The Hobbit"}])
+
+    def test_unknown_field(self):
+        response = self.client.get(BOOK_URL, {"omit": "isbn"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BookStatsExpansionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.admin = get_user_model().objects.create_user(
+            "admin@test.com", "test1234", is_staff=True
+        )
+        self.book = sample_book()
+        BookStats.objects.record_loans({self.book.id: 2})
+        BookStats.objects.refresh_overdue(date(2023, 1, 2))
+
+    def test_staff_expand_list_and_detail(self):
+        self.client.force_authenticate(self.admin)
+        expected = {
+            "active_loans": 2,
+            "overdue_loans": 0,
+            "overdue_as_of": "2023-01-02",
+            "lifetime_loans": 2,
+            "revenue": 0,
+        }
+
+        response = self.client.get(BOOK_URL, {"expand": "stats"})
+        self.assertEqual(response.data["results"][0]["stats"], expected)
+        response = self.client.get(detail_url(self.book.id), {"expand": "stats"})
+        self.assertEqual(response.data["stats"], expected)
+        response = self.client.get(BOOK_URL, {"expand": "stats", "fields": "stats"})
+        self.assertEqual(response.data["results"], [{"stats": expected}])
+
+    def test_not_expanded_by_default(self):
+        self.client.force_authenticate(self.admin)
+        self.assertNotIn("stats", self.client.get(BOOK_URL).data["results"][0])
+
+    def test_staff_only_even_when_cached(self):
+        self.client.force_authenticate(self.admin)
+        self.client.get(BOOK_URL, {"expand": "stats"})
+        self.client.force_authenticate(None)
+
+        response = self.client.get(BOOK_URL, {"expand": "stats"})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_unknown_expansion(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(BOOK_URL, {"expand": "borrowings"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class InstrumentationTest(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.client = APIClient()
+        self.book = sample_book()
+
+    def test_book_reads_within_budget(self):
+        self.assertWithinQueryBudget(self.client.get(BOOK_URL))
+        self.assertWithinQueryBudget(self.client.get(detail_url(self.book.id)))
+        self.assertWithinQueryBudget(
+            self.client.get(AUTOCOMPLETE_URL, {"prefix": "on"})
+        )
+
+    def test_signed_in_reads_within_budget(self):
+        user = get_user_model().objects.create_user("reader@test.com", "test1234")
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}"
+        )
+        self.assertWithinQueryBudget(self.client.get(BOOK_URL))
+        self.assertWithinQueryBudget(self.client.get(detail_url(self.book.id)))
+
+    def test_server_timing_header(self):
+        response = self.client.get(BOOK_URL)
+
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=[\d.]+;desc="1 queries", serialize;dur=[\d.]+, '
+            r"render;dur=[\d.]+, total;dur=[\d.]+$",
+        )
+        self.assertEqual(response.metrics.endpoint, "GET book:book-list")
+        self.assertEqual(response.metrics.action, "list")
+
+    def test_serialization_is_timed_apart_from_rendering(self):
+        for response in (
+            self.client.get(BOOK_URL),
+            self.client.get(detail_url(self.book.id)),
+        ):
+            self.assertGreater(response.metrics.serialize_seconds, 0)
+            self.assertGreater(response.metrics.render_seconds, 0)
+
+        cached = self.client.get(detail_url(self.book.id))
+        self.assertEqual(cached.metrics.serialize_seconds, 0)
+
+    @override_settings(METRICS_TOKEN="scrape")
+    def test_metrics_endpoint(self):
+        self.client.get(BOOK_URL)
+        self.client.get(BOOK_URL)
+        self.client.get("/api/book/unknown/")
+
+        self.assertEqual(self.client.get(METRICS_URL).status_code, 404)
+        response = self.client.get(METRICS_URL, HTTP_AUTHORIZATION="Bearer scrape")
+        body = response.content.decode()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+            'library_http_requests_total{endpoint="GET book:book-list",status="200"} 2',
+            body,
+        )
+        self.assertIn(
+            'library_http_requests_total{endpoint="GET <unresolved>",status="404"} 1',
+            body,
+        )
+        self.assertIn(
+            'library_http_request_duration_seconds_count{endpoint="GET book:book-list"} 2',
+            body,
+        )
+        self.assertIn('library_db_queries_total{endpoint="GET book:book-list"} 1', body)
+        self.assertIn(
+            'library_serialize_duration_seconds_total{endpoint="GET book:book-list"}',
+            body,
+        )
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_metrics_endpoint_disabled_without_token(self):
+        response = self.client.get(METRICS_URL, HTTP_AUTHORIZATION="Bearer None")
+        self.assertEqual(response.status_code, 404)
+
+
+def asgi_request(application, method: str, path: str, headers=()) -> tuple:
+    """Send a request to an ASGI application: (status, headers, body)"""
+    communicator = ApplicationCommunicator(
+        application,
+        {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "query_string": b"",
+            "headers": [(b"host", b"testserver"), *headers],
+        },
+    )
+
+    async def send() -> tuple:
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(5)
+        body = b""
+        while True:
+            message = await communicator.receive_output(5)
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        headers = {
+            name.decode().lower(): value.decode() for name, value in start["headers"]
+        }
+        return start["status"], headers, body
+
+    return async_to_sync(send)()
+
+
+class ReadPoolASGIHandlerTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.book = sample_book()
+        self.handler = ReadPoolASGIHandler()
+
+    def test_is_read(self):
+        factory = RequestFactory()
+
+        self.assertTrue(self.handler.is_read(factory.get(detail_url(self.book.id))))
+        self.assertTrue(self.handler.is_read(factory.head(BOOK_URL)))
+        self.assertFalse(self.handler.is_read(factory.post(BOOK_URL)))
+        self.assertFalse(
+            self.handler.is_read(factory.get(reverse("borrowing:payment-success")))
+        )
+        self.assertFalse(self.handler.is_read(factory.get("/api/book/unknown/")))
+
+    def test_reads_served_from_pool(self):
+        with mock.patch.object(
+            self.handler,
+            "get_read_response",
+            wraps=self.handler.get_read_response,
+        ) as get_read_response:
+            status_code, headers, body = asgi_request(
+                self.handler, "GET", detail_url(self.book.id)
+            )
+
+        get_read_response.assert_called_once()
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(body, self.client.get(detail_url(self.book.id)).content)
+        self.assertIn('desc="1 queries"', headers["server-timing"])
+
+    def test_read_streams_are_read_in_their_own_thread(self):
+        staff = get_user_model().objects.create_user(
+            "stream@test.com", "test1234", is_staff=True
+        )
+        Borrowing.objects.create(
+            book=self.book,
+            user=staff,
+            borrow_date=date.today(),
+            expected_return_date=date.today() + timedelta(days=3),
+        )
+        threads = set()
+        ndjson_lines = export.ndjson_lines
+
+        def lines(columns, rows):
+            for line in ndjson_lines(columns, rows):
+                threads.add(threading.current_thread().name.split("_")[0])
+                yield line
+
+        with mock.patch.object(export, "ndjson_lines", lines), mock.patch.object(
+            self.handler,
+            "get_read_response",
+            wraps=self.handler.get_read_response,
+        ) as get_read_response:
+            status_code, _, body = asgi_request(
+                self.handler,
+                "GET",
+                reverse("borrowing:borrowing-export"),
+                [(b"authorization", f"Bearer {AccessToken.for_user(staff)}".encode())],
+            )
+
+        get_read_response.assert_called_once()
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(len(body.splitlines()), 1)
+        self.assertEqual(threads, {"asgi-read-stream"})
+
+    def test_writes_not_served_from_pool(self):
+        with mock.patch.object(
+            self.handler, "get_read_response"
+        ) as get_read_response:
+            status_code, _, _ = asgi_request(self.handler, "POST", BOOK_URL)
+
+        get_read_response.assert_not_called()
+        self.assertEqual(status_code, status.HTTP_401_UNAUTHORIZED)
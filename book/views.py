@@ -1,14 +1,160 @@
-from rest_framework import viewsets
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.response import Response
 
+from book.autocomplete import DEFAULT_LIMIT, MAX_LIMIT, get_index
+from book.cache import CachedCatalogueMixin
 from book.models import Book
-from book.serializers import BookSerializer
+from book.serializers import BookFilterSerializer, BookSerializer
+from fieldsets import SparseFieldsetMixin
+from instrumentation import TimedSerializationMixin
+from pagination import BookPagination
 from permissions import IsAdminOrReadOnly
 
 
 class BookViewSet(
+    CachedCatalogueMixin,
+    SparseFieldsetMixin,
+    TimedSerializationMixin,
     viewsets.ModelViewSet,
 ):
     queryset = Book.objects.all()
 
     permission_classes = (IsAdminOrReadOnly,)
     serializer_class = BookSerializer
+    pagination_class = BookPagination
+    # Most SQL queries each action may run, including the JWT user lookup
+    # of signed-in readers, enforced by the test suite.
+    query_budgets = {"list": 2, "retrieve": 2, "autocomplete": 2}
+
+    def get_queryset(self):
+        queryset = self.queryset
+        query = self.request.query_params.get("q")
+
+        if "stats" in self.get_expand():
+            queryset = queryset.select_related("stats")
+
+        if self.action == "list":
+            filters = BookFilterSerializer(data=self.request.query_params)
+            filters.is_valid(raise_exception=True)
+            queryset = queryset.filter(**filters.validated_data)
+            if query:
+                queryset = queryset.search(query)
+
+        return queryset
+
+    def get_expand(self) -> tuple:
+        """Expandable serializer fields named in ?expand=, staff only"""
+        names = [
+            name.strip()
+            for name in self.request.query_params.get("expand", "").split(",")
+            if name.strip()
+        ]
+        if not names or self.action not in ("list", "retrieve"):
+            return ()
+        expandable = self.get_serializer_class().Meta.expandable
+        unknown = [name for name in names if name not in expandable]
+        if unknown:
+            raise ValidationError(
+                {"expand": f"Choose from: {', '.join(expandable)}"}
+            )
+        if not self.request.user.is_staff:
+            raise PermissionDenied("Only staff can expand book stats.")
+        return tuple(names)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["expand"] = self.get_expand()
+        return context
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "q",
+                type=OpenApiTypes.STR,
+                description="Search by title and author, best match first (ex. ?q=tolkien hobbit)",
+            ),
+            OpenApiParameter(
+                "author",
+                type=OpenApiTypes.STR,
+                description="Filter by exact author (ex. ?author=Jack Kerouac)",
+            ),
+            OpenApiParameter(
+                "cover",
+                type=OpenApiTypes.STR,
+                enum=Book.CoverChoices.values,
+                description="Filter by cover (ex. ?cover=Hard)",
+            ),
+            OpenApiParameter(
+                "inventory__gt",
+                type=OpenApiTypes.INT,
+                description="Filter by copies left, ?inventory__gt=0 for books in stock",
+            ),
+            OpenApiParameter(
+                "daily_fee__gte",
+                type=OpenApiTypes.DECIMAL,
+                description="Filter by minimal daily fee (ex. ?daily_fee__gte=0.50)",
+            ),
+            OpenApiParameter(
+                "daily_fee__lte",
+                type=OpenApiTypes.DECIMAL,
+                description="Filter by maximal daily fee (ex. ?daily_fee__lte=1.00)",
+            ),
+            OpenApiParameter(
+                "ordering",
+                type=OpenApiTypes.STR,
+                enum=[
+                    f"{prefix}{key}"
+                    for key in BookPagination.orderings
+                    for prefix in ("", "-")
+                ],
+                description="Sort by one field, '-' for descending (ex. ?ordering=daily_fee)",
+            ),
+            OpenApiParameter(
+                "fields",
+                type=OpenApiTypes.STR,
+                description="Return only these fields (ex. ?fields=id,title,author)",
+            ),
+            OpenApiParameter(
+                "expand",
+                type=OpenApiTypes.STR,
+                enum=["stats"],
+                description="Add loan stats of every book, staff only (ex. ?expand=stats)",
+            ),
+            OpenApiParameter(
+                "omit",
+                type=OpenApiTypes.STR,
+                description="Leave out these fields (ex. ?omit=inventory)",
+            ),
+        ]
+    )
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                "prefix",
+                type=OpenApiTypes.STR,
+                description="Beginning of a title or an author, typos tolerated (ex. ?prefix=tolkein)",
+            ),
+            OpenApiParameter(
+                "limit",
+                type=OpenApiTypes.INT,
+                description=f"Number of suggestions, at most {MAX_LIMIT}",
+            ),
+        ]
+    )
+    @action(methods=["GET"], detail=False, url_path="autocomplete")
+    def autocomplete(self, request):
+        """Suggest titles and authors from the in-process autocomplete index"""
+        try:
+            limit = int(request.query_params.get("limit", DEFAULT_LIMIT))
+        except ValueError:
+            limit = DEFAULT_LIMIT
+        limit = min(max(limit, 1), MAX_LIMIT)
+        suggestions = get_index().suggest(request.query_params.get("prefix", ""), limit)
+        return Response(suggestions, status=status.HTTP_200_OK)
@@ -1,6 +1,12 @@
 from django.contrib import admin
 
-from borrowing.models import Borrowing, Payment
+from borrowing.models import (
+    Borrowing,
+    Notification,
+    OutstandingBalance,
+    Payment,
+    StripeEvent,
+)
 
 
 @admin.register(Borrowing)
@@ -11,3 +17,21 @@ class BorrowingAdmin(admin.ModelAdmin):
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ("id", "chat_id", "status", "attempts", "created_at", "sent_at")
+    list_filter = ("status",)
+
+
+@admin.register(OutstandingBalance)
+class OutstandingBalanceAdmin(admin.ModelAdmin):
+    list_display = ("user", "pending_payments", "pending_amount")
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ("event_id", "type", "session_id", "created_at", "processed_at")
+    list_filter = ("type",)
+    search_fields = ("event_id", "session_id")
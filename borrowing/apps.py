@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class BorrowingConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "borrowing"
+
+    def ready(self):
+        from borrowing import reconcile
+        from instrumentation import registry
+
+        registry.collectors.append(reconcile.collect)
@@ -19,10 +19,6 @@ async def send_notification(message: types.Message) -> None:
     await message.reply(text=notification_text)
 
 
-def send_telegram_notification(notification_text: str) -> None:
-    bot.send_message(chat_id=CHAT_ID, text=notification_text)
-
-
 @dp.message_handler(filters.Text(contains="hello"))
 async def send_notification(message: types.Message) -> None:
     user_username = message.from_user.username
@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from borrowing.models import Payment
+from borrowing.session import CreateSession
+
+# Time after a session expires for the webhook or the reconciliation
+# to settle a payment made at the last minute, and for the sessions
+# Stripe was asked to keep open for its minimum lifetime.
+EXPIRY_GRACE = timedelta(hours=1)
+
+
+class PaymentExpirer:
+    """
+    Expire the pending payments whose checkout sessions have expired,
+    taking them off their users' outstanding balances, and optionally
+    record new pending payments with new sessions in their place
+    """
+
+    def __init__(self, regenerate: bool = None):
+        self.batch_size = settings.STRIPE_EXPIRE_BATCH_SIZE
+        if regenerate is None:
+            regenerate = settings.STRIPE_REGENERATE_EXPIRED_SESSIONS
+        self.regenerate = regenerate
+
+    def expire(self, payment_ids: list) -> dict:
+        """
+        Expire the given pending payments; counts of the rows changed.
+        Only the payments this call expired are regenerated, as another
+        may have expired and regenerated the rest already.
+        """
+        with transaction.atomic():
+            expired = Payment.objects.filter(pk__in=payment_ids).mark_expired()
+            regenerated = (
+                len(CreateSession.regenerate_payments(expired))
+                if self.regenerate and expired
+                else 0
+            )
+        return {"expired": len(expired), "regenerated": regenerated}
+
+    def run(self) -> dict:
+        """Expire the stale payments, one chunk at a time"""
+        started = time.perf_counter()
+        cutoff = (
+            timezone.now()
+            - timedelta(hours=settings.STRIPE_SESSION_EXPIRY_HOURS)
+            - EXPIRY_GRACE
+        )
+        stale = Payment.objects.filter(
+            status=Payment.StatusChoices.PENDING, created_at__lt=cutoff
+        ).order_by("created_at", "id")
+        metrics = {"batches": 0, "expired": 0, "regenerated": 0}
+        while True:
+            # Expired payments leave the pending ones: each chunk is new.
+            payment_ids = list(stale.values_list("id", flat=True)[: self.batch_size])
+            if not payment_ids:
+                break
+            for name, count in self.expire(payment_ids).items():
+                metrics[name] += count
+            metrics["batches"] += 1
+        metrics["duration"] = round(time.perf_counter() - started, 4)
+        return metrics
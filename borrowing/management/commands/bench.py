@@ -0,0 +1,328 @@
+import json
+import logging
+import random
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework_simplejwt.tokens import AccessToken
+
+from book.models import Book, BookStats
+from book.search import index_books, unindex_books
+from borrowing.models import Borrowing, Notification, OutstandingBalance, Payment
+from borrowing.tasks import create_payment_session_task, send_notifications_task
+from borrowing.testing import FakeStripeClient
+
+EMAIL_DOMAIN = "bench.invalid"
+BATCH_SIZE = 2000
+
+
+def percentile(sorted_values: list, share: float) -> float:
+    position = min(int(len(sorted_values) * share), len(sorted_values) - 1)
+    return round(sorted_values[position] * 1000, 3)
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    """Report of (latency, status code, query count) results"""
+    if not results:
+        return {"requests": 0}
+    latencies = sorted(latency for latency, _, _ in results)
+    queries = [count for _, _, count in results]
+    return {
+        "requests": len(results),
+        "statuses": dict(Counter(str(status) for _, status, _ in results)),
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "requests_per_second": round(len(results) / elapsed, 1),
+        "queries_mean": round(sum(queries) / len(queries), 2),
+        "queries_max": max(queries),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic library with bulk inserts, drive the hot API "
+        "endpoints in-process from several threads and report latency "
+        "percentiles, throughput and query counts as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--books", type=int, default=2000)
+        parser.add_argument("--borrowings", type=int, default=10000)
+        parser.add_argument(
+            "--pending-share",
+            type=float,
+            default=0.1,
+            help="Share of returned borrowings whose payment is still pending",
+        )
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Threads sending requests; SQLite fails some concurrent writes",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep", action="store_true", help="Do not delete the seeded rows"
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        self.concurrency = options["concurrency"]
+        self.requests = options["requests"]
+
+        start = time.perf_counter()
+        dataset = self.seed(rng, options)
+        seed_seconds = time.perf_counter() - start
+
+        sent = Counter()
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=["testserver"],
+                STRIPE_CLIENT="borrowing.testing.FakeStripeClient",
+                CHAT_ID=dataset["chat_id"],
+            ), mock.patch.object(
+                SimpleRateThrottle, "THROTTLE_RATES", {"anon": None, "user": None}
+            ), mock.patch.object(
+                create_payment_session_task,
+                "delay",
+                lambda *args: sent.update(["create_payment_session"]),
+            ), mock.patch.object(
+                send_notifications_task,
+                "apply_async",
+                lambda **kwargs: sent.update(["send_notifications"]),
+            ), mock.patch.object(
+                # Failed requests are counted in "statuses" instead.
+                logging.getLogger("django.request"),
+                "disabled",
+                True,
+            ):
+                scenarios = self.run_scenarios(rng, dataset)
+        finally:
+            if not options["keep"]:
+                self.clean_up(dataset)
+
+        report = {
+            "vendor": connection.vendor,
+            "dataset": {
+                "users": len(dataset["users"]),
+                "books": len(dataset["books"]),
+                "borrowings": options["borrowings"],
+                "pending_payments": len(dataset["sessions"]),
+                "seed_seconds": round(seed_seconds, 2),
+            },
+            "concurrency": self.concurrency,
+            "scenarios": scenarios,
+            "tasks_not_sent": dict(sent),
+        }
+        self.stdout.write(json.dumps(report))
+
+    def seed(self, rng, options) -> dict:
+        password = make_password(None)
+        users = get_user_model().objects.bulk_create(
+            get_user_model()(
+                email=f"bench-{options['seed']}-{number}@{EMAIL_DOMAIN}",
+                password=password,
+                is_staff=number == 0,
+            )
+            for number in range(options["users"])
+        )
+        books = Book.objects.bulk_create(
+            (
+                Book(
+                    title=f"Bench book {number}",
+                    author=f"Bench author {number % 97}",
+                    cover=rng.choice(Book.CoverChoices.values),
+                    inventory=rng.randint(0, 5) + 1000,
+                    daily_fee=Decimal(rng.randint(10, 300)) / 100,
+                )
+                for number in range(options["books"])
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        index_books(books)
+
+        today = date.today()
+        borrowings = []
+        for _ in range(options["borrowings"]):
+            borrow_date = today - timedelta(days=rng.randint(0, 365))
+            expected = borrow_date + timedelta(days=rng.randint(1, 30))
+            returned = rng.random() < 0.8
+            borrowings.append(
+                Borrowing(
+                    user=rng.choice(users[1:] or users),
+                    book=rng.choice(books),
+                    borrow_date=borrow_date,
+                    expected_return_date=expected,
+                    actual_return_date=(
+                        min(expected + timedelta(days=rng.randint(-1, 5)), today)
+                        if returned
+                        else None
+                    ),
+                )
+            )
+        borrowings = Borrowing.objects.bulk_create(borrowings, batch_size=BATCH_SIZE)
+
+        returned = [b for b in borrowings if b.actual_return_date is not None]
+        client = FakeStripeClient()
+        payments = []
+        for borrowing in returned:
+            session_id = f"cs_bench_{borrowing.id}"
+            pending = rng.random() < options["pending_share"]
+            if pending:
+                # Paid on Stripe, for the success redirect to confirm.
+                session_id = client.create_checkout_session([], session_id).id
+                FakeStripeClient.complete(session_id)
+            payments.append(
+                Payment(
+                    borrowing=borrowing,
+                    status=(
+                        Payment.StatusChoices.PENDING
+                        if pending
+                        else Payment.StatusChoices.PAID
+                    ),
+                    session_id=session_id,
+                    payment_amount=rng.randint(100, 3000),
+                )
+            )
+        payments = Payment.objects.bulk_create(payments, batch_size=BATCH_SIZE)
+        OutstandingBalance.objects.rebuild(user_ids=[user.id for user in users])
+        BookStats.objects.rebuild(book_ids=[book.id for book in books])
+
+        users_by_id = {user.id: user for user in users}
+        pending_users = {
+            payment.borrowing.user_id
+            for payment in payments
+            if payment.status == Payment.StatusChoices.PENDING
+        }
+        return {
+            # Notifications sent by the scenarios go to this chat alone,
+            # so that clean_up finds them among the real ones.
+            "chat_id": f"bench-{uuid.uuid4().hex}",
+            "staff": users[0],
+            "users": users,
+            "books": books,
+            "borrowers": [user for user in users[1:] if user.id not in pending_users],
+            "active": [b.id for b in borrowings if b.actual_return_date is None],
+            # (user, checkout session) of each pending payment.
+            "sessions": [
+                (users_by_id[payment.borrowing.user_id], payment.session_id)
+                for payment in payments
+                if payment.status == Payment.StatusChoices.PENDING
+            ],
+        }
+
+    def run_scenarios(self, rng, dataset) -> dict:
+        users = dataset["users"][1:] or dataset["users"]
+        borrowers = dataset["borrowers"] or users
+        books = dataset["books"]
+        due = (date.today() + timedelta(days=14)).isoformat()
+        active = list(dataset["active"])
+        sessions = list(dataset["sessions"])
+        rng.shuffle(active)
+        rng.shuffle(sessions)
+
+        def payment_success():
+            user, session_id = sessions.pop()
+            url = reverse("borrowing:payment-success")
+            return user, "get", url, {"session_id": session_id}
+
+        book_list = reverse("book:book-list")
+        borrowing_list = reverse("borrowing:borrowing-list")
+        scenarios = {
+            "book_list": lambda: (
+                None,
+                "get",
+                book_list,
+                {
+                    "ordering": rng.choice(["author", "title", "-daily_fee"]),
+                    "daily_fee__lte": f"{rng.randint(20, 300) / 100:.2f}",
+                },
+            ),
+            "book_detail": lambda: (
+                None,
+                "get",
+                reverse("book:book-detail", args=[rng.choice(books).id]),
+                None,
+            ),
+            "borrowing_list": lambda: (rng.choice(users), "get", borrowing_list, None),
+            "borrowing_create": lambda: (
+                rng.choice(borrowers),
+                "post",
+                borrowing_list,
+                {"book": rng.choice(books).id, "expected_return_date": due},
+            ),
+            "borrowing_return": lambda: (
+                dataset["staff"],
+                "post",
+                reverse("borrowing:borrowing-return", args=[active.pop()]),
+                None,
+            ),
+            "payment_success": payment_success,
+        }
+        limits = {
+            "borrowing_return": len(active),
+            "payment_success": len(sessions),
+        }
+        return {
+            name: self.run(
+                make_request, min(self.requests, limits.get(name, self.requests))
+            )
+            for name, make_request in scenarios.items()
+        }
+
+    def run(self, make_request, count: int) -> dict:
+        """Send `count` requests built by make_request from the thread pool"""
+        requests = [make_request() for _ in range(count)]
+        tokens = {}
+
+        def send(request) -> tuple:
+            user, method, url, data = request
+            headers = {}
+            if user is not None:
+                if user.id not in tokens:
+                    tokens[user.id] = str(AccessToken.for_user(user))
+                headers["HTTP_AUTHORIZATION"] = f"Bearer {tokens[user.id]}"
+            try:
+                start = time.perf_counter()
+                response = getattr(Client(raise_request_exception=False), method)(
+                    url, data, **headers
+                )
+                return (
+                    time.perf_counter() - start,
+                    response.status_code,
+                    response.metrics.queries,
+                )
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(pool.map(send, requests))
+        return summarize(results, time.perf_counter() - start)
+
+    @staticmethod
+    def clean_up(dataset) -> None:
+        """Delete the seeded rows and those the scenarios wrote, only"""
+        user_ids = [user.id for user in dataset["users"]]
+        book_ids = [book.id for book in dataset["books"]]
+        Payment.objects.filter(borrowing__user_id__in=user_ids).delete()
+        Borrowing.objects.filter(user_id__in=user_ids).delete()
+        get_user_model().objects.filter(id__in=user_ids).delete()
+        Book.objects.filter(id__in=book_ids).delete()
+        Notification.objects.filter(chat_id=dataset["chat_id"]).delete()
+        unindex_books(book_ids)
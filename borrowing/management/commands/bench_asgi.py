@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from urllib.parse import urlencode
+
+from asgiref.testing import ApplicationCommunicator
+from django.core.handlers.asgi import ASGIHandler
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from rest_framework.throttling import SimpleRateThrottle
+from rest_framework_simplejwt.tokens import AccessToken
+
+from borrowing.management.commands import bench
+from readpool import ReadPoolASGIHandler
+
+RESPONSE_TIMEOUT = 300
+QUERIES = re.compile(r'"(\d+) queries"')
+
+
+class Command(bench.Command):
+    help = (
+        "Seed a synthetic library like bench, send the read endpoints the "
+        "same requests through the WSGI handler, Django's ASGI handler and "
+        "ReadPoolASGIHandler at each concurrency and report latency "
+        "percentiles and throughput as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--books", type=int, default=2000)
+        parser.add_argument("--borrowings", type=int, default=10000)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            nargs="+",
+            default=[100, 1000],
+            help="Concurrent clients; WSGI runs one thread per client",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        dataset = self.seed(rng, {**options, "pending_share": 0})
+        read_pool = ReadPoolASGIHandler()
+        report = {}
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=["testserver"], CHAT_ID=dataset["chat_id"]
+            ), mock.patch.object(
+                SimpleRateThrottle, "THROTTLE_RATES", {"anon": None, "user": None}
+            ), mock.patch.object(
+                logging.getLogger("django.request"), "disabled", True
+            ):
+                for concurrency in options["concurrency"]:
+                    report[concurrency] = {
+                        name: {
+                            "wsgi": self.run_wsgi(requests, concurrency),
+                            "asgi": self.run_asgi(ASGIHandler(), requests, concurrency),
+                            "asgi_read_pool": self.run_asgi(
+                                read_pool, requests, concurrency
+                            ),
+                        }
+                        for name, requests in self.make_requests(
+                            rng, dataset, options["requests"]
+                        ).items()
+                    }
+        finally:
+            self.clean_up(dataset)
+
+        self.stdout.write(
+            json.dumps({"vendor": connection.vendor, "concurrency": report})
+        )
+
+    @staticmethod
+    def make_requests(rng, dataset, count: int) -> dict:
+        """Scenario name -> `count` (access token, url, query) tuples"""
+        tokens = {user.id: str(AccessToken.for_user(user)) for user in dataset["users"]}
+        users = dataset["users"][1:] or dataset["users"]
+        staff = tokens[dataset["staff"].id]
+        books = dataset["books"]
+        borrowings = dataset["active"] or [0]
+        scenarios = {
+            "book_list": lambda: (
+                None,
+                reverse("book:book-list"),
+                {"ordering": rng.choice(["author", "title", "-daily_fee"])},
+            ),
+            "book_detail": lambda: (
+                None,
+                reverse("book:book-detail", args=[rng.choice(books).id]),
+                None,
+            ),
+            "borrowing_list": lambda: (
+                tokens[rng.choice(users).id],
+                reverse("borrowing:borrowing-list"),
+                None,
+            ),
+            "borrowing_detail": lambda: (
+                staff,
+                reverse("borrowing:borrowing-detail", args=[rng.choice(borrowings)]),
+                None,
+            ),
+            "user_me": lambda: (
+                tokens[rng.choice(users).id],
+                reverse("user:manage"),
+                None,
+            ),
+        }
+        return {
+            name: [make_request() for _ in range(count)]
+            for name, make_request in scenarios.items()
+        }
+
+    @staticmethod
+    def run_wsgi(requests: list, concurrency: int) -> dict:
+        """The requests through the WSGI handler, one thread per client"""
+
+        def send(request) -> tuple:
+            token, url, query = request
+            headers = {"HTTP_AUTHORIZATION": f"Bearer {token}"} if token else {}
+            try:
+                start = time.perf_counter()
+                response = Client(raise_request_exception=False).get(
+                    url, query, **headers
+                )
+                return (
+                    time.perf_counter() - start,
+                    response.status_code,
+                    response.metrics.queries,
+                )
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(send, requests))
+        return bench.summarize(results, time.perf_counter() - start)
+
+    @staticmethod
+    def run_asgi(application, requests: list, concurrency: int) -> dict:
+        """The requests through an ASGI application, from one event loop"""
+        pending = iter(requests)
+        results = []
+
+        async def client() -> None:
+            for token, url, query in pending:
+                headers = [(b"host", b"testserver")]
+                if token:
+                    headers.append((b"authorization", f"Bearer {token}".encode()))
+                communicator = ApplicationCommunicator(
+                    application,
+                    {
+                        "type": "http",
+                        "asgi": {"version": "3.0"},
+                        "http_version": "1.1",
+                        "method": "GET",
+                        "scheme": "http",
+                        "path": url,
+                        "query_string": urlencode(query or {}).encode(),
+                        "headers": headers,
+                    },
+                )
+                start = time.perf_counter()
+                await communicator.send_input({"type": "http.request"})
+                response = await communicator.receive_output(RESPONSE_TIMEOUT)
+                while (await communicator.receive_output(RESPONSE_TIMEOUT)).get(
+                    "more_body"
+                ):
+                    pass
+                headers = {name.lower(): value for name, value in response["headers"]}
+                server_timing = headers[b"server-timing"]
+                results.append(
+                    (
+                        time.perf_counter() - start,
+                        response["status"],
+                        int(QUERIES.search(server_timing.decode()).group(1)),
+                    )
+                )
+
+        async def clients() -> None:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+
+        start = time.perf_counter()
+        asyncio.run(clients())
+        return bench.summarize(results, time.perf_counter() - start)
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from celery import shared_task, uuid
+from celery.app.trace import trace_task
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from library_service.celery import app
+
+# Environment of each profile compared; "worker_results" is the former
+# configuration, keeping every result and its STARTED state.
+PROFILES = {
+    "eager": {"CELERY_PROFILE": "eager"},
+    "worker": {"CELERY_PROFILE": "worker", "CELERY_RESULT_BACKEND": ""},
+    "worker_results": {
+        "CELERY_PROFILE": "worker",
+        "CELERY_RESULT_BACKEND": "cache+memory://",
+    },
+}
+
+
+@shared_task(name="bench.noop")
+def noop_task() -> int:
+    return 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a no-op task many times under each Celery profile, each in its "
+        "own process, and report tasks per second: run inline when eager, "
+        "else published to the broker (in memory unless --broker is given) "
+        "and executed as a worker would"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tasks", type=int, default=5000)
+        parser.add_argument(
+            "--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES)
+        )
+        parser.add_argument("--broker", default="memory://")
+        parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["run"]:
+            self.stdout.write(json.dumps(self.run(options)))
+            return
+
+        report = {}
+        for profile in options["profiles"]:
+            env = {
+                **os.environ,
+                "CELERY_BROKER_URL": options["broker"],
+                **PROFILES[profile],
+            }
+            if profile == "worker_results":
+                env["CELERY_TASK_TRACK_STARTED"] = "1"
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    sys.argv[0],
+                    "bench_celery",
+                    "--run",
+                    f"--tasks={options['tasks']}",
+                ],
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            report[profile] = json.loads(output.strip().splitlines()[-1])
+        self.stdout.write(json.dumps(report))
+
+    @staticmethod
+    def run(options) -> dict:
+        count = options["tasks"]
+        task = noop_task._get_current_object()
+        task.track_started = bool(os.getenv("CELERY_TASK_TRACK_STARTED"))
+        report = {
+            "broker": app.conf.broker_url.split("://")[0],
+            "result_backend": settings.CELERY_RESULT_BACKEND,
+            "tasks": count,
+        }
+
+        start = time.perf_counter()
+        for _ in range(count):
+            task.delay()
+        key = "tasks" if task.app.conf.task_always_eager else "published"
+        report[f"{key}_per_second"] = round(count / (time.perf_counter() - start))
+        if task.app.conf.task_always_eager:
+            return report
+
+        # What a worker process runs for each message: the task with
+        # its state and result bookkeeping.
+        start = time.perf_counter()
+        for _ in range(count):
+            trace_task(task, uuid(), (), {}, app=app)
+        report["executed_per_second"] = round(count / (time.perf_counter() - start))
+        return report
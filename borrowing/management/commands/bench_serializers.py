@@ -0,0 +1,124 @@
+import json
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from book.models import Book
+from book.serializers import BookSerializer
+from borrowing.models import Borrowing
+from borrowing.serializers import BorrowingSerializer
+from fieldsets import LeanSerializer
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare rows per second of the list serializers with LeanSerializer "
+        "over generated books and borrowings; every generated row is rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=20_000)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument(
+            "--fields",
+            nargs="+",
+            default=["book", "is_active"],
+            help="Borrowing fields of the sparse fieldset run",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        rows, repeat = options["rows"], options["repeat"]
+        with transaction.atomic():
+            self.generate(rng, rows)
+            books = Book.objects.order_by("id")[:rows]
+            borrowings = Borrowing.objects.select_related("book", "user").order_by(
+                "id"
+            )[:rows]
+            report = {
+                "rows": rows,
+                "book": self.compare(BookSerializer, books, repeat),
+                "borrowing": self.compare(BorrowingSerializer, borrowings, repeat),
+                "borrowing_fields": self.compare(
+                    BorrowingSerializer, borrowings, repeat, options["fields"]
+                ),
+            }
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report))
+
+    @staticmethod
+    def generate(rng, count: int) -> None:
+        user = get_user_model().objects.create(
+            email="bench-serializers@bench.invalid", password=make_password(None)
+        )
+        books = Book.objects.bulk_create(
+            (
+                Book(
+                    title=f"Book {number}",
+                    author=f"Author {number % 97}",
+                    cover=Book.CoverChoices.SOFT,
+                    inventory=rng.randint(0, 10),
+                    daily_fee="0.50",
+                )
+                for number in range(count)
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        today = date.today()
+        Borrowing.objects.bulk_create(
+            (
+                Borrowing(
+                    user=user,
+                    book=rng.choice(books),
+                    borrow_date=today,
+                    expected_return_date=today + timedelta(days=7),
+                    actual_return_date=today if rng.random() < 0.5 else None,
+                    penalty_for_delay="1.50",
+                )
+                for _ in range(count)
+            ),
+            batch_size=BATCH_SIZE,
+        )
+
+    @staticmethod
+    def timed(serialize, repeat: int) -> tuple:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = len(serialize())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return count, best
+
+    def compare(self, serializer_class, queryset, repeat: int, fields=None) -> dict:
+        serializer = serializer_class()
+        lean = LeanSerializer(serializer, fields)
+        field_names = set(lean.field_names)
+
+        def full() -> list:
+            data = serializer_class(queryset.all(), many=True).data
+            if fields:
+                data = [
+                    {name: value for name, value in item.items() if name in field_names}
+                    for item in data
+                ]
+            return data
+
+        count, full_seconds = self.timed(full, repeat)
+        _, lean_seconds = self.timed(
+            lambda: lean.to_representation(lean.values(queryset.all())), repeat
+        )
+        return {
+            "fields": list(lean.field_names),
+            "serializer_rows_per_second": round(count / full_seconds),
+            "lean_rows_per_second": round(count / lean_seconds),
+            "speedup": round(full_seconds / lean_seconds, 1),
+        }
@@ -0,0 +1,136 @@
+import json
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.models import Book
+from borrowing.management.commands.bench import summarize
+from borrowing.models import Borrowing, Payment, StripeEvent
+from borrowing.testing import FakeStripeClient, sign_event
+from borrowing.webhooks import StripeEventProcessor
+
+SECRET = "whsec_bench"
+
+
+class Command(BaseCommand):
+    help = (
+        "Post signed checkout.session events from FakeStripeClient to the "
+        "webhook endpoint, some of them twice, process them and report "
+        "the throughput of both; every generated row is rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=5000)
+        parser.add_argument(
+            "--duplicate-share",
+            type=float,
+            default=0.1,
+            help="Share of the events Stripe delivers a second time",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        count = options["events"]
+        FakeStripeClient.reset()
+        with override_settings(
+            ALLOWED_HOSTS=["testserver"], STRIPE_WEBHOOK_SECRET=SECRET
+        ), transaction.atomic():
+            session_ids = self.seed(count)
+            events = [
+                (
+                    FakeStripeClient.complete(session_id)
+                    if rng.random() < 0.9
+                    else FakeStripeClient.expire(session_id)
+                )
+                for session_id in session_ids
+            ]
+            events += rng.sample(events, int(count * options["duplicate_share"]))
+            rng.shuffle(events)
+            requests = [sign_event(event, SECRET) for event in events]
+
+            client = Client()
+            url = reverse("borrowing:payment-webhook")
+            results = []
+            start = time.perf_counter()
+            for payload, signature in requests:
+                with CaptureQueriesContext(connection) as queries:
+                    request_start = time.perf_counter()
+                    response = client.post(
+                        url,
+                        payload,
+                        content_type="application/json",
+                        HTTP_STRIPE_SIGNATURE=signature,
+                    )
+                results.append(
+                    (
+                        time.perf_counter() - request_start,
+                        response.status_code,
+                        len(queries),
+                    )
+                )
+            ingest = summarize(results, time.perf_counter() - start)
+            stored = StripeEvent.objects.count()
+
+            processed = StripeEventProcessor().drain()
+            processed["events_per_second"] = round(
+                processed["events"] / processed["duration"], 1
+            )
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            json.dumps(
+                {
+                    "vendor": connection.vendor,
+                    "posted": len(requests),
+                    "stored": stored,
+                    "ingest": ingest,
+                    "processing": processed,
+                }
+            )
+        )
+
+    @staticmethod
+    def seed(count: int) -> list:
+        """Pending payments with a checkout session each; their session ids"""
+        user = get_user_model().objects.create(
+            email="bench-webhook@bench.invalid", password=make_password(None)
+        )
+        book = Book.objects.create(
+            title="Bench", author="Bench", cover="Soft", inventory=1, daily_fee=1
+        )
+        today = date.today()
+        borrowings = Borrowing.objects.bulk_create(
+            Borrowing(
+                user=user,
+                book=book,
+                borrow_date=today - timedelta(days=3),
+                expected_return_date=today,
+                actual_return_date=today,
+            )
+            for _ in range(count)
+        )
+        client = FakeStripeClient()
+        sessions = [
+            client.create_checkout_session([("Bench", 300)], f"bench-{number}")
+            for number in range(count)
+        ]
+        Payment.objects.bulk_create(
+            Payment(
+                status=Payment.StatusChoices.PENDING,
+                borrowing=borrowing,
+                session_id=session.id,
+                session_url=session.url,
+                payment_amount=300,
+            )
+            for borrowing, session in zip(borrowings, sessions)
+        )
+        return [session.id for session in sessions]
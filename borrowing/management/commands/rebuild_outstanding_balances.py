@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from borrowing.models import OutstandingBalance
+
+
+class Command(BaseCommand):
+    help = "Recompute users' outstanding balances from pending payments"
+
+    def handle(self, *args, **options):
+        drifted = OutstandingBalance.objects.rebuild()
+        self.stdout.write(f"Rebuilt outstanding balances, {drifted} users had drifted")
@@ -0,0 +1,67 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from borrowing.models import StripeEvent
+from borrowing.session import get_stripe_client
+from borrowing.webhooks import (
+    SESSION_COMPLETED,
+    SESSION_EXPIRED,
+    StripeEventProcessor,
+    record_events,
+)
+
+PAGE_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = (
+        "Process the Stripe events stored since a time again, or with "
+        "--fetch, first store the events Stripe sent since then, such as "
+        "those missed while the webhook endpoint was down"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "since",
+            type=datetime.fromisoformat,
+            help="ISO date or time, ex. 2023-05-01T12:00",
+        )
+        parser.add_argument(
+            "--fetch",
+            action="store_true",
+            help="List the events from the Stripe API, skipping the stored ones",
+        )
+
+    def handle(self, *args, **options):
+        since = options["since"]
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        if options["fetch"]:
+            fetched = 0
+            page = []
+            for event in get_stripe_client().list_events(
+                [SESSION_COMPLETED, SESSION_EXPIRED], int(since.timestamp())
+            ):
+                page.append(event)
+                if len(page) == PAGE_SIZE:
+                    record_events(page)
+                    fetched += len(page)
+                    page = []
+            if page:
+                record_events(page)
+                fetched += len(page)
+            self.stdout.write(f"Fetched {fetched} events from Stripe")
+        else:
+            reset = StripeEvent.objects.filter(created_at__gte=since).update(
+                processed_at=None
+            )
+            self.stdout.write(f"Marked {reset} stored events for processing")
+
+        metrics = StripeEventProcessor().drain()
+        self.stdout.write(
+            f"Processed {metrics['events']} events: {metrics['paid']} payments "
+            f"paid, {metrics['expired']} sessions expired"
+        )
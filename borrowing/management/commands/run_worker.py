@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from library_service.celery import app
+
+
+def worker_argv(queue: str) -> list:
+    """Arguments of `celery worker` consuming one queue with its settings"""
+    options = settings.CELERY_WORKER_QUEUES[queue]
+    return [
+        "worker",
+        f"--queues={queue}",
+        f"--hostname={queue}@%h",
+        f"--concurrency={options['concurrency']}",
+        f"--prefetch-multiplier={options['prefetch_multiplier']}",
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Start a Celery worker for one queue, with the concurrency and "
+        "prefetch of CELERY_WORKER_QUEUES; other arguments go to the worker"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue", choices=sorted(settings.CELERY_WORKER_QUEUES))
+        parser.add_argument("worker_args", nargs="*", metavar="-- ARGS")
+
+    def handle(self, *args, **options):
+        app.worker_main(worker_argv(options["queue"]) + options["worker_args"])
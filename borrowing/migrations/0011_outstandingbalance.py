@@ -0,0 +1,49 @@
+# Generated by Django 4.0.4 on 2026-10-18 16:57
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def backfill_outstanding_balances(apps, schema_editor):
+    Payment = apps.get_model("borrowing", "Payment")
+    OutstandingBalance = apps.get_model("borrowing", "OutstandingBalance")
+    OutstandingBalance.objects.bulk_create(
+        OutstandingBalance(
+            user_id=row["borrowing__user_id"],
+            pending_payments=row["payments"],
+            pending_amount=row["amount"],
+        )
+        for row in Payment.objects.filter(status="Pending")
+        .values("borrowing__user_id")
+        .annotate(payments=Count("id"), amount=Sum("payment_amount"))
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("user", "0001_initial"),
+        ("borrowing", "0010_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutstandingBalance",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="outstanding_balance",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("pending_payments", models.IntegerField(default=0)),
+                ("pending_amount", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_outstanding_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:02
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_created_at(apps, schema_editor):
+    """Payments are created when their borrowing is returned"""
+    Payment = apps.get_model("borrowing", "Payment")
+    return_dates = (
+        Payment.objects.values_list("borrowing__actual_return_date", flat=True)
+        .exclude(borrowing__actual_return_date=None)
+        .distinct()
+    )
+    for return_date in list(return_dates):
+        Payment.objects.filter(borrowing__actual_return_date=return_date).update(
+            created_at=timezone.make_aware(
+                datetime.datetime.combine(return_date, datetime.time())
+            )
+        )
+    Payment.objects.filter(created_at=None).update(created_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("borrowing", "0012_stripeevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="created_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="payment",
+            name="created_at",
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("Pending", "Pending"),
+                    ("Paid", "Paid"),
+                    ("Expired", "Expired"),
+                ],
+                max_length=63,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["status", "created_at"], name="payment_status_created_idx"
+            ),
+        ),
+    ]
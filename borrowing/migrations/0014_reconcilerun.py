@@ -0,0 +1,34 @@
+# Generated by Django 4.0.4 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrowing", "0013_payment_created_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReconcileRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("payments", models.IntegerField(default=0)),
+                ("sessions", models.IntegerField(default=0)),
+                ("paid", models.IntegerField(default=0)),
+                ("errors", models.IntegerField(default=0)),
+                ("oldest_pending_days", models.IntegerField(default=0)),
+                ("duration", models.FloatField(default=0)),
+                ("finished_at", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -1,12 +1,74 @@
 import datetime
+from collections import defaultdict
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Func, IntegerField, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest, Round
+from django.utils import timezone
 
 
 def tomorrow_date():
     return datetime.date.today() + datetime.timedelta(days=1)
 
 
+class DaysBetween(Func):
+    """Whole days from the first date expression to the second one"""
+
+    arity = 2
+    output_field = IntegerField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        start, end = self.get_source_expressions()
+        return Func(end, start, arg_joiner=" - ", template="(%(expressions)s)").as_sql(
+            compiler, connection, **extra_context
+        )
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        start, end = self.get_source_expressions()
+        return Func(
+            end,
+            start,
+            arg_joiner=") - julianday(",
+            template="CAST(julianday(%(expressions)s) AS INTEGER)",
+        ).as_sql(compiler, connection, **extra_context)
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        start, end = self.get_source_expressions()
+        return Func(end, start, function="DATEDIFF").as_sql(
+            compiler, connection, **extra_context
+        )
+
+
+def in_hundredths(expression):
+    """Turn a two-decimal amount into an exact integer number of hundredths"""
+    return Cast(Round(expression * Value(100)), IntegerField())
+
+
+class BorrowingQuerySet(models.QuerySet):
+    def with_amounts(self, on_date: datetime.date = None):
+        """
+        Annotate rental_amount, penalty_amount and total_amount in cents,
+        for borrowings returned on their actual_return_date or, if still
+        active, on `on_date` (today by default).
+        Everything is computed in integers, so SQLite's float decimals
+        give the same result as Borrowing.total_amount.
+        """
+        on_date = on_date or datetime.date.today()
+        return_date = Coalesce(
+            F("actual_return_date"), Value(on_date, output_field=models.DateField())
+        )
+        fee = in_hundredths(F("book__daily_fee"))
+        penalty_rate = in_hundredths(Coalesce(F("penalty_for_delay"), Value(0)))
+        overdue_days = Greatest(
+            DaysBetween(F("expected_return_date"), return_date), Value(0)
+        )
+        return self.annotate(
+            rental_amount=DaysBetween(F("borrow_date"), return_date) * fee,
+            penalty_amount=overdue_days * fee * penalty_rate / Value(100),
+            total_amount=F("rental_amount") + F("penalty_amount"),
+        )
+
+
 class Borrowing(models.Model):
     borrow_date = models.DateField(auto_now_add=True)
     expected_return_date = models.DateField()
@@ -21,50 +83,294 @@ class Borrowing(models.Model):
         max_digits=5, decimal_places=2, null=True, blank=True
     )
 
+    objects = BorrowingQuerySet.as_manager()
+
+    # Set when the row is loaded through BorrowingQuerySet.with_amounts().
+    _total_amount = None
+
     @property
     def is_active(self) -> bool:
         return self.actual_return_date is None
 
     @property
     def total_amount(self) -> int:
-        self.actual_return_date = datetime.date.today()
-        total_amount = (
-            100
-            * (self.actual_return_date - self.borrow_date).days
-            * self.book.daily_fee
-        )
-        if self.actual_return_date is not None and self.expected_return_date:
-            if self.actual_return_date > self.expected_return_date:
-                penalty_amount = 100 * (
-                    (self.actual_return_date - self.expected_return_date).days
-                    * self.book.daily_fee
-                    * self.penalty_for_delay
-                )
-                total_amount += penalty_amount
+        """
+        Amount in cents; uses the value annotated by
+        BorrowingQuerySet.with_amounts() when there is one
+        """
+        if self._total_amount is not None:
+            return self._total_amount
+        return_date = self.actual_return_date or datetime.date.today()
+        total_amount = 100 * (return_date - self.borrow_date).days * self.book.daily_fee
+        if return_date > self.expected_return_date:
+            penalty_amount = 100 * (
+                (return_date - self.expected_return_date).days
+                * self.book.daily_fee
+                * (self.penalty_for_delay or 0)
+            )
+            total_amount += penalty_amount
         return int(total_amount)
 
+    @total_amount.setter
+    def total_amount(self, value: int) -> None:
+        self._total_amount = value
+
     class Meta:
         ordering = [
             "user",
             "borrow_date",
         ]
+        indexes = [
+            models.Index(
+                fields=["borrow_date", "id"], name="borrowing_borrow_date_id_idx"
+            ),
+            models.Index(
+                fields=["user", "borrow_date", "id"],
+                name="borrowing_user_date_idx",
+            ),
+            models.Index(
+                fields=["user", "borrow_date", "id"],
+                name="borrowing_user_active_idx",
+                condition=models.Q(actual_return_date__isnull=True),
+            ),
+            models.Index(
+                fields=["expected_return_date"],
+                name="borrowing_active_due_idx",
+                condition=models.Q(actual_return_date__isnull=True),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.book}, {self.borrow_date}({self.id})"
 
 
+class PaymentQuerySet(models.QuerySet):
+    def settle(self, status: str) -> list:
+        """
+        Move the pending payments of this queryset to `status` and take
+        them off their users' outstanding balances.
+        Return the ids of the payments changed.
+        """
+        with transaction.atomic():
+            settled = list(
+                self.select_for_update(of=("self",))
+                .filter(status=Payment.StatusChoices.PENDING)
+                .values_list("id", "borrowing__user_id", "payment_amount")
+            )
+            Payment.objects.filter(
+                id__in=[payment_id for payment_id, _, _ in settled]
+            ).update(status=status)
+            OutstandingBalance.objects.adjust(
+                [(user_id, -1, -amount) for _, user_id, amount in settled]
+            )
+        return [payment_id for payment_id, _, _ in settled]
+
+    def mark_paid(self) -> list:
+        return self.settle(Payment.StatusChoices.PAID)
+
+    def mark_expired(self) -> list:
+        return self.settle(Payment.StatusChoices.EXPIRED)
+
+
 class Payment(models.Model):
     class StatusChoices(models.TextChoices):
         PENDING = ("Pending",)
         PAID = "Paid"
+        EXPIRED = "Expired"
 
     status = models.CharField(max_length=63, choices=StatusChoices.choices)
     borrowing = models.ForeignKey(
         Borrowing, on_delete=models.CASCADE, related_name="payments"
     )
     session_url = models.URLField(max_length=250, null=True, blank=True)
-    session_id = models.CharField(max_length=10, null=True, blank=True)
+    session_id = models.CharField(max_length=255, null=True, blank=True)
     payment_amount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = PaymentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["session_id"], name="payment_session_id_idx"),
+            models.Index(fields=["status", "borrowing"], name="payment_status_idx"),
+            models.Index(
+                fields=["status", "created_at"], name="payment_status_created_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"Payment #{self.id}: {self.status},borrowing {self.borrowing_id}"
+
+
+class OutstandingBalanceQuerySet(models.QuerySet):
+    def adjust(self, changes: list) -> None:
+        """
+        Apply (user_id, payments delta, amount delta) changes
+        with one INSERT for new users and one UPDATE
+        """
+        deltas = defaultdict(lambda: [0, 0])
+        for user_id, payments, amount in changes:
+            deltas[user_id][0] += payments
+            deltas[user_id][1] += amount
+        if not deltas:
+            return
+        self.bulk_create(
+            [OutstandingBalance(user_id=user_id) for user_id in deltas],
+            ignore_conflicts=True,
+        )
+        self.filter(user_id__in=deltas).update(
+            pending_payments=F("pending_payments")
+            + Case(
+                *(
+                    When(user_id=user_id, then=Value(payments))
+                    for user_id, (payments, _) in deltas.items()
+                ),
+                output_field=models.IntegerField(),
+            ),
+            pending_amount=F("pending_amount")
+            + Case(
+                *(
+                    When(user_id=user_id, then=Value(amount))
+                    for user_id, (_, amount) in deltas.items()
+                ),
+                output_field=models.BigIntegerField(),
+            ),
+        )
+
+    def rebuild(self, user_ids: list = None) -> int:
+        """
+        Recompute the balances of the given users, or of every user,
+        from the Payment table. Return how many users had a drifted balance.
+        """
+        pending = Payment.objects.filter(status=Payment.StatusChoices.PENDING)
+        balances = self
+        if user_ids is not None:
+            pending = pending.filter(borrowing__user_id__in=user_ids)
+            balances = self.filter(user_id__in=user_ids)
+        expected = {
+            user_id: (payments, amount)
+            for user_id, payments, amount in pending.values("borrowing__user_id")
+            .annotate(payments=Count("id"), amount=Sum("payment_amount"))
+            .values_list("borrowing__user_id", "payments", "amount")
+        }
+        with transaction.atomic():
+            current = {
+                user_id: (payments, amount)
+                for user_id, payments, amount in balances.select_for_update()
+                .values_list("user_id", "pending_payments", "pending_amount")
+            }
+            drifted = {
+                user_id
+                for user_id in expected.keys() | current.keys()
+                if expected.get(user_id, (0, 0)) != current.get(user_id, (0, 0))
+            }
+            self.filter(user_id__in=drifted).delete()
+            self.bulk_create(
+                OutstandingBalance(
+                    user_id=user_id,
+                    pending_payments=expected.get(user_id, (0, 0))[0],
+                    pending_amount=expected.get(user_id, (0, 0))[1],
+                )
+                for user_id in drifted
+            )
+        return len(drifted)
+
+    def has_pending(self, user_id: int) -> bool:
+        return self.filter(user_id=user_id, pending_payments__gt=0).exists()
+
+
+class OutstandingBalance(models.Model):
+    """
+    Pending payments per user, kept in step with Payment so the borrow
+    gate is a primary-key lookup; rebuilt by rebuild_outstanding_balances
+    """
+
+    user = models.OneToOneField(
+        "user.User",
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="outstanding_balance",
+    )
+    pending_payments = models.IntegerField(default=0)
+    pending_amount = models.BigIntegerField(default=0)
+
+    objects = OutstandingBalanceQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.user_id}: {self.pending_payments} pending payments"
+
+
+class Notification(models.Model):
+    """Outbox row for a Telegram message, drained by send_notifications_task"""
+
+    class StatusChoices(models.TextChoices):
+        PENDING = "Pending"
+        SENT = "Sent"
+        FAILED = "Failed"
+
+    chat_id = models.CharField(max_length=63)
+    text = models.TextField()
+    status = models.CharField(
+        max_length=63, choices=StatusChoices.choices, default=StatusChoices.PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at", "id"],
+                name="notification_due_idx",
+                condition=models.Q(status="Pending"),
+            ),
+        ]
+
+    def __str__(self):
+        return f"Notification #{self.id}: {self.status}, chat {self.chat_id}"
+
+
+class StripeEvent(models.Model):
+    """
+    Stripe webhook event, stored once per event id and applied
+    to its payments by process_stripe_events_task
+    """
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    session_id = models.CharField(max_length=255, null=True, blank=True)
+    payment_status = models.CharField(max_length=63, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["id"],
+                name="stripe_event_pending_idx",
+                condition=models.Q(processed_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"Stripe event {self.event_id}: {self.type}"
+
+
+class ReconcileRun(models.Model):
+    """
+    Counts of the last PaymentReconciler run, in one row, which
+    every web process reads for /metrics/
+    """
+
+    payments = models.IntegerField(default=0)
+    sessions = models.IntegerField(default=0)
+    paid = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    oldest_pending_days = models.IntegerField(default=0)
+    duration = models.FloatField(default=0)
+    finished_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Reconciliation finished at {self.finished_at}"
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from borrowing.models import Notification
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this.
+MESSAGE_LIMIT = 4096
+MESSAGE_SEPARATOR = "\n\n"
+# A claimed row is retried by another drain if its sender
+# has not finished within this time.
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+class NotificationRetryAfter(Exception):
+    """Raised by a transport when the API asks to slow down"""
+
+    def __init__(self, seconds: float):
+        super().__init__(f"Retry after {seconds} seconds")
+        self.seconds = seconds
+
+
+class TelegramTransport:
+    def __init__(self):
+        from aiogram import Bot
+
+        self.bot = Bot(settings.BOT_TOKEN)
+
+    async def send(self, chat_id: str, text: str) -> None:
+        from aiogram.utils.exceptions import RetryAfter
+
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as error:
+            raise NotificationRetryAfter(error.timeout)
+
+    async def close(self) -> None:
+        session = await self.bot.get_session()
+        await session.close()
+
+
+def get_transport():
+    return import_string(settings.TELEGRAM_TRANSPORT)()
+
+
+def notify(text: str, chat_id: str = None):
+    """
+    Write a notification to the outbox as part of the current transaction;
+    it is sent by send_notifications_task once the transaction commits.
+    Return None when no chat is configured.
+    """
+    notifications = notify_many([text], chat_id)
+    return notifications[0] if notifications else None
+
+
+def notify_many(texts: list, chat_id: str = None) -> list:
+    """
+    Write several notifications with one INSERT and one drain task;
+    write none, with a warning, when neither chat_id nor CHAT_ID is set
+    """
+    from borrowing.tasks import send_notifications_task
+
+    chat_id = chat_id or settings.CHAT_ID
+    if not chat_id:
+        logger.warning("CHAT_ID is not set, dropping %d notifications", len(texts))
+        return []
+    notifications = Notification.objects.bulk_create(
+        Notification(chat_id=chat_id, text=text) for text in texts
+    )
+    transaction.on_commit(
+        lambda: send_notifications_task.apply_async(
+            countdown=settings.TELEGRAM_COALESCE_SECONDS
+        )
+    )
+    return notifications
+
+
+def split_message(texts: list, limit: int = MESSAGE_LIMIT) -> list:
+    """Join texts into as few messages as fit in the Telegram length limit"""
+    return [message for message, _ in pack_messages(texts, limit)]
+
+
+def pack_messages(texts: list, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    The messages of split_message, each paired with how many of the
+    texts have been sent in full once it and those before it are sent
+    """
+    messages = []
+    current = ""
+    for done, text in enumerate(texts):
+        for start in range(0, max(len(text), 1), limit):
+            part = text[start:start + limit]
+            if current and len(current) + len(MESSAGE_SEPARATOR) + len(part) > limit:
+                messages.append((current, done))
+                current = ""
+            current = f"{current}{MESSAGE_SEPARATOR}{part}" if current else part
+    if current:
+        messages.append((current, len(texts)))
+    return messages
+
+
+class RateLimiter:
+    """Space out calls so no more than `rate` start per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class NotificationDispatcher:
+    def __init__(self, transport=None):
+        self.transport = transport or get_transport()
+        self.max_concurrency = settings.TELEGRAM_MAX_CONCURRENCY
+        self.messages_per_second = settings.TELEGRAM_MESSAGES_PER_SECOND
+        self.max_attempts = settings.TELEGRAM_MAX_ATTEMPTS
+        self.batch_size = settings.TELEGRAM_BATCH_SIZE
+
+    def drain(self) -> dict:
+        """
+        Send every due notification, one coalesced message per chat.
+        When a chat fails part way, the notifications already sent in
+        full are marked sent and only the rest are retried.
+        """
+        notifications = self.claim()
+        by_chat = defaultdict(list)
+        for notification in notifications:
+            by_chat[notification.chat_id].append(notification)
+
+        results = asyncio.run(self.send_all(by_chat)) if by_chat else {}
+
+        now = timezone.now()
+        sent_ids = []
+        for chat_id, (sent, error) in results.items():
+            ids = [notification.id for notification in by_chat[chat_id]]
+            sent_ids += ids[:sent]
+            if error is not None:
+                self.reschedule(ids[sent:], error, now)
+        Notification.objects.filter(id__in=sent_ids).update(
+            status=Notification.StatusChoices.SENT, sent_at=now
+        )
+        return {
+            "claimed": len(notifications),
+            "sent": len(sent_ids),
+            "chats": len(by_chat),
+            "failed_chats": sum(error is not None for _, error in results.values()),
+        }
+
+    def claim(self) -> list:
+        now = timezone.now()
+        with transaction.atomic():
+            notifications = list(
+                Notification.objects.select_for_update(skip_locked=True)
+                .filter(
+                    status=Notification.StatusChoices.PENDING,
+                    next_attempt_at__lte=now,
+                )
+                .order_by("next_attempt_at", "id")[: self.batch_size]
+            )
+            Notification.objects.filter(
+                id__in=[notification.id for notification in notifications]
+            ).update(next_attempt_at=now + CLAIM_LEASE)
+        notifications.sort(key=lambda notification: notification.id)
+        return notifications
+
+    def reschedule(self, ids: list, error: Exception, now) -> None:
+        if isinstance(error, NotificationRetryAfter):
+            Notification.objects.filter(id__in=ids).update(
+                next_attempt_at=now + timedelta(seconds=error.seconds),
+                last_error=str(error),
+            )
+            return
+        failed = Notification.objects.filter(id__in=ids)
+        attempts = max(failed.values_list("attempts", flat=True)) + 1
+        failed.update(
+            attempts=F("attempts") + 1,
+            next_attempt_at=now + timedelta(seconds=2**attempts),
+            last_error=repr(error),
+        )
+        failed.filter(attempts__gte=self.max_attempts).update(
+            status=Notification.StatusChoices.FAILED
+        )
+
+    async def send_all(self, by_chat: dict) -> dict:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        limiter = RateLimiter(self.messages_per_second)
+
+        async def send_chat(chat_id, notifications):
+            """(chat_id, (notifications sent in full, error or None))"""
+            messages = pack_messages(
+                [notification.text for notification in notifications]
+            )
+            sent = 0
+            async with semaphore:
+                try:
+                    for message, done in messages:
+                        await limiter.wait()
+                        await self.transport.send(chat_id, message)
+                        sent = done
+                except Exception as error:
+                    return chat_id, (sent, error)
+            return chat_id, (sent, None)
+
+        try:
+            results = await asyncio.gather(
+                *(send_chat(chat_id, rows) for chat_id, rows in by_chat.items())
+            )
+        finally:
+            close = getattr(self.transport, "close", None)
+            if close is not None:
+                await close()
+        return dict(results)
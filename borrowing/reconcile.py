@@ -0,0 +1,114 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+from django.conf import settings
+from django.utils import timezone
+
+from borrowing.models import Payment, ReconcileRun
+from borrowing.session import get_stripe_client
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentReconciler:
+    """
+    Settle the pending payments whose checkout sessions were paid,
+    for customers who never came back through the success redirect.
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_stripe_client()
+        self.batch_size = settings.STRIPE_RECONCILE_BATCH_SIZE
+        self.max_concurrency = settings.STRIPE_RECONCILE_CONCURRENCY
+
+    def run(self) -> dict:
+        """Check every pending payment's session, one chunk at a time"""
+        started = time.perf_counter()
+        metrics = {"payments": 0, "sessions": 0, "paid": 0, "errors": 0}
+        last_id = 0
+        with ThreadPoolExecutor(self.max_concurrency) as pool:
+            while True:
+                chunk = list(
+                    Payment.objects.filter(
+                        status=Payment.StatusChoices.PENDING,
+                        session_id__isnull=False,
+                        id__gt=last_id,
+                    )
+                    .order_by("id")
+                    .values_list("id", "session_id")[: self.batch_size]
+                )
+                if not chunk:
+                    break
+                last_id = chunk[-1][0]
+                session_ids = list(dict.fromkeys(session_id for _, session_id in chunk))
+                statuses = dict(
+                    zip(session_ids, pool.map(self.payment_status, session_ids))
+                )
+                paid = [
+                    session_id
+                    for session_id, status in statuses.items()
+                    if status == "paid"
+                ]
+                if paid:
+                    metrics["paid"] += len(
+                        Payment.objects.filter(session_id__in=paid).mark_paid()
+                    )
+                metrics["payments"] += len(chunk)
+                metrics["sessions"] += len(session_ids)
+                metrics["errors"] += sum(status is None for status in statuses.values())
+
+        oldest = (
+            Payment.objects.filter(status=Payment.StatusChoices.PENDING)
+            .order_by("created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        )
+        metrics["oldest_pending_days"] = (timezone.now() - oldest).days if oldest else 0
+        metrics["duration"] = round(time.perf_counter() - started, 4)
+        # Kept in the database, as the worker and the web processes may
+        # not share a cache.
+        ReconcileRun.objects.update_or_create(
+            pk=1, defaults={**metrics, "finished_at": timezone.now()}
+        )
+        return metrics
+
+    def payment_status(self, session_id: str):
+        """The session's payment_status, or None when Stripe failed"""
+        try:
+            return self.client.retrieve_checkout_session(session_id).payment_status
+        except stripe.error.StripeError as error:
+            logger.warning("Could not retrieve session %s: %r", session_id, error)
+            return None
+
+
+def collect() -> list:
+    """Prometheus lines of the last reconciliation, for instrumentation.registry"""
+    metrics = ReconcileRun.objects.filter(pk=1).values().first()
+    if metrics is None:
+        return []
+    lines = [
+        "# HELP library_payment_reconcile Counts of the last payment "
+        "reconciliation run.",
+        "# TYPE library_payment_reconcile gauge",
+    ]
+    for name in ("payments", "sessions", "paid", "errors"):
+        lines.append(f'library_payment_reconcile{{count="{name}"}} {metrics[name]}')
+    lines += [
+        "# HELP library_payment_reconcile_oldest_pending_days Days since the "
+        "oldest pending payment was created.",
+        "# TYPE library_payment_reconcile_oldest_pending_days gauge",
+        f"library_payment_reconcile_oldest_pending_days "
+        f"{metrics['oldest_pending_days']}",
+        "# HELP library_payment_reconcile_duration_seconds Duration of the "
+        "last run.",
+        "# TYPE library_payment_reconcile_duration_seconds gauge",
+        f"library_payment_reconcile_duration_seconds {metrics['duration']}",
+        "# HELP library_payment_reconcile_finished_timestamp_seconds When "
+        "the last run finished.",
+        "# TYPE library_payment_reconcile_finished_timestamp_seconds gauge",
+        "library_payment_reconcile_finished_timestamp_seconds "
+        f"{metrics['finished_at'].timestamp():.0f}",
+    ]
+    return lines
@@ -1,13 +1,26 @@
 import datetime
+from collections import Counter
 
+from django.conf import settings
 from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, Q
 from rest_framework import serializers
 
-from borrowing.bot import send_telegram_notification
-from borrowing.models import Borrowing, Payment
+from book.models import Book, BookStats
+from borrowing.models import Borrowing, OutstandingBalance, Payment
+from borrowing.notifications import notify
+from borrowing.session import CreateSession
+from borrowing.tasks import create_payment_session_task
 from user.serializers import UserBorrowingSerializer
 
 
+def validate_no_pending_payments(user) -> None:
+    if OutstandingBalance.objects.has_pending(user.id):
+        raise serializers.ValidationError(
+            "Sorry, firstly you have to performed your existed payments"
+        )
+
+
 class BorrowingSerializer(serializers.ModelSerializer):
     is_active = serializers.SerializerMethodField(read_only=True)
     book = serializers.SlugRelatedField(slug_field="title", read_only=True)
@@ -23,6 +36,13 @@ class BorrowingSerializer(serializers.ModelSerializer):
             "is_active",
             "penalty_for_delay",
         )
+        # values() sources of the fields LeanSerializer cannot read directly.
+        value_sources = {
+            "book": "book__title",
+            "is_active": ExpressionWrapper(
+                Q(actual_return_date=None), output_field=BooleanField()
+            ),
+        }
 
     def get_is_active(self, obj):
         return obj.is_active
@@ -68,35 +88,167 @@ class BorrowingCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Book is not available for borrowing.")
         return book
 
-    def validate_user(self, user):
-        user = self.context["request"].user
-        payments = Payment.objects.filter(borrowing__user=user, status="Pending")
-        if payments > 0:
-            raise serializers.ValidationError(
-                "Sorry, firstly you have to performed your existed payments"
-            )
-        return user
-
     def validate(self, attrs):
+        validate_no_pending_payments(self.context["request"].user)
         if datetime.date.today() >= attrs["expected_return_date"]:
             raise serializers.ValidationError("Change expected_return_date")
         return attrs
 
     @transaction.atomic
     def create(self, validated_data) -> Borrowing:
+        book = validated_data["book"]
+        if not Book.objects.reserve(book.id):
+            raise serializers.ValidationError(
+                {"book": ["Book is not available for borrowing."]}
+            )
+        BookStats.objects.record_loans({book.id: 1})
         borrowing = Borrowing.objects.create(**validated_data)
-        book = self.validated_data["book"]
-        book.inventory -= 1
-        book.save()
         message = (
             f"New borrowing: {book.title}, "
             f"borrow_date: {borrowing.borrow_date}"
             f"expected_return_date: {borrowing.expected_return_date}"
         )
-        send_telegram_notification(message)
+        notify(message)
         return borrowing
 
 
+class BorrowingBulkItemSerializer(serializers.Serializer):
+    book = serializers.IntegerField(min_value=1)
+    expected_return_date = serializers.DateField()
+    penalty_for_delay = serializers.DecimalField(
+        max_digits=5, decimal_places=2, required=False, allow_null=True
+    )
+
+    def validate(self, attrs):
+        if datetime.date.today() >= attrs["expected_return_date"]:
+            raise serializers.ValidationError("Change expected_return_date")
+        return attrs
+
+
+class BorrowingBulkCreateSerializer(serializers.Serializer):
+    borrowings = serializers.ListField(
+        child=serializers.DictField(),
+        allow_empty=False,
+        max_length=settings.BULK_BORROWING_MAX_ITEMS,
+    )
+    allow_partial = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        validate_no_pending_payments(self.context["request"].user)
+        items = {}
+        errors = {}
+        for index, item in enumerate(attrs["borrowings"]):
+            item_serializer = BorrowingBulkItemSerializer(data=item)
+            if item_serializer.is_valid():
+                items[index] = item_serializer.validated_data
+            else:
+                errors[index] = item_serializer.errors
+
+        books = Book.objects.in_bulk({item["book"] for item in items.values()})
+        copies_left = {book_id: book.inventory for book_id, book in books.items()}
+        for index, item in list(items.items()):
+            if item["book"] not in books:
+                errors[index] = {"book": ["Book does not exist."]}
+            elif copies_left[item["book"]] == 0:
+                errors[index] = {"book": ["Book is not available for borrowing."]}
+            else:
+                copies_left[item["book"]] -= 1
+                continue
+            del items[index]
+
+        if not items or (errors and not attrs["allow_partial"]):
+            raise serializers.ValidationError({"borrowings": errors})
+        attrs["items"] = items
+        attrs["books"] = books
+        attrs["errors"] = errors
+        return attrs
+
+    @transaction.atomic
+    def create(self, validated_data) -> dict:
+        items = validated_data["items"].values()
+        books = validated_data["books"]
+        counts = Counter(item["book"] for item in items)
+        if not Book.objects.reserve_many(counts):
+            raise serializers.ValidationError(
+                {"borrowings": "Books were borrowed meanwhile, try again."}
+            )
+        BookStats.objects.record_loans(counts)
+        borrowings = Borrowing.objects.bulk_create(
+            Borrowing(
+                user=self.context["request"].user,
+                book=books[item["book"]],
+                expected_return_date=item["expected_return_date"],
+                penalty_for_delay=item.get("penalty_for_delay"),
+            )
+            for item in items
+        )
+        notify(
+            "New borrowings:\n"
+            + "\n".join(
+                f"{borrowing.book.title}, "
+                f"expected_return_date: {borrowing.expected_return_date}"
+                for borrowing in borrowings
+            )
+        )
+        return {"created": borrowings, "errors": validated_data["errors"]}
+
+
+class BorrowingBulkReturnSerializer(serializers.Serializer):
+    borrowings = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_BORROWING_MAX_ITEMS,
+    )
+    allow_partial = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        borrowing_ids = list(dict.fromkeys(attrs["borrowings"]))
+        found = {
+            borrowing_id: (actual_return_date, book_id)
+            for borrowing_id, actual_return_date, book_id in Borrowing.objects.filter(
+                pk__in=borrowing_ids
+            ).values_list("id", "actual_return_date", "book_id")
+        }
+        errors = {}
+        for borrowing_id in borrowing_ids:
+            if borrowing_id not in found:
+                errors[borrowing_id] = "Borrowing does not exist."
+            elif found[borrowing_id][0] is not None:
+                errors[borrowing_id] = "This borrowing is closed already"
+
+        returned = [
+            borrowing_id for borrowing_id in borrowing_ids if borrowing_id not in errors
+        ]
+        if not returned or (errors and not attrs["allow_partial"]):
+            raise serializers.ValidationError({"borrowings": errors})
+        attrs["returned"] = returned
+        attrs["book_ids"] = [found[borrowing_id][1] for borrowing_id in returned]
+        attrs["errors"] = errors
+        return attrs
+
+    @transaction.atomic
+    def create(self, validated_data) -> dict:
+        returned = validated_data["returned"]
+        closed = Borrowing.objects.filter(
+            pk__in=returned, actual_return_date=None
+        ).update(actual_return_date=datetime.date.today())
+        if closed != len(returned):
+            raise serializers.ValidationError(
+                {"borrowings": "Borrowings were returned meanwhile, try again."}
+            )
+        Book.objects.release_many(Counter(validated_data["book_ids"]))
+        payments = CreateSession.create_payments(returned)
+        payment_ids = [payment.id for payment in payments]
+        transaction.on_commit(
+            lambda: create_payment_session_task.delay(*payment_ids)
+        )
+        return {
+            "returned": returned,
+            "payments": payment_ids,
+            "errors": validated_data["errors"],
+        }
+
+
 class BorrowingReturnSerializer(serializers.ModelSerializer):
     class Meta:
         model = Borrowing
@@ -108,3 +260,19 @@ class PaymentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = "__all__"
+
+
+class ExportFilterSerializer(serializers.Serializer):
+    """Query parameters of the staff exports"""
+
+    output = serializers.ChoiceField(choices=("ndjson", "csv"), default="ndjson")
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        if attrs.get("date_from") and attrs.get("date_to"):
+            if attrs["date_from"] > attrs["date_to"]:
+                raise serializers.ValidationError(
+                    {"date_to": "date_to must not be before date_from"}
+                )
+        return attrs
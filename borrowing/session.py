@@ -1,45 +1,186 @@
-import os
+from datetime import datetime, timedelta
+from hashlib import sha1
+from itertools import groupby
+from operator import itemgetter
 
 import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from borrowing.models import Borrowing, Payment
-from library_service import settings
-from dotenv import load_dotenv
+from book.models import BookStats
+from borrowing.models import Borrowing, OutstandingBalance, Payment
 
-load_dotenv()
-STRIPE_SECRET_KEY = os.environ.get("STRIPE_SECRET_KEY")
 HOST = "http://127.0.0.1:8000"
-SECRET_API_KEY = settings.STRIPE_SECRET_KEY
+# Stripe accepts checkout sessions expiring 30 minutes to 24 hours on.
+SESSION_MIN_LIFETIME = timedelta(minutes=31)
+SESSION_MAX_LIFETIME = timedelta(hours=24)
 
 
-class CreateSession:
-    @staticmethod
-    def create_session(borrowing: Borrowing) -> None:
-        stripe.api_key = STRIPE_SECRET_KEY
-        session = stripe.checkout.Session.create(
+class StripeClient:
+    def __init__(self):
+        self.api_key = settings.STRIPE_SECRET_KEY
+
+    def create_checkout_session(
+        self, line_items: list, idempotency_key: str, expires_at: datetime = None
+    ):
+        """`line_items` is a list of (product name, amount in cents)"""
+        return stripe.checkout.Session.create(
+            api_key=self.api_key,
+            idempotency_key=idempotency_key,
+            expires_at=int(expires_at.timestamp()) if expires_at else None,
             line_items=[
                 {
                     "price_data": {
                         "currency": "usd",
                         "product_data": {
-                            "name": borrowing.book.title,
+                            "name": name,
                         },
-                        "unit_amount": borrowing.total_amount,
+                        "unit_amount": unit_amount,
                     },
                     "quantity": 1,
                 }
+                for name, unit_amount in line_items
             ],
             mode="payment",
-            success_url=HOST + "/api/payments/success?session_id={CHECKOUT_SESSION_ID}",
-            cancel_url=HOST + "/api/payments/cancel/?session_id={CHECKOUT_SESSION_ID}",
-        )
-        payment = Payment.objects.create(
-            status="IN_PROCESS",
-            borrowing=borrowing,
-            session_id=session.id,
-            session_url=session.url,
-            payment_amount=borrowing.total_amount,
-        )
-        payment.session_url = session.url
-        payment.session_id = session.id
-        payment.save()
+            success_url=HOST
+            + "/api/borrowing/payments/success/?session_id={CHECKOUT_SESSION_ID}",
+            cancel_url=HOST + "/api/borrowing/payments/cancel/",
+        )
+
+    def retrieve_checkout_session(self, session_id: str):
+        return stripe.checkout.Session.retrieve(session_id, api_key=self.api_key)
+
+    def list_events(self, types: list, created_after: int):
+        """Iterate over the events of `types` created since the timestamp"""
+        return stripe.Event.list(
+            api_key=self.api_key,
+            types=types,
+            created={"gte": created_after},
+            limit=100,
+        ).auto_paging_iter()
+
+
+def get_stripe_client():
+    return import_string(settings.STRIPE_CLIENT)()
+
+
+class CreateSession:
+    @staticmethod
+    def create_payment(borrowing: Borrowing) -> Payment:
+        """
+        Record a pending payment; the checkout session is
+        created later by borrowing.tasks.create_payment_session_task
+        """
+        return CreateSession.create_payments([borrowing.pk])[0]
+
+    @staticmethod
+    def create_payments(borrowing_ids: list) -> list:
+        """
+        Record pending payments for several returned borrowings with one
+        INSERT, and add them to their users' outstanding balances and
+        their books' stats
+        """
+        amounts = list(
+            Borrowing.objects.with_amounts()
+            .filter(pk__in=borrowing_ids)
+            .order_by("id")
+            .values_list(
+                "id", "user_id", "total_amount", "book_id", "expected_return_date"
+            )
+        )
+        payments = Payment.objects.bulk_create(
+            Payment(
+                status=Payment.StatusChoices.PENDING,
+                borrowing_id=borrowing_id,
+                payment_amount=amount,
+            )
+            for borrowing_id, _, amount, _, _ in amounts
+        )
+        OutstandingBalance.objects.adjust(
+            [(user_id, 1, amount) for _, user_id, amount, _, _ in amounts]
+        )
+        BookStats.objects.record_returns(
+            [(book_id, due, amount) for _, _, amount, book_id, due in amounts]
+        )
+        return payments
+
+    @staticmethod
+    def regenerate_payments(payment_ids: list) -> list:
+        """
+        Record new pending payments for the borrowings of expired
+        payments, add them to the outstanding balances and queue one
+        checkout session per user once the transaction commits
+        """
+        from borrowing.tasks import create_payment_session_task
+
+        expired = list(
+            Payment.objects.filter(
+                pk__in=payment_ids, status=Payment.StatusChoices.EXPIRED
+            )
+            .order_by("borrowing__user_id", "id")
+            .values_list("borrowing__user_id", "borrowing_id", "payment_amount")
+        )
+        payments = Payment.objects.bulk_create(
+            Payment(
+                status=Payment.StatusChoices.PENDING,
+                borrowing_id=borrowing_id,
+                payment_amount=amount,
+            )
+            for _, borrowing_id, amount in expired
+        )
+        OutstandingBalance.objects.adjust(
+            [(user_id, 1, amount) for user_id, _, amount in expired]
+        )
+        users = [user_id for user_id, _, _ in expired]
+        for _, rows in groupby(zip(users, payments), key=itemgetter(0)):
+            ids = [payment.pk for _, payment in rows]
+            transaction.on_commit(
+                lambda ids=ids: create_payment_session_task.delay(*ids)
+            )
+        return payments
+
+    @staticmethod
+    def idempotency_key(payments: list) -> str:
+        payment_ids = "-".join(str(payment.pk) for payment in payments)
+        if len(payments) == 1:
+            return f"payment-{payment_ids}-checkout-session"
+        digest = sha1(payment_ids.encode()).hexdigest()
+        return f"payments-{digest}-checkout-session"
+
+    @staticmethod
+    def expires_at(payments: list) -> datetime:
+        """
+        When the session of payments expires: STRIPE_SESSION_EXPIRY_HOURS
+        after the oldest was created, within the range Stripe accepts
+        """
+        now = timezone.now()
+        expires_at = min(payment.created_at for payment in payments) + timedelta(
+            hours=settings.STRIPE_SESSION_EXPIRY_HOURS
+        )
+        return min(
+            max(expires_at, now + SESSION_MIN_LIFETIME), now + SESSION_MAX_LIFETIME
+        )
+
+    @staticmethod
+    def create_session(*payment_ids: int) -> None:
+        """Create one checkout session covering every given payment"""
+        payments = list(
+            Payment.objects.select_related("borrowing__book")
+            .filter(pk__in=payment_ids, session_id=None)
+            .order_by("id")
+        )
+        if not payments:
+            return
+        session = get_stripe_client().create_checkout_session(
+            line_items=[
+                (payment.borrowing.book.title, payment.payment_amount)
+                for payment in payments
+            ],
+            idempotency_key=CreateSession.idempotency_key(payments),
+            expires_at=CreateSession.expires_at(payments),
+        )
+        Payment.objects.filter(
+            pk__in=[payment.pk for payment in payments], session_id=None
+        ).update(session_id=session.id, session_url=session.url)
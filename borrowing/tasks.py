@@ -1,28 +1,117 @@
+import time
 from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
 
+import stripe
 from celery import shared_task
+from celery.utils.log import get_task_logger
 
-from borrowing.bot import send_telegram_notification
+from book.models import BookStats
+from borrowing.expiry import PaymentExpirer
 from borrowing.models import Borrowing
+from borrowing.notifications import (
+    NotificationDispatcher,
+    notify_many,
+    split_message,
+)
+from borrowing.reconcile import PaymentReconciler
+from borrowing.session import CreateSession
+from borrowing.webhooks import StripeEventProcessor
+
+logger = get_task_logger(__name__)
+
+OVERDUE_CHUNK_SIZE = 2000
 
 
 @shared_task
-def overdue_borrowings_task() -> None:
-    today = date.today()
-    tomorrow = today + timedelta(days=1)
+def overdue_borrowings_task() -> dict:
+    """Send one digest of borrowings due by tomorrow, grouped per user"""
+    started = time.perf_counter()
+    tomorrow = date.today() + timedelta(days=1)
 
-    overdue_borrowings = Borrowing.objects.filter(
-        expected_return_date__lte=tomorrow, actual_return_date=None
+    overdue_rows = (
+        Borrowing.objects.filter(
+            expected_return_date__lte=tomorrow, actual_return_date=None
+        )
+        .order_by("user_id", "expected_return_date", "id")
+        .values_list("user_id", "user__email", "book__title", "expected_return_date")
+        .iterator(chunk_size=OVERDUE_CHUNK_SIZE)
     )
 
-    if overdue_borrowings:
-        for borrowing in overdue_borrowings:
-            message = (
-                f"Overdue borrowing:\n"
-                f"User: {borrowing.user.email}\n"
-                f"Book: {borrowing.book.title}"
-            )
-            send_telegram_notification(message)
-
-    message = "everything is ok, we haven't expired borrowings"
-    send_telegram_notification(message)
+    rows_scanned = 0
+    users = 0
+    lines = []
+    for _, user_rows in groupby(overdue_rows, key=itemgetter(0)):
+        user_rows = list(user_rows)
+        rows_scanned += len(user_rows)
+        users += 1
+        books = ", ".join(
+            f"{title} (due {expected_return_date})"
+            for _, _, title, expected_return_date in user_rows
+        )
+        lines.append(f"{user_rows[0][1]}: {len(user_rows)} overdue - {books}")
+
+    if lines:
+        header = f"Overdue borrowings: {rows_scanned} books, {users} users"
+        messages = split_message([header] + lines)
+    else:
+        messages = ["everything is ok, we haven't expired borrowings"]
+    notify_many(messages)
+
+    metrics = {
+        "rows_scanned": rows_scanned,
+        "users": users,
+        "messages_sent": len(messages),
+        "duration": round(time.perf_counter() - started, 4),
+    }
+    logger.info("overdue_borrowings_task finished: %s", metrics)
+    return metrics
+
+
+@shared_task(ignore_result=True)
+def refresh_overdue_loans_task() -> None:
+    """Recount overdue loans per book once the day has changed"""
+    BookStats.objects.refresh_overdue()
+
+
+@shared_task(
+    autoretry_for=(
+        stripe.error.APIConnectionError,
+        stripe.error.APIError,
+        stripe.error.RateLimitError,
+    ),
+    retry_backoff=True,
+    retry_backoff_max=10 * 60,
+    max_retries=8,
+    ignore_result=True,
+    acks_late=True,
+)
+def create_payment_session_task(*payment_ids: int) -> None:
+    CreateSession.create_session(*payment_ids)
+
+
+@shared_task(ignore_result=True)
+def send_notifications_task() -> dict:
+    return NotificationDispatcher().drain()
+
+
+@shared_task(acks_late=True)
+def reconcile_payments_task() -> dict:
+    """Settle pending payments paid without the success redirect"""
+    metrics = PaymentReconciler().run()
+    logger.info("reconcile_payments_task finished: %s", metrics)
+    return metrics
+
+
+@shared_task(ignore_result=True, acks_late=True)
+def process_stripe_events_task() -> dict:
+    return StripeEventProcessor().drain()
+
+
+@shared_task(acks_late=True)
+def expire_stale_payments_task() -> dict:
+    """Expire pending payments whose checkout sessions have expired"""
+    metrics = PaymentExpirer().run()
+    logger.info("expire_stale_payments_task finished: %s", metrics)
+    return metrics
@@ -0,0 +1,163 @@
+import asyncio
+import hmac
+import itertools
+import json
+import threading
+import time
+from hashlib import sha256
+from types import SimpleNamespace
+
+import stripe
+
+
+class FakeStripeClient:
+    """
+    In-memory stand-in for borrowing.session.StripeClient.
+    Sessions are kept on the class so tests can inspect them.
+    """
+
+    sessions = {}
+    sessions_by_key = {}
+    events = []
+    _ids = itertools.count(1)
+    # Seconds each retrieve takes, and session ids whose retrieve fails.
+    delay = 0
+    failing_sessions = set()
+    in_flight = 0
+    max_in_flight = 0
+    _lock = threading.Lock()
+
+    def create_checkout_session(
+        self, line_items: list, idempotency_key: str, expires_at=None
+    ):
+        if idempotency_key in self.sessions_by_key:
+            return self.sessions_by_key[idempotency_key]
+        session_id = f"cs_test_{next(self._ids)}"
+        session = SimpleNamespace(
+            id=session_id,
+            url=f"https://checkout.stripe.test/pay/{session_id}",
+            line_items=line_items,
+            amount_total=sum(amount for _, amount in line_items),
+            status="open",
+            payment_status="unpaid",
+            expires_at=expires_at,
+        )
+        self.sessions[session_id] = session
+        self.sessions_by_key[idempotency_key] = session
+        return session
+
+    def retrieve_checkout_session(self, session_id: str):
+        cls = type(self)
+        with cls._lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            time.sleep(self.delay)
+            if session_id in self.failing_sessions:
+                raise stripe.error.APIConnectionError("Stripe is unreachable")
+            if session_id not in self.sessions:
+                raise stripe.error.InvalidRequestError(
+                    f"No such checkout.session: {session_id}", "id"
+                )
+            return self.sessions[session_id]
+        finally:
+            with cls._lock:
+                cls.in_flight -= 1
+
+    def list_events(self, types: list, created_after: int):
+        return [
+            event
+            for event in self.events
+            if event["type"] in types and event["created"] >= created_after
+        ]
+
+    @classmethod
+    def complete(cls, session_id: str) -> dict:
+        """
+        Pay a session, as the customer would on the checkout page;
+        return the event Stripe sends
+        """
+        session = cls.sessions[session_id]
+        session.status = "complete"
+        session.payment_status = "paid"
+        return cls.event("checkout.session.completed", session_id)
+
+    @classmethod
+    def expire(cls, session_id: str) -> dict:
+        cls.sessions[session_id].status = "expired"
+        return cls.event("checkout.session.expired", session_id)
+
+    @classmethod
+    def event(cls, event_type: str, session_id: str) -> dict:
+        session = cls.sessions.get(session_id)
+        event = {
+            "id": f"evt_test_{next(cls._ids)}",
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "data": {
+                "object": {
+                    "id": session_id,
+                    "object": "checkout.session",
+                    "status": session.status if session else "complete",
+                    "payment_status": session.payment_status if session else "paid",
+                }
+            },
+        }
+        cls.events.append(event)
+        return event
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.sessions.clear()
+        cls.sessions_by_key.clear()
+        cls.events.clear()
+        cls.failing_sessions = set()
+        cls.delay = 0
+        cls.in_flight = 0
+        cls.max_in_flight = 0
+
+
+def sign_event(event: dict, secret: str, timestamp: int = None) -> tuple:
+    """The webhook request body of an event and its Stripe-Signature header"""
+    payload = json.dumps(event)
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(
+        secret.encode(), f"{timestamp}.{payload}".encode(), sha256
+    ).hexdigest()
+    return payload, f"t={timestamp},v1={signature}"
+
+
+class FakeTelegramTransport:
+    """
+    Records messages instead of calling the Telegram API.
+    Chats listed in `failing_chats` raise `error` on every send, or on
+    every send after their first `fail_after` ones.
+    """
+
+    def __init__(
+        self, failing_chats=(), error=None, delay: float = 0, fail_after: int = 0
+    ):
+        self.sent = []
+        self.fail_after = fail_after
+        self.failing_chats = set(failing_chats)
+        self.error = error or ConnectionError("Telegram is unreachable")
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.closed = False
+
+    async def send(self, chat_id: str, text: str) -> None:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if chat_id in self.failing_chats:
+                if self.fail_after <= sum(chat == chat_id for chat, _ in self.sent):
+                    raise self.error
+            self.sent.append((chat_id, text))
+        finally:
+            self.in_flight -= 1
+
+    async def close(self) -> None:
+        self.closed = True
@@ -1,18 +1,68 @@
+import csv
 import datetime
+import json
+import re
+import resource
+import time
 from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+import stripe
 
-from book.models import Book
-from borrowing.models import Borrowing, Payment
-from borrowing.serializers import BorrowingSerializer, BorrowingReturnSerializer
+from book.models import Book, BookStats
+from book.tests import asgi_request
+from borrowing.expiry import PaymentExpirer
+from borrowing.management.commands.run_worker import worker_argv
+from borrowing.models import (
+    Borrowing,
+    Notification,
+    OutstandingBalance,
+    Payment,
+    StripeEvent,
+)
+from borrowing.notifications import (
+    MESSAGE_LIMIT,
+    NotificationDispatcher,
+    NotificationRetryAfter,
+)
+from borrowing.reconcile import PaymentReconciler
+from borrowing.serializers import BorrowingSerializer
+from borrowing.session import CreateSession
+from borrowing.tasks import (
+    create_payment_session_task,
+    expire_stale_payments_task,
+    overdue_borrowings_task,
+    process_stripe_events_task,
+    reconcile_payments_task,
+    send_notifications_task,
+)
+from borrowing.testing import FakeStripeClient, FakeTelegramTransport, sign_event
+from borrowing.webhooks import EVENTS_SCHEDULED_KEY, StripeEventProcessor
+from instrumentation import QueryBudgetTestMixin
+from library_service.celery import app as celery_app
+from readpool import ReadPoolASGIHandler
 
 BORROWING_URL = reverse("borrowing:borrowing-list")
 PAYMENT_URL = reverse("borrowing:borrowing-list")
+BULK_CREATE_URL = reverse("borrowing:borrowing-bulk-create")
+BULK_RETURN_URL = reverse("borrowing:borrowing-bulk-return")
+EXPORT_URL = reverse("borrowing:borrowing-export")
+PAYMENT_EXPORT_URL = reverse("borrowing:payment-export")
+EXPORT_MEMORY_CEILING = 16 * 2**20
+WEBHOOK_URL = reverse("borrowing:payment-webhook")
+WEBHOOK_SECRET = "whsec_test"
 
 
 def detail_url(borrowing_id: int):
@@ -23,6 +73,10 @@ def return_url(borrowing_id: int):
     return reverse("borrowing:borrowing-return", args=[borrowing_id])
 
 
+def read_stream(response) -> str:
+    return b"".join(response.streaming_content).decode()
+
+
 def sample_book(**params):
     defaults = {
         "title": "On thr road",
@@ -97,8 +151,8 @@ class AuthenticatedBorrowingTest(TestCase):
         res = self.client.get(BORROWING_URL)
         serializer = BorrowingSerializer(Borrowing.objects.filter(user_id=1), many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertNotIn(Borrowing.objects.filter(user_id=3), res.data)
-        self.assertEqual(res.data, serializer.data)
+        self.assertNotIn(Borrowing.objects.filter(user_id=3), res.data["results"])
+        self.assertEqual(res.data["results"], serializer.data)
 
     def test_create_borrowing(self) -> None:
         book1 = Book.objects.create(
@@ -169,12 +223,12 @@ class AdminBorrowingTest(TestCase):
     def test_filter_borrowings(self):
         response = self.client.get(BORROWING_URL)
         serializer = BorrowingSerializer(Borrowing.objects.all(), many=True)
-        self.assertEqual(response.data, serializer.data)
+        self.assertEqual(response.data["results"], serializer.data)
         response2 = self.client.get(BORROWING_URL, {"user_id": 2})
         serializer3 = BorrowingSerializer(
             Borrowing.objects.filter(user_id=2), many=True
         )
-        self.assertEqual(response2.data, serializer3.data)
+        self.assertEqual(response2.data["results"], serializer3.data)
 
     def test_return_borrowings(self):
         url = return_url(borrowing_id=self.borrowing.id)
@@ -198,3 +252,1482 @@ class AdminBorrowingTest(TestCase):
         self.book.refresh_from_db()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(self.book.inventory, 11)
+
+
+class HotQueryPlanTest(TestCase):
+    """Fail when a hot query falls back to a full table scan."""
+
+    def setUp(self) -> None:
+        self.user = get_user_model().objects.create_user("plan@test.com", "test1234")
+        book = sample_book()
+        for days in range(20):
+            borrowing = sample_borrowing(
+                book=book,
+                user=self.user,
+                expected_return_date=date.today() + timedelta(days=days),
+                actual_return_date=date.today() if days % 2 else None,
+            )
+            Payment.objects.create(
+                status=Payment.StatusChoices.PENDING,
+                borrowing=borrowing,
+                session_id=f"cs_{days}",
+            )
+
+    def assert_no_full_scan(self, queryset) -> None:
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        table = queryset.model._meta.db_table
+        full_scan = re.compile(rf"(Seq Scan on {table}\b|\bSCAN {table}\b)")
+        self.assertIsNone(full_scan.search(plan), plan)
+
+    def test_active_borrowings_per_user(self):
+        self.assert_no_full_scan(
+            Borrowing.objects.filter(
+                user=self.user, actual_return_date=None
+            ).order_by("borrow_date", "id")
+        )
+
+    def test_borrowings_per_user(self):
+        self.assert_no_full_scan(
+            Borrowing.objects.filter(user=self.user).order_by("borrow_date", "id")
+        )
+
+    def test_overdue_borrowings(self):
+        self.assert_no_full_scan(
+            Borrowing.objects.filter(
+                expected_return_date__lte=date.today() + timedelta(days=1),
+                actual_return_date=None,
+            ).order_by("user_id", "expected_return_date", "id")
+        )
+
+    def test_payment_by_session_id(self):
+        self.assert_no_full_scan(Payment.objects.filter(session_id="cs_3"))
+
+    def test_pending_payments_per_user(self):
+        self.assert_no_full_scan(
+            Payment.objects.filter(
+                borrowing__user=self.user, status=Payment.StatusChoices.PENDING
+            )
+        )
+
+
+class ConcurrentReservationTest(TransactionTestCase):
+    def test_last_copies_are_never_oversold(self):
+        out = StringIO()
+        call_command(
+            "stress_inventory", threads=8, copies=5, attempts=3, stdout=out
+        )
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report["reserved"], 5)
+        self.assertEqual(report["rejected"], 8 * 3 - 5)
+        self.assertEqual(report["inventory_left"], 0)
+        self.assertEqual(report["oversold"], 0)
+
+    def test_borrow_rejected_when_reservation_fails(self):
+        user = get_user_model().objects.create_user("race@test.com", "test1234")
+        book = sample_book(inventory=1)
+        client = APIClient()
+        client.force_authenticate(user)
+        payload = {
+            "expected_return_date": date.today() + timedelta(days=3),
+            "book": book.id,
+        }
+        with mock.patch.object(Book.objects, "reserve", return_value=False):
+            response = client.post(BORROWING_URL, payload)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Borrowing.objects.exists())
+
+
+@override_settings(STRIPE_CLIENT="borrowing.testing.FakeStripeClient")
+class PaymentSessionTaskTest(TestCase):
+    def setUp(self) -> None:
+        FakeStripeClient.reset()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            "stripe@test.com", "test1234", is_staff=True
+        )
+        self.client.force_authenticate(self.user)
+        self.borrowing = sample_borrowing(
+            user=self.user, borrow_date=date.today() - timedelta(days=2)
+        )
+
+    def test_return_enqueues_session_after_commit(self):
+        with mock.patch.object(create_payment_session_task, "delay") as delay:
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(return_url(self.borrowing.id))
+            payment = Payment.objects.get(borrowing=self.borrowing)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+            self.assertIsNone(payment.session_id)
+            delay.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+            delay.assert_called_once_with(payment.id)
+
+    def test_task_fills_pending_payment(self):
+        payment = CreateSession.create_payment(self.borrowing)
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        session = FakeStripeClient.sessions[payment.session_id]
+
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(payment.session_url, session.url)
+        self.assertEqual(session.amount_total, payment.payment_amount)
+
+    def test_task_is_idempotent(self):
+        payment = CreateSession.create_payment(self.borrowing)
+        create_payment_session_task.apply(args=(payment.id,))
+        Payment.objects.filter(pk=payment.pk).update(session_id=None)
+        create_payment_session_task.apply(args=(payment.id,))
+        create_payment_session_task.apply(args=(payment.id,))
+
+        self.assertEqual(len(FakeStripeClient.sessions), 1)
+
+    def test_task_retries_on_stripe_outage(self):
+        payment = CreateSession.create_payment(self.borrowing)
+        outage = stripe.error.APIConnectionError("Stripe is down")
+        session = FakeStripeClient().create_checkout_session([("test", 100)], "key")
+        with mock.patch.object(
+            FakeStripeClient,
+            "create_checkout_session",
+            side_effect=[outage, outage, session],
+        ) as create:
+            create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+
+        self.assertEqual(create.call_count, 3)
+        self.assertIsNotNone(payment.session_id)
+
+
+@override_settings(TELEGRAM_MESSAGES_PER_SECOND=1000, CHAT_ID="42")
+class NotificationOutboxTest(TestCase):
+    def test_borrowing_writes_notification_in_transaction(self):
+        user = get_user_model().objects.create_user("outbox@test.com", "test1234")
+        client = APIClient()
+        client.force_authenticate(user)
+        book = sample_book()
+        with mock.patch.object(send_notifications_task, "apply_async") as enqueue:
+            with self.captureOnCommitCallbacks(execute=True):
+                client.post(
+                    BORROWING_URL,
+                    {
+                        "book": book.id,
+                        "expected_return_date": date.today() + timedelta(days=3),
+                    },
+                )
+
+        notification = Notification.objects.get()
+        self.assertEqual(notification.chat_id, "42")
+        self.assertIn(book.title, notification.text)
+
+        self.assertEqual(notification.status, Notification.StatusChoices.PENDING)
+        enqueue.assert_called_once()
+
+    @override_settings(CHAT_ID=None)
+    def test_borrowing_without_chat_writes_no_notification(self):
+        user = get_user_model().objects.create_user("nochat@test.com", "test1234")
+        client = APIClient()
+        client.force_authenticate(user)
+        payload = {
+            "book": sample_book().id,
+            "expected_return_date": date.today() + timedelta(days=3),
+        }
+        with self.assertLogs("borrowing.notifications", "WARNING"):
+            response = client.post(BORROWING_URL, payload)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(Notification.objects.exists())
+
+    def test_drain_coalesces_one_message_per_chat(self):
+        for text in ("first", "second", "third"):
+            Notification.objects.create(chat_id="1", text=text)
+        Notification.objects.create(chat_id="2", text="other chat")
+        transport = FakeTelegramTransport()
+
+        report = NotificationDispatcher(transport).drain()
+
+        self.assertEqual(
+            sorted(transport.sent),
+            [("1", "first\n\nsecond\n\nthird"), ("2", "other chat")],
+        )
+        self.assertEqual(report["sent"], 4)
+        self.assertFalse(
+            Notification.objects.exclude(
+                status=Notification.StatusChoices.SENT
+            ).exists()
+        )
+        self.assertTrue(transport.closed)
+
+    def test_long_bursts_are_split_at_message_limit(self):
+        for _ in range(3):
+            Notification.objects.create(chat_id="1", text="x" * 3000)
+        transport = FakeTelegramTransport()
+
+        NotificationDispatcher(transport).drain()
+
+        self.assertEqual(len(transport.sent), 3)
+        self.assertTrue(all(len(text) <= MESSAGE_LIMIT for _, text in transport.sent))
+
+    def test_failed_part_retries_only_unsent_notifications(self):
+        notifications = [
+            Notification.objects.create(chat_id="1", text=text * 3000)
+            for text in ("a", "b", "c")
+        ]
+        transport = FakeTelegramTransport(failing_chats={"1"}, fail_after=1)
+
+        report = NotificationDispatcher(transport).drain()
+
+        self.assertEqual(report["sent"], 1)
+        self.assertEqual(
+            list(
+                Notification.objects.order_by("id").values_list("status", "attempts")
+            ),
+            [
+                (Notification.StatusChoices.SENT, 0),
+                (Notification.StatusChoices.PENDING, 1),
+                (Notification.StatusChoices.PENDING, 1),
+            ],
+        )
+
+        Notification.objects.update(next_attempt_at=timezone.now())
+        transport = FakeTelegramTransport()
+        NotificationDispatcher(transport).drain()
+        self.assertEqual(
+            [text for _, text in transport.sent],
+            [notification.text for notification in notifications[1:]],
+        )
+
+    @override_settings(TELEGRAM_MAX_CONCURRENCY=3)
+    def test_concurrency_is_bounded(self):
+        for chat_id in range(10):
+            Notification.objects.create(chat_id=str(chat_id), text="hi")
+        transport = FakeTelegramTransport(delay=0.01)
+
+        NotificationDispatcher(transport).drain()
+
+        self.assertEqual(len(transport.sent), 10)
+        self.assertLessEqual(transport.max_in_flight, 3)
+        self.assertGreater(transport.max_in_flight, 1)
+
+    @override_settings(TELEGRAM_MAX_ATTEMPTS=2)
+    def test_failures_are_retried_then_given_up(self):
+        notification = Notification.objects.create(chat_id="1", text="hi")
+        transport = FakeTelegramTransport(failing_chats={"1"})
+
+        NotificationDispatcher(transport).drain()
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.StatusChoices.PENDING)
+        self.assertEqual(notification.attempts, 1)
+        self.assertGreater(notification.next_attempt_at, timezone.now())
+
+        Notification.objects.update(next_attempt_at=timezone.now())
+        NotificationDispatcher(transport).drain()
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.StatusChoices.FAILED)
+
+    def test_rate_limited_chat_waits_without_spending_attempts(self):
+        notification = Notification.objects.create(chat_id="1", text="hi")
+        transport = FakeTelegramTransport(
+            failing_chats={"1"}, error=NotificationRetryAfter(30)
+        )
+
+        NotificationDispatcher(transport).drain()
+        notification.refresh_from_db()
+
+        self.assertEqual(notification.attempts, 0)
+        self.assertGreater(
+            notification.next_attempt_at, timezone.now() + timedelta(seconds=20)
+        )
+
+    def test_claimed_notifications_are_not_sent_twice(self):
+        Notification.objects.create(chat_id="1", text="hi")
+        dispatcher = NotificationDispatcher(FakeTelegramTransport())
+
+        self.assertEqual(len(dispatcher.claim()), 1)
+        self.assertEqual(dispatcher.claim(), [])
+
+
+@override_settings(CHAT_ID="42")
+class OverdueBorrowingsTaskTest(TestCase):
+    def setUp(self) -> None:
+        self.book = sample_book(title="Dune")
+        self.users = [
+            get_user_model().objects.create_user(f"late{i}@test.com", "test1234")
+            for i in range(3)
+        ]
+
+    def overdue(self, user, days=1, **params):
+        return sample_borrowing(
+            book=self.book,
+            user=user,
+            expected_return_date=date.today() - timedelta(days=days),
+            **params,
+        )
+
+    def test_sends_one_digest_grouped_by_user(self):
+        for user in self.users:
+            self.overdue(user, days=1)
+            self.overdue(user, days=2)
+        self.overdue(self.users[0], actual_return_date=date.today())
+
+        metrics = overdue_borrowings_task()
+        digest = Notification.objects.get().text
+
+        self.assertEqual(metrics["rows_scanned"], 6)
+        self.assertEqual(metrics["users"], 3)
+        self.assertEqual(metrics["messages_sent"], 1)
+        self.assertIn("Overdue borrowings: 6 books, 3 users", digest)
+        self.assertIn("late0@test.com: 2 overdue", digest)
+        self.assertNotIn("everything is ok", digest)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        for user in self.users:
+            for days in range(5):
+                self.overdue(user, days=days + 1)
+
+        # One SELECT for the overdue rows and one INSERT for the digest.
+        with self.assertNumQueries(2):
+            overdue_borrowings_task()
+
+    def test_digest_is_split_at_message_limit(self):
+        book = sample_book(title="T" * 90)
+        for user in self.users:
+            for days in range(20):
+                sample_borrowing(
+                    book=book,
+                    user=user,
+                    expected_return_date=date.today() - timedelta(days=days),
+                )
+
+        metrics = overdue_borrowings_task()
+        texts = Notification.objects.values_list("text", flat=True)
+
+        self.assertGreater(metrics["messages_sent"], 1)
+        self.assertEqual(metrics["messages_sent"], len(texts))
+        self.assertTrue(all(len(text) <= MESSAGE_LIMIT for text in texts))
+
+    def test_reports_nothing_overdue(self):
+        sample_borrowing(book=self.book, user=self.users[0])
+
+        metrics = overdue_borrowings_task()
+
+        self.assertEqual(metrics["rows_scanned"], 0)
+        self.assertEqual(
+            Notification.objects.get().text,
+            "everything is ok, we haven't expired borrowings",
+        )
+
+
+class BorrowingAmountsTest(TestCase):
+    def setUp(self) -> None:
+        self.user = get_user_model().objects.create_user("fee@test.com", "test1234")
+        self.today = date.today()
+
+    def borrowing(self, daily_fee, borrowed, expected, returned=None, penalty=None):
+        borrowing = sample_borrowing(
+            book=sample_book(daily_fee=daily_fee),
+            user=self.user,
+            expected_return_date=self.today + timedelta(days=expected),
+            actual_return_date=(
+                None if returned is None else self.today + timedelta(days=returned)
+            ),
+            penalty_for_delay=penalty,
+        )
+        # borrow_date is auto_now_add, so it can only be moved by an update.
+        Borrowing.objects.filter(pk=borrowing.pk).update(
+            borrow_date=self.today + timedelta(days=borrowed)
+        )
+        borrowing.refresh_from_db()
+        return borrowing
+
+    def test_matches_python_formula(self):
+        cases = [
+            ("0.77", -5, 2, 0, None),
+            ("0.77", 0, 2, 0, None),
+            ("0.29", -10, -3, None, "1.50"),
+            ("0.29", -10, -3, None, None),
+            ("9.99", -30, -7, -1, "2.00"),
+            ("0.01", -3, -2, 0, "0.33"),
+            ("1.10", -3, -1, -1, "3.00"),
+            ("0.70", -100, -50, None, "0.50"),
+        ]
+        for daily_fee, borrowed, expected, returned, penalty in cases:
+            with self.subTest(
+                fee=daily_fee, returned=returned, expected=expected, penalty=penalty
+            ):
+                borrowing = self.borrowing(
+                    daily_fee, borrowed, expected, returned, penalty
+                )
+                annotated = Borrowing.objects.with_amounts().get(pk=borrowing.pk)
+
+                self.assertEqual(annotated.total_amount, borrowing.total_amount)
+                self.assertEqual(
+                    annotated.total_amount,
+                    annotated.rental_amount + annotated.penalty_amount,
+                )
+
+    def test_no_penalty_when_returned_on_time(self):
+        borrowing = self.borrowing("1.00", -4, -1, -2, "2.00")
+        annotated = Borrowing.objects.with_amounts().get(pk=borrowing.pk)
+
+        self.assertEqual(annotated.rental_amount, 200)
+        self.assertEqual(annotated.penalty_amount, 0)
+
+    def test_active_borrowings_are_priced_on_given_date(self):
+        borrowing = self.borrowing("1.00", -4, 10, None)
+        annotated = Borrowing.objects.with_amounts(
+            on_date=self.today + timedelta(days=1)
+        ).get(pk=borrowing.pk)
+
+        self.assertEqual(annotated.total_amount, 500)
+
+    def test_total_amount_has_no_side_effects(self):
+        borrowing = self.borrowing("1.00", -4, 10, None)
+        self.assertGreater(borrowing.total_amount, 0)
+        self.assertIsNone(borrowing.actual_return_date)
+
+    def test_amounts_for_many_rows_in_one_query(self):
+        for _ in range(5):
+            self.borrowing("0.50", -3, 2, None)
+
+        with self.assertNumQueries(1):
+            amounts = [
+                borrowing.total_amount
+                for borrowing in Borrowing.objects.with_amounts()
+            ]
+
+        self.assertEqual(amounts, [150] * 5)
+
+
+@override_settings(STRIPE_CLIENT="borrowing.testing.FakeStripeClient", CHAT_ID="42")
+class BulkBorrowingTest(TestCase):
+    def setUp(self) -> None:
+        FakeStripeClient.reset()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            "desk@test.com", "test1234", is_staff=True
+        )
+        self.client.force_authenticate(self.user)
+        self.books = [sample_book(title=f"Book {i}", inventory=2) for i in range(3)]
+        self.due = date.today() + timedelta(days=7)
+
+    def item(self, book, **params):
+        return {"book": book.id, "expected_return_date": self.due, **params}
+
+    def test_bulk_create(self):
+        payload = {"borrowings": [self.item(book) for book in self.books]}
+        # One SELECT each for the outstanding balance and the books, one
+        # UPDATE each for the inventory and the book stats, one INSERT each
+        # for borrowings and the notification, and the savepoints.
+        with self.assertNumQueries(10):
+            response = self.client.post(BULK_CREATE_URL, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data["created"]), 3)
+        self.assertEqual(Borrowing.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(
+            list(Book.objects.values_list("inventory", flat=True)), [1, 1, 1]
+        )
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_bulk_create_rejects_whole_batch_by_default(self):
+        payload = {
+            "borrowings": [
+                self.item(self.books[0]),
+                self.item(self.books[1]),
+                self.item(self.books[1]),
+                self.item(self.books[1]),
+            ]
+        }
+        response = self.client.post(BULK_CREATE_URL, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(3, response.data["borrowings"])
+        self.assertFalse(Borrowing.objects.exists())
+        self.assertEqual(
+            list(Book.objects.values_list("inventory", flat=True)), [2, 2, 2]
+        )
+
+    def test_bulk_create_partial(self):
+        payload = {
+            "allow_partial": True,
+            "borrowings": [
+                self.item(self.books[0]),
+                {"book": 999, "expected_return_date": self.due},
+                self.item(self.books[2], expected_return_date=date.today()),
+            ],
+        }
+        response = self.client.post(BULK_CREATE_URL, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data["created"]), 1)
+        self.assertEqual(sorted(response.data["errors"]), [1, 2])
+
+    def test_bulk_create_fails_when_inventory_changes_meanwhile(self):
+        payload = {"borrowings": [self.item(book) for book in self.books]}
+        with mock.patch.object(Book.objects, "reserve_many", return_value=False):
+            response = self.client.post(BULK_CREATE_URL, payload, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Borrowing.objects.exists())
+
+    def test_bulk_return_uses_one_checkout_session(self):
+        borrowings = [sample_borrowing(book=book, user=self.user) for book in self.books]
+        payload = {"borrowings": [borrowing.id for borrowing in borrowings]}
+
+        with mock.patch.object(create_payment_session_task, "delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(BULK_RETURN_URL, payload, format="json")
+        create_payment_session_task.apply(args=delay.call_args.args)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["payments"]), 3)
+        self.assertFalse(Borrowing.objects.filter(actual_return_date=None).exists())
+        for book in self.books:
+            book.refresh_from_db()
+            self.assertEqual(book.inventory, 3)
+        self.assertEqual(len(FakeStripeClient.sessions), 1)
+        self.assertEqual(
+            Payment.objects.values("session_id").distinct().count(), 1
+        )
+
+    def test_bulk_return_partial(self):
+        active = sample_borrowing(book=self.books[0], user=self.user)
+        closed = sample_borrowing(
+            book=self.books[1], user=self.user, actual_return_date=date.today()
+        )
+        payload = {"borrowings": [active.id, closed.id, 999]}
+
+        response = self.client.post(BULK_RETURN_URL, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        payload["allow_partial"] = True
+        response = self.client.post(BULK_RETURN_URL, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["returned"], [active.id])
+        self.assertEqual(sorted(response.data["errors"]), [closed.id, 999])
+
+    def test_bulk_return_only_for_admin(self):
+        borrowing = sample_borrowing(book=self.books[0], user=self.user)
+        self.client.force_authenticate(
+            get_user_model().objects.create_user("patron@test.com", "test1234")
+        )
+
+        response = self.client.post(
+            BULK_RETURN_URL, {"borrowings": [borrowing.id]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(STRIPE_CLIENT="borrowing.testing.FakeStripeClient")
+class OutstandingBalanceTest(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user("owe@test.com", "test1234")
+        self.client.force_authenticate(self.user)
+        self.book = sample_book()
+        self.payload = {
+            "book": self.book.id,
+            "expected_return_date": date.today() + timedelta(days=3),
+        }
+
+    def pending_payment(self, **params):
+        borrowing = sample_borrowing(book=self.book, user=self.user, **params)
+        return CreateSession.create_payment(borrowing)
+
+    def test_balance_follows_payments(self):
+        first = self.pending_payment()
+        self.pending_payment()
+        balance = OutstandingBalance.objects.get(user=self.user)
+        self.assertEqual(balance.pending_payments, 2)
+
+        Payment.objects.filter(pk=first.pk).mark_paid()
+        Payment.objects.filter(pk=first.pk).mark_paid()
+        balance.refresh_from_db()
+        self.assertEqual(balance.pending_payments, 1)
+
+    def test_pending_payment_blocks_borrowing(self):
+        self.pending_payment()
+
+        response = self.client.post(BORROWING_URL, self.payload)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            BULK_CREATE_URL, {"borrowings": [self.payload]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_gate_is_one_primary_key_lookup(self):
+        self.pending_payment()
+        with self.assertNumQueries(1):
+            self.assertTrue(OutstandingBalance.objects.has_pending(self.user.id))
+
+    def test_success_redirect_unblocks_borrowing(self):
+        payment = self.pending_payment()
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        FakeStripeClient.complete(payment.session_id)
+
+        response = self.client.get(
+            reverse("borrowing:payment-success"), {"session_id": payment.session_id}
+        )
+        payment.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(payment.status, Payment.StatusChoices.PAID)
+
+        response = self.client.post(BORROWING_URL, self.payload)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_success_redirect_needs_a_paid_session_of_the_user(self):
+        payment = self.pending_payment()
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        url = reverse("borrowing:payment-success")
+
+        response = self.client.get(url, {"session_id": payment.session_id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        FakeStripeClient.complete(payment.session_id)
+        self.client.force_authenticate(
+            get_user_model().objects.create_user("other@test.com", "test1234")
+        )
+        response = self.client.get(url, {"session_id": payment.session_id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        self.assertTrue(OutstandingBalance.objects.has_pending(self.user.id))
+
+    def test_rebuild_repairs_drift(self):
+        self.pending_payment()
+        other = get_user_model().objects.create_user("drift@test.com", "test1234")
+        OutstandingBalance.objects.create(user=other, pending_payments=3)
+        OutstandingBalance.objects.filter(user=self.user).update(pending_payments=0)
+
+        out = StringIO()
+        call_command("rebuild_outstanding_balances", stdout=out)
+
+        self.assertIn("2 users had drifted", out.getvalue())
+        self.assertTrue(OutstandingBalance.objects.has_pending(self.user.id))
+        self.assertFalse(OutstandingBalance.objects.has_pending(other.id))
+
+    def test_rebuild_given_users_leaves_others(self):
+        self.pending_payment()
+        other = get_user_model().objects.create_user("drift@test.com", "test1234")
+        OutstandingBalance.objects.create(user=other, pending_payments=3)
+        OutstandingBalance.objects.filter(user=self.user).update(pending_payments=0)
+
+        drifted = OutstandingBalance.objects.rebuild(user_ids=[self.user.id])
+
+        self.assertEqual(drifted, 1)
+        self.assertTrue(OutstandingBalance.objects.has_pending(self.user.id))
+        self.assertTrue(OutstandingBalance.objects.has_pending(other.id))
+
+
+@override_settings(
+    STRIPE_CLIENT="borrowing.testing.FakeStripeClient",
+    STRIPE_RECONCILE_BATCH_SIZE=2,
+    STRIPE_RECONCILE_CONCURRENCY=2,
+)
+class PaymentReconcileTest(TestCase):
+    def setUp(self) -> None:
+        FakeStripeClient.reset()
+        self.user = get_user_model().objects.create_user("late@test.com", "test1234")
+        self.book = sample_book()
+
+    def pending_payment(self):
+        borrowing = sample_borrowing(book=self.book, user=self.user)
+        payment = CreateSession.create_payment(borrowing)
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        return payment
+
+    def test_settles_paid_sessions(self):
+        payments = [self.pending_payment() for _ in range(5)]
+        for payment in payments[:3]:
+            FakeStripeClient.complete(payment.session_id)
+
+        metrics = reconcile_payments_task.apply().get()
+
+        self.assertEqual(metrics["payments"], 5)
+        self.assertEqual(metrics["sessions"], 5)
+        self.assertEqual(metrics["paid"], 3)
+        self.assertEqual(metrics["errors"], 0)
+        self.assertEqual(
+            list(Payment.objects.order_by("id").values_list("status", flat=True)),
+            [Payment.StatusChoices.PAID] * 3 + [Payment.StatusChoices.PENDING] * 2,
+        )
+        balance = OutstandingBalance.objects.get(user=self.user)
+        self.assertEqual(balance.pending_payments, 2)
+
+    def test_failed_retrieve_leaves_payment_pending(self):
+        first, second = self.pending_payment(), self.pending_payment()
+        FakeStripeClient.complete(first.session_id)
+        FakeStripeClient.complete(second.session_id)
+        FakeStripeClient.failing_sessions = {first.session_id}
+
+        with self.assertLogs("borrowing.reconcile", "WARNING"):
+            metrics = PaymentReconciler().run()
+        first.refresh_from_db()
+        second.refresh_from_db()
+
+        self.assertEqual(metrics["errors"], 1)
+        self.assertEqual(first.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(second.status, Payment.StatusChoices.PAID)
+
+    def test_settles_each_chunk_in_one_update(self):
+        for _ in range(5):
+            FakeStripeClient.complete(self.pending_payment().session_id)
+
+        with CaptureQueriesContext(connection) as queries:
+            metrics = PaymentReconciler().run()
+        updates = [
+            query
+            for query in queries.captured_queries
+            if query["sql"].startswith('UPDATE "borrowing_payment"')
+        ]
+
+        self.assertEqual(metrics["paid"], 5)
+        # Batches of two: three chunks, one UPDATE each.
+        self.assertEqual(len(updates), 3)
+
+    def test_concurrency_is_bounded(self):
+        for _ in range(6):
+            self.pending_payment()
+        FakeStripeClient.delay = 0.05
+
+        PaymentReconciler().run()
+
+        self.assertEqual(FakeStripeClient.max_in_flight, 2)
+
+    @override_settings(METRICS_TOKEN="scrape")
+    def test_metrics(self):
+        FakeStripeClient.complete(self.pending_payment().session_id)
+        PaymentReconciler().run()
+        # As seen by a web process not sharing the worker's cache.
+        cache.clear()
+
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape"
+        )
+
+        body = response.content.decode()
+        self.assertIn('library_payment_reconcile{count="paid"} 1', body)
+        self.assertIn("library_payment_reconcile_oldest_pending_days 0", body)
+
+
+@override_settings(
+    STRIPE_CLIENT="borrowing.testing.FakeStripeClient",
+    STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+)
+class StripeWebhookTest(TestCase):
+    def setUp(self) -> None:
+        FakeStripeClient.reset()
+        cache.delete(EVENTS_SCHEDULED_KEY)
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user("hook@test.com", "test1234")
+        self.book = sample_book()
+
+    def pending_payment(self):
+        borrowing = sample_borrowing(book=self.book, user=self.user)
+        payment = CreateSession.create_payment(borrowing)
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        return payment
+
+    def post_event(self, event, secret=WEBHOOK_SECRET, **params):
+        payload, signature = sign_event(event, secret, **params)
+        return self.client.post(
+            WEBHOOK_URL,
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+
+    def test_completed_session_is_paid_after_commit(self):
+        payment = self.pending_payment()
+        event = FakeStripeClient.complete(payment.session_id)
+
+        with mock.patch.object(
+            process_stripe_events_task, "apply_async"
+        ) as apply_async, self.captureOnCommitCallbacks(execute=True):
+            response = self.post_event(event)
+        payment.refresh_from_db()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        apply_async.assert_called_once()
+
+        metrics = process_stripe_events_task.apply().get()
+        payment.refresh_from_db()
+
+        self.assertEqual(metrics["paid"], 1)
+        self.assertEqual(payment.status, Payment.StatusChoices.PAID)
+        self.assertFalse(OutstandingBalance.objects.has_pending(self.user.id))
+        self.assertFalse(StripeEvent.objects.filter(processed_at=None).exists())
+
+    def test_expired_session_expires_payment(self):
+        payment = self.pending_payment()
+        self.post_event(FakeStripeClient.expire(payment.session_id))
+
+        metrics = StripeEventProcessor().drain()
+        payment.refresh_from_db()
+
+        self.assertEqual(metrics["expired"], 1)
+        self.assertEqual(payment.status, Payment.StatusChoices.EXPIRED)
+        self.assertFalse(OutstandingBalance.objects.has_pending(self.user.id))
+
+    def test_rejects_bad_signatures(self):
+        event = FakeStripeClient.complete(self.pending_payment().session_id)
+
+        response = self.post_event(event, secret="whsec_other")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post_event(event, timestamp=int(time.time()) - 3600)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post_event({"id": "evt_test"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET=None)
+    def test_disabled_without_secret(self):
+        event = FakeStripeClient.complete(self.pending_payment().session_id)
+
+        response = self.post_event(event, secret="")
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(STRIPE_EVENTS_COALESCE_SECONDS=60)
+    def test_burst_of_events_is_stored_once_each(self):
+        payments = [self.pending_payment() for _ in range(50)]
+        events = [FakeStripeClient.complete(p.session_id) for p in payments]
+        deliveries = [*events, *events[:20]] * 5
+
+        with mock.patch.object(
+            process_stripe_events_task, "apply_async"
+        ) as apply_async, self.captureOnCommitCallbacks(execute=True):
+            for event in deliveries:
+                with self.assertNumQueries(1):
+                    response = self.post_event(event)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(StripeEvent.objects.count(), 50)
+        # The task is queued once for the whole burst.
+        apply_async.assert_called_once()
+        metrics = StripeEventProcessor().drain()
+        self.assertEqual(metrics, {**metrics, "events": 50, "paid": 50})
+        self.assertFalse(Payment.objects.filter(status="Pending").exists())
+
+    def test_replay_stored_events(self):
+        payment = self.pending_payment()
+        self.post_event(FakeStripeClient.complete(payment.session_id))
+        StripeEventProcessor().drain()
+        # As if the payment was reverted while processing.
+        Payment.objects.filter(pk=payment.pk).update(
+            status=Payment.StatusChoices.PENDING
+        )
+
+        out = StringIO()
+        call_command("replay_stripe_events", date.today().isoformat(), stdout=out)
+        payment.refresh_from_db()
+
+        self.assertIn("Processed 1 events: 1 payments paid", out.getvalue())
+        self.assertEqual(payment.status, Payment.StatusChoices.PAID)
+
+    def test_replay_fetches_missed_events(self):
+        first, second = self.pending_payment(), self.pending_payment()
+        self.post_event(FakeStripeClient.complete(first.session_id))
+        # Sent while the endpoint was down.
+        FakeStripeClient.complete(second.session_id)
+
+        out = StringIO()
+        call_command(
+            "replay_stripe_events", date.today().isoformat(), "--fetch", stdout=out
+        )
+        second.refresh_from_db()
+
+        self.assertIn("Fetched 2 events", out.getvalue())
+        self.assertEqual(StripeEvent.objects.count(), 2)
+        self.assertEqual(second.status, Payment.StatusChoices.PAID)
+
+
+class CeleryProfileTest(TestCase):
+    def test_tests_run_tasks_eagerly(self):
+        self.assertTrue(celery_app.conf.task_always_eager)
+        self.assertEqual(celery_app.conf.broker_url, "memory://")
+        self.assertIsNone(celery_app.conf.result_backend)
+        self.assertTrue(send_notifications_task.ignore_result)
+
+    def test_tasks_are_routed_per_queue(self):
+        queues = {
+            task.name: celery_app.amqp.router.route({}, task.name)["queue"].name
+            for task in (
+                send_notifications_task,
+                create_payment_session_task,
+                process_stripe_events_task,
+                reconcile_payments_task,
+                overdue_borrowings_task,
+            )
+        }
+
+        self.assertEqual(
+            list(queues.values()),
+            ["notifications", "payments", "payments", "payments", "reports"],
+        )
+        self.assertTrue(create_payment_session_task.acks_late)
+        self.assertFalse(send_notifications_task.acks_late)
+
+    @override_settings(
+        CELERY_WORKER_QUEUES={
+            "payments": {"concurrency": 3, "prefetch_multiplier": 1}
+        }
+    )
+    def test_worker_argv(self):
+        self.assertEqual(
+            worker_argv("payments"),
+            [
+                "worker",
+                "--queues=payments",
+                "--hostname=payments@%h",
+                "--concurrency=3",
+                "--prefetch-multiplier=1",
+            ],
+        )
+
+
+@override_settings(
+    STRIPE_CLIENT="borrowing.testing.FakeStripeClient",
+    STRIPE_SESSION_EXPIRY_HOURS=24,
+    STRIPE_EXPIRE_BATCH_SIZE=2,
+)
+class PaymentExpiryTest(TestCase):
+    def setUp(self) -> None:
+        FakeStripeClient.reset()
+        self.user = get_user_model().objects.create_user("stale@test.com", "test1234")
+        self.book = sample_book()
+
+    def pending_payment(self, hours_ago: int = 0):
+        borrowing = sample_borrowing(book=self.book, user=self.user)
+        payment = CreateSession.create_payment(borrowing)
+        Payment.objects.filter(pk=payment.pk).update(
+            created_at=timezone.now() - timedelta(hours=hours_ago)
+        )
+        create_payment_session_task.apply(args=(payment.id,))
+        payment.refresh_from_db()
+        return payment
+
+    def test_expires_stale_payments(self):
+        stale = [self.pending_payment(hours_ago=26) for _ in range(3)]
+        recent = self.pending_payment(hours_ago=24)
+        paid = self.pending_payment(hours_ago=26)
+        Payment.objects.filter(pk=paid.pk).mark_paid()
+
+        with CaptureQueriesContext(connection) as queries:
+            metrics = expire_stale_payments_task.apply().get()
+        updates = [
+            query
+            for query in queries.captured_queries
+            if query["sql"].startswith('UPDATE "borrowing_payment"')
+        ]
+
+        self.assertEqual(metrics, {**metrics, "batches": 2, "expired": 3})
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(
+            set(
+                Payment.objects.filter(
+                    status=Payment.StatusChoices.EXPIRED
+                ).values_list("id", flat=True)
+            ),
+            {payment.id for payment in stale},
+        )
+        recent.refresh_from_db()
+        self.assertEqual(recent.status, Payment.StatusChoices.PENDING)
+        balance = OutstandingBalance.objects.get(user=self.user)
+        self.assertEqual(balance.pending_payments, 1)
+
+    def test_expiry_releases_blocked_user(self):
+        self.pending_payment(hours_ago=30)
+        self.assertTrue(OutstandingBalance.objects.has_pending(self.user.id))
+
+        PaymentExpirer().run()
+
+        self.assertFalse(OutstandingBalance.objects.has_pending(self.user.id))
+
+    def test_regenerates_sessions(self):
+        expired = [self.pending_payment(hours_ago=30) for _ in range(2)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            metrics = PaymentExpirer(regenerate=True).run()
+
+        self.assertEqual(metrics["expired"], 2)
+        self.assertEqual(metrics["regenerated"], 2)
+        new = Payment.objects.filter(status=Payment.StatusChoices.PENDING)
+        self.assertEqual(
+            sorted(new.values_list("borrowing_id", flat=True)),
+            sorted(payment.borrowing_id for payment in expired),
+        )
+        # One new checkout session for the user's new payments.
+        self.assertEqual(len(set(new.values_list("session_id", flat=True))), 1)
+        self.assertNotIn(
+            new.first().session_id, {payment.session_id for payment in expired}
+        )
+        balance = OutstandingBalance.objects.get(user=self.user)
+        self.assertEqual(balance.pending_payments, 2)
+
+    def test_regenerates_only_payments_it_expired(self):
+        first, second = [self.pending_payment(hours_ago=30) for _ in range(2)]
+        expirer = PaymentExpirer(regenerate=True)
+        expirer.expire([first.id])
+
+        counts = expirer.expire([first.id, second.id])
+
+        self.assertEqual(counts, {"expired": 1, "regenerated": 1})
+        self.assertEqual(
+            sorted(
+                Payment.objects.filter(
+                    status=Payment.StatusChoices.PENDING
+                ).values_list("borrowing_id", flat=True)
+            ),
+            sorted([first.borrowing_id, second.borrowing_id]),
+        )
+
+    def test_session_expiry_follows_payment(self):
+        payment = self.pending_payment()
+        session = FakeStripeClient.sessions[payment.session_id]
+        self.assertEqual(session.expires_at, payment.created_at + timedelta(hours=24))
+
+        payment = self.pending_payment(hours_ago=30)
+        session = FakeStripeClient.sessions[payment.session_id]
+        # Stripe keeps a session open for 30 minutes at least.
+        self.assertGreater(session.expires_at, timezone.now() + timedelta(minutes=30))
+
+
+class BookStatsTest(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.admin = get_user_model().objects.create_user(
+            "stats@test.com", "test1234", is_staff=True
+        )
+        self.client.force_authenticate(self.admin)
+        self.book = sample_book()
+        self.due = date.today() + timedelta(days=3)
+
+    def stats(self) -> tuple:
+        stats = BookStats.objects.get(book=self.book)
+        return (
+            stats.active_loans,
+            stats.overdue_loans,
+            stats.lifetime_loans,
+            stats.revenue,
+        )
+
+    def test_borrow_and_return(self):
+        response = self.client.post(
+            BORROWING_URL, {"book": self.book.id, "expected_return_date": self.due}
+        )
+        self.client.post(
+            BULK_CREATE_URL,
+            {
+                "borrowings": [
+                    {"book": self.book.id, "expected_return_date": self.due}
+                ]
+                * 2
+            },
+            format="json",
+        )
+        self.assertEqual(self.stats(), (3, 0, 3, 0))
+
+        Borrowing.objects.update(borrow_date=date.today() - timedelta(days=2))
+        self.client.post(return_url(response.data["id"]))
+        others = Borrowing.objects.exclude(pk=response.data["id"])
+        self.client.post(
+            BULK_RETURN_URL,
+            {"borrowings": [borrowing.id for borrowing in others]},
+            format="json",
+        )
+
+        revenue = sum(Payment.objects.values_list("payment_amount", flat=True))
+        self.assertEqual(revenue, 3 * 154)
+        self.assertEqual(self.stats(), (0, 0, 3, revenue))
+
+    def test_overdue_follows_refresh(self):
+        today = date.today()
+        late = sample_borrowing(
+            book=self.book, user=self.admin, expected_return_date=today
+        )
+        sample_borrowing(book=self.book, user=self.admin, expected_return_date=today)
+        BookStats.objects.record_loans({self.book.id: 2})
+
+        BookStats.objects.refresh_overdue(today)
+        self.assertEqual(self.stats()[:2], (2, 0))
+        BookStats.objects.refresh_overdue(today + timedelta(days=1))
+        self.assertEqual(self.stats()[:2], (2, 2))
+
+        self.client.post(return_url(late.id))
+        self.assertEqual(self.stats()[:2], (1, 1))
+
+    def test_loan_due_since_refresh_is_not_uncounted(self):
+        borrowing = sample_borrowing(
+            book=self.book,
+            user=self.admin,
+            expected_return_date=date.today() - timedelta(days=1),
+        )
+        BookStats.objects.record_loans({self.book.id: 1})
+        BookStats.objects.filter(book=self.book).update(
+            overdue_as_of=date.today() - timedelta(days=1)
+        )
+
+        self.client.post(return_url(borrowing.id))
+        self.assertEqual(self.stats()[:2], (0, 0))
+
+    def test_rebuild_repairs_drift(self):
+        sample_borrowing(book=self.book, user=self.admin)
+        returned = sample_borrowing(
+            book=self.book, user=self.admin, expected_return_date=date.today()
+        )
+        Borrowing.objects.filter(pk=returned.pk).update(
+            borrow_date=date.today() - timedelta(days=2)
+        )
+        self.client.post(return_url(returned.id))
+        other = sample_book(title="Missing stats")
+        BookStats.objects.filter(book=other).delete()
+        BookStats.objects.filter(book=self.book).update(active_loans=7, revenue=0)
+
+        out = StringIO()
+        call_command("rebuild_book_stats", stdout=out)
+
+        self.assertIn("2 books had drifted", out.getvalue())
+        self.assertEqual(self.stats(), (1, 0, 2, 154))
+        self.assertEqual(BookStats.objects.get(book=other).lifetime_loans, 0)
+
+    def test_rebuild_given_books_leaves_others(self):
+        sample_borrowing(book=self.book, user=self.admin)
+        other = sample_book(title="Drifted elsewhere")
+        BookStats.objects.filter(book=other).update(lifetime_loans=9)
+        BookStats.objects.filter(book=self.book).update(active_loans=7)
+
+        drifted = BookStats.objects.rebuild(book_ids=[self.book.id])
+
+        self.assertEqual(drifted, 1)
+        self.assertEqual(self.stats()[0], 1)
+        self.assertEqual(BookStats.objects.get(book=other).lifetime_loans, 9)
+
+    def test_rebuild_counts_regenerated_payments_once(self):
+        returned = sample_borrowing(
+            book=self.book, user=self.admin, expected_return_date=date.today()
+        )
+        BookStats.objects.record_loans({self.book.id: 1})
+        Borrowing.objects.filter(pk=returned.pk).update(
+            borrow_date=date.today() - timedelta(days=2)
+        )
+        self.client.post(return_url(returned.id))
+
+        PaymentExpirer(regenerate=True).expire(
+            list(Payment.objects.values_list("id", flat=True))
+        )
+
+        self.assertEqual(Payment.objects.count(), 2)
+        self.assertEqual(BookStats.objects.rebuild(), 0)
+        self.assertEqual(self.stats()[3], 154)
+
+
+class BorrowingFieldsetTest(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user("fields@test.com", "test1234")
+        self.client.force_authenticate(self.user)
+        sample_borrowing(user=self.user, penalty_for_delay="1.50")
+        sample_borrowing(
+            user=self.user,
+            borrow_date=date.today() - timedelta(days=3),
+            actual_return_date=date.today(),
+        )
+        self.ordered = Borrowing.objects.order_by("borrow_date", "id")
+
+    def test_lean_list_matches_serializer(self):
+        response = self.client.get(BORROWING_URL)
+        self.assertEqual(
+            response.data["results"], BorrowingSerializer(self.ordered, many=True).data
+        )
+
+    def test_fields_narrow_response_and_sql(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(BORROWING_URL, {"fields": "book,is_active"})
+
+        self.assertEqual(
+            response.data["results"],
+            [
+                {"book": borrowing.book.title, "is_active": borrowing.is_active}
+                for borrowing in self.ordered
+            ],
+        )
+        select = queries[-1]["sql"]
+        self.assertNotIn("penalty_for_delay", select)
+        self.assertNotIn("expected_return_date", select)
+
+    def test_omit(self):
+        response = self.client.get(BORROWING_URL, {"omit": "user, penalty_for_delay"})
+        self.assertEqual(
+            set(response.data["results"][0]),
+            {"id", "book", "borrow_date", "expected_return_date", "is_active"},
+        )
+
+    def test_omit_every_field(self):
+        fields = BorrowingSerializer().fields
+        omit = [name for name, field in fields.items() if not field.write_only]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(BORROWING_URL, {"omit": ",".join(omit)})
+
+        self.assertEqual(response.data["results"], [{}, {}])
+        self.assertNotIn("penalty_for_delay", queries[-1]["sql"])
+
+    def test_pages_without_ordering_fields(self):
+        seen = []
+        url = BORROWING_URL + "?page_size=1&fields=id"
+        while url:
+            response = self.client.get(url)
+            seen.extend(borrowing["id"] for borrowing in response.data["results"])
+            url = response.data["next"]
+
+        self.assertEqual(seen, [borrowing.id for borrowing in self.ordered])
+
+    def test_unknown_field(self):
+        response = self.client.get(BORROWING_URL, {"fields": "id,password"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("password", response.data["fields"])
+
+
+class ExportASGITest(TransactionTestCase):
+    def setUp(self) -> None:
+        self.admin = get_user_model().objects.create_user(
+            "export@test.com", "test1234", is_staff=True
+        )
+        self.borrowing = sample_borrowing(user=self.admin)
+        Payment.objects.create(
+            borrowing=self.borrowing,
+            status=Payment.StatusChoices.PENDING,
+            session_id="cs_export",
+            payment_amount=539,
+        )
+        self.handler = ReadPoolASGIHandler()
+        self.headers = [
+            (b"authorization", f"Bearer {AccessToken.for_user(self.admin)}".encode())
+        ]
+
+    def test_exports_stream_under_asgi(self):
+        for url, expected in (
+            (EXPORT_URL, {"id": self.borrowing.id}),
+            (PAYMENT_EXPORT_URL, {"session_id": "cs_export"}),
+        ):
+            status_code, headers, body = asgi_request(
+                self.handler, "GET", url, self.headers
+            )
+
+            self.assertEqual(status_code, status.HTTP_200_OK)
+            self.assertEqual(headers["content-type"], "application/x-ndjson")
+            rows = [json.loads(line) for line in body.decode().splitlines()]
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0], {**rows[0], **expected})
+
+
+class ExportTest(TestCase):
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.admin = get_user_model().objects.create_user(
+            "export@test.com", "test1234", is_staff=True
+        )
+        self.client.force_authenticate(self.admin)
+        today = date.today()
+        self.returned = sample_borrowing(
+            user=self.admin,
+            expected_return_date=today - timedelta(days=2),
+            actual_return_date=today,
+            penalty_for_delay="2.00",
+        )
+        Borrowing.objects.filter(pk=self.returned.pk).update(
+            borrow_date=today - timedelta(days=5)
+        )
+        self.active = sample_borrowing(user=self.admin)
+        self.payment = Payment.objects.create(
+            borrowing=self.returned,
+            status=Payment.StatusChoices.PENDING,
+            session_id="cs_export",
+            payment_amount=539,
+        )
+
+    def test_staff_only(self):
+        self.client.force_authenticate(
+            get_user_model().objects.create_user("reader@test.com", "test1234")
+        )
+        self.assertEqual(
+            self.client.get(EXPORT_URL).status_code, status.HTTP_403_FORBIDDEN
+        )
+        self.assertEqual(
+            self.client.get(PAYMENT_EXPORT_URL).status_code,
+            status.HTTP_403_FORBIDDEN,
+        )
+
+    def test_ndjson_with_amounts(self):
+        response = self.client.get(EXPORT_URL)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in read_stream(response).splitlines()]
+
+        self.assertEqual(
+            [row["id"] for row in rows], [self.returned.id, self.active.id]
+        )
+        self.assertEqual(rows[0]["user"], "export@test.com")
+        self.assertEqual(rows[0]["actual_return_date"], date.today().isoformat())
+        self.assertEqual(rows[0]["rental_amount"], 385)
+        self.assertEqual(rows[0]["penalty_amount"], 308)
+        self.assertEqual(rows[0]["total_amount"], 693)
+
+    def test_csv_with_date_range(self):
+        response = self.client.get(
+            EXPORT_URL, {"output": "csv", "date_from": date.today().isoformat()}
+        )
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn("borrowings.csv", response["Content-Disposition"])
+        rows = list(csv.reader(read_stream(response).splitlines()))
+
+        self.assertEqual(rows[0][:3], ["id", "user", "book"])
+        self.assertEqual([row[0] for row in rows[1:]], [str(self.active.id)])
+
+    def test_invalid_filters(self):
+        response = self.client.get(
+            EXPORT_URL, {"date_from": "2023-02-01", "date_to": "2023-01-01"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(EXPORT_URL, {"output": "xlsx"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_payments(self):
+        response = self.client.get(
+            PAYMENT_EXPORT_URL, {"date_to": date.today().isoformat()}
+        )
+        rows = [json.loads(line) for line in read_stream(response).splitlines()]
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["borrowing"], self.returned.id)
+        self.assertEqual(rows[0]["status"], "Pending")
+        self.assertEqual(rows[0]["payment_amount"], 539)
+
+    def test_memory_stays_flat(self):
+        """A million rows stream within a fixed memory ceiling"""
+        rows = 1_000_000
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {Borrowing._meta.db_table} "
+                "(borrow_date, expected_return_date, book_id, user_id) "
+                "WITH RECURSIVE n(i) AS "
+                "(SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < %s) "
+                "SELECT %s, %s, %s, %s FROM n",
+                [
+                    rows,
+                    date.today(),
+                    date.today() + timedelta(days=7),
+                    self.active.book_id,
+                    self.admin.id,
+                ],
+            )
+
+        response = self.client.get(EXPORT_URL, {"output": "csv"})
+        lines = 0
+        # Peak resident set size, in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for chunk in response.streaming_content:
+            lines += chunk.count(b"\n")
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak
+
+        self.assertEqual(lines, rows + 3)
+        self.assertLess(growth * 1024, EXPORT_MEMORY_CEILING)
+
+
+@override_settings(STRIPE_CLIENT="borrowing.testing.FakeStripeClient", CHAT_ID="42")
+class BorrowingQueryBudgetTest(QueryBudgetTestMixin, TestCase):
+    """Every hot action stays within the query_budgets of its view."""
+
+    def setUp(self) -> None:
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            "budget@test.com", "test1234", is_staff=True
+        )
+        # A real token, so the budgets include the user lookup.
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+        self.books = [sample_book(title=f"Book {i}") for i in range(3)]
+        self.due = date.today() + timedelta(days=7)
+        self.borrowings = [
+            sample_borrowing(book=book, user=self.user) for book in self.books
+        ]
+
+    def test_borrowing_reads(self):
+        self.assertWithinQueryBudget(self.client.get(BORROWING_URL))
+        self.assertWithinQueryBudget(
+            self.client.get(detail_url(self.borrowings[0].id))
+        )
+
+    def test_borrowing_writes(self):
+        response = self.client.post(
+            BORROWING_URL, {"book": self.books[0].id, "expected_return_date": self.due}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertWithinQueryBudget(response)
+
+        payload = {
+            "borrowings": [
+                {"book": book.id, "expected_return_date": self.due}
+                for book in self.books
+            ]
+        }
+        response = self.client.post(BULK_CREATE_URL, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertWithinQueryBudget(response)
+
+        response = self.client.post(return_url(self.borrowings[0].id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+
+        payload = {"borrowings": [borrowing.id for borrowing in self.borrowings[1:]]}
+        response = self.client.post(BULK_RETURN_URL, payload, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+
+    def test_payment_endpoints(self):
+        payment = CreateSession.create_payment(self.borrowings[0])
+        session = FakeStripeClient().create_checkout_session([], "budget")
+        FakeStripeClient.complete(session.id)
+        Payment.objects.filter(pk=payment.pk).update(session_id=session.id)
+
+        self.assertWithinQueryBudget(
+            self.client.get(reverse("borrowing:payment-list"))
+        )
+        self.assertWithinQueryBudget(
+            self.client.get(reverse("borrowing:payment-detail", args=[payment.id]))
+        )
+        response = self.client.get(
+            reverse("borrowing:payment-success"), {"session_id": session.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+    def test_webhook(self):
+        payload, signature = sign_event(
+            FakeStripeClient.event("checkout.session.completed", "cs_budget"),
+            WEBHOOK_SECRET,
+        )
+        response = self.client.post(
+            WEBHOOK_URL,
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response)
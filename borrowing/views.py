@@ -1,37 +1,88 @@
 import datetime
-import os
 
 import stripe
-from django.core.exceptions import ValidationError
+from django.conf import settings
 from django.db import transaction
+from django.shortcuts import get_object_or_404
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
+from book.models import Book
+from borrowing.export import (
+    BORROWING_COLUMNS,
+    PAYMENT_COLUMNS,
+    filter_dates,
+    stream_export,
+)
 from borrowing.models import Borrowing, Payment
+from borrowing.reconcile import PaymentReconciler
 from borrowing.serializers import (
+    BorrowingBulkCreateSerializer,
+    BorrowingBulkReturnSerializer,
     BorrowingSerializer,
     BorrowingCreateSerializer,
     BorrowingDetailSerializer,
     BorrowingReturnSerializer,
+    ExportFilterSerializer,
     PaymentSerializer,
 )
 from borrowing.session import CreateSession
+from borrowing.tasks import create_payment_session_task
+from borrowing.webhooks import parse_event, record_events, schedule_processing
+from fieldsets import SparseFieldsetMixin
+from instrumentation import TimedSerializationMixin
+from pagination import BorrowingPagination, PaymentPagination
 from permissions import IsAdminOrReadOnly
 
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+EXPORT_PARAMETERS = [
+    OpenApiParameter(
+        "output",
+        type=OpenApiTypes.STR,
+        enum=["ndjson", "csv"],
+        description="File format, NDJSON by default (ex. ?output=csv)",
+    ),
+    OpenApiParameter(
+        "date_from",
+        type=OpenApiTypes.DATE,
+        description="Only rows from this date on (ex. ?date_from=2023-01-01)",
+    ),
+    OpenApiParameter(
+        "date_to",
+        type=OpenApiTypes.DATE,
+        description="Only rows up to this date (ex. ?date_to=2023-01-31)",
+    ),
+]
+EXPORT_RESPONSES = {
+    (200, "application/x-ndjson"): OpenApiTypes.STR,
+    (200, "text/csv"): OpenApiTypes.STR,
+}
 
 
-class BorrowingViewSet(viewsets.ModelViewSet):
+class BorrowingViewSet(
+    SparseFieldsetMixin, TimedSerializationMixin, viewsets.ModelViewSet
+):
     queryset = Borrowing.objects.all().select_related(
         "book", "user"
     )
     permission_classes = [IsAuthenticated]
     serializer_class = BorrowingSerializer
+    pagination_class = BorrowingPagination
+    # Most SQL queries each action may run, including the JWT user lookup,
+    # enforced by the test suite.
+    query_budgets = {
+        "list": 2,
+        "retrieve": 2,
+        "create": 11,
+        "return_book": 11,
+        "bulk_create": 11,
+        "bulk_return": 11,
+    }
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user, borrow_date=datetime.date.today())
@@ -45,28 +96,90 @@ class BorrowingViewSet(viewsets.ModelViewSet):
             IsAdminOrReadOnly,
         ],
     )
-    @transaction.atomic
     def return_book(self, request, pk=None):
         with transaction.atomic():
-            borrowing_returned = Borrowing.objects.get(pk=pk)
-            if not borrowing_returned.is_active:
+            borrowing_returned = get_object_or_404(Borrowing, pk=pk)
+            today = datetime.date.today()
+            closed = Borrowing.objects.filter(
+                pk=pk, actual_return_date=None
+            ).update(actual_return_date=today)
+            if not closed:
                 raise ValidationError({"message": "This borrowing is closed already"})
-            borrowing_returned.actual_return_date = datetime.date.today()
-            serializer = self.get_serializer_class()(
-                borrowing_returned,
-                data={"actual_return_date": datetime.date.today()},
-                partial=True,
+            borrowing_returned.actual_return_date = today
+            Book.objects.release(borrowing_returned.book_id)
+            payment = CreateSession.create_payment(borrowing_returned)
+            transaction.on_commit(
+                lambda: create_payment_session_task.delay(payment.id)
             )
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-            book = borrowing_returned.book
-            book.inventory += 1
-            book.save()
-            session = CreateSession.create_session(borrowing=borrowing_returned)
             return Response(
                 {"message": "Book was successfully returned"}, status=status.HTTP_200_OK
             )
 
+    @action(
+        methods=["POST"],
+        detail=False,
+        url_name="bulk-create",
+        url_path="bulk",
+    )
+    def bulk_create(self, request):
+        """
+        Borrow several books at once. With "allow_partial": true
+        the valid items are borrowed and the others reported in "errors".
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result = serializer.save()
+        return Response(
+            {
+                "created": BorrowingSerializer(result["created"], many=True).data,
+                "errors": result["errors"],
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(
+        methods=["POST"],
+        detail=False,
+        url_name="bulk-return",
+        url_path="bulk-return",
+        permission_classes=[
+            IsAdminOrReadOnly,
+        ],
+    )
+    def bulk_return(self, request):
+        """
+        Return several borrowings at once, paid through one checkout session.
+        With "allow_partial": true the valid ones are returned anyway.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.save(), status=status.HTTP_200_OK)
+
+    @extend_schema(parameters=EXPORT_PARAMETERS, responses=EXPORT_RESPONSES)
+    @action(
+        methods=["GET"],
+        detail=False,
+        url_name="export",
+        url_path="export",
+        permission_classes=[IsAdminUser],
+    )
+    def export(self, request):
+        """
+        Stream every borrowing with its amounts in cents, filtered by
+        borrow_date, for reconciliation
+        """
+        filters = ExportFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        queryset = filter_dates(
+            Borrowing.objects.with_amounts(), "borrow_date", filters.validated_data
+        )
+        return stream_export(
+            queryset.order_by("id"),
+            BORROWING_COLUMNS,
+            filters.validated_data["output"],
+            "borrowings",
+        )
+
     def get_queryset(self):
         queryset = self.queryset
         is_active = self.request.query_params.get("is_active")
@@ -98,6 +211,16 @@ class BorrowingViewSet(viewsets.ModelViewSet):
                 type=OpenApiTypes.INT,
                 description="Filter by user_id, available only for admin (ex. ?user_id=4)",
             ),
+            OpenApiParameter(
+                "fields",
+                type=OpenApiTypes.STR,
+                description="Return only these fields (ex. ?fields=id,book,is_active)",
+            ),
+            OpenApiParameter(
+                "omit",
+                type=OpenApiTypes.STR,
+                description="Leave out these fields (ex. ?omit=user,penalty_for_delay)",
+            ),
         ]
     )
     def list(self, request, *args, **kwargs):
@@ -105,7 +228,7 @@ class BorrowingViewSet(viewsets.ModelViewSet):
         this method is created for documentation, to use extend_schema
         for filtering
         """
-        return super().list(self, request, *args, **kwargs)
+        return super().list(request, *args, **kwargs)
 
     def get_serializer_class(self):
         if self.action == "create":
@@ -114,10 +237,15 @@ class BorrowingViewSet(viewsets.ModelViewSet):
             return BorrowingDetailSerializer
         if self.action == "return_book":
             return BorrowingReturnSerializer
+        if self.action == "bulk_create":
+            return BorrowingBulkCreateSerializer
+        if self.action == "bulk_return":
+            return BorrowingBulkReturnSerializer
         return BorrowingSerializer
 
 
 class PaymentViewSet(
+    TimedSerializationMixin,
     mixins.ListModelMixin,
     mixins.RetrieveModelMixin,
     GenericViewSet,
@@ -127,6 +255,8 @@ class PaymentViewSet(
         IsAuthenticated,
     ]
     serializer_class = PaymentSerializer
+    pagination_class = PaymentPagination
+    query_budgets = {"list": 2, "retrieve": 2, "success_payment": 8, "webhook": 1}
 
     @action(
         methods=["GET"],
@@ -135,18 +265,78 @@ class PaymentViewSet(
         url_name="success",
     )
     def success_payment(self, request, pk=None):
-        """Change payment status for success"""
+        """Mark the user's payments of a checkout session paid, once Stripe says so"""
         session_id = self.request.query_params.get("session_id")
-        payment = Payment.objects.filter(session_id=session_id)
-        serializer = PaymentSerializer(payment, data={"status": "PAID"}, partial=True)
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
+        payments = Payment.objects.filter(
+            session_id=session_id, borrowing__user=request.user
+        )
+        if not session_id or not payments.exists():
+            raise ValidationError({"session_id": "Unknown checkout session"})
+        if PaymentReconciler().payment_status(session_id) != "paid":
+            raise ValidationError(
+                {"session_id": "Stripe has not confirmed the payment"}
+            )
+        payments.mark_paid()
         return Response(
             {"success": "Payment was successfully performed"}, status=status.HTTP_200_OK
         )
 
+    @extend_schema(request=None, responses={200: OpenApiTypes.OBJECT})
     @action(
-        detail=True,
+        methods=["POST"],
+        detail=False,
+        url_path="webhook",
+        url_name="webhook",
+        authentication_classes=[],
+        permission_classes=[AllowAny],
+        throttle_classes=[],
+    )
+    def webhook(self, request):
+        """
+        Receive a Stripe event signed with STRIPE_WEBHOOK_SECRET; it is
+        stored and applied to its payments by process_stripe_events_task
+        """
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            raise NotFound
+        try:
+            event = parse_event(
+                request.body, request.headers.get("Stripe-Signature", "")
+            )
+        except (stripe.error.SignatureVerificationError, ValueError):
+            raise ValidationError({"detail": "Invalid Stripe event"})
+        record_events([event])
+        transaction.on_commit(schedule_processing)
+        return Response({"received": True}, status=status.HTTP_200_OK)
+
+    @extend_schema(parameters=EXPORT_PARAMETERS, responses=EXPORT_RESPONSES)
+    @action(
+        methods=["GET"],
+        detail=False,
+        url_name="export",
+        url_path="export",
+        permission_classes=[IsAdminUser],
+    )
+    def export(self, request):
+        """
+        Stream every payment, filtered by the return date of its borrowing
+        (the day the payment was created), for reconciliation
+        """
+        filters = ExportFilterSerializer(data=request.query_params)
+        filters.is_valid(raise_exception=True)
+        queryset = filter_dates(
+            Payment.objects.all(),
+            "borrowing__actual_return_date",
+            filters.validated_data,
+        )
+        return stream_export(
+            queryset.order_by("id"),
+            PAYMENT_COLUMNS,
+            filters.validated_data["output"],
+            "payments",
+        )
+
+    @action(
+        detail=False,
         methods=["GET"],
         url_path="cancel",
         url_name="cancel",
@@ -0,0 +1,120 @@
+import json
+import time
+
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from borrowing.expiry import PaymentExpirer
+from borrowing.models import Payment, StripeEvent
+
+SESSION_COMPLETED = "checkout.session.completed"
+SESSION_EXPIRED = "checkout.session.expired"
+# Set while a process_stripe_events_task is queued, so that a burst
+# of events enqueues one task instead of one per event.
+EVENTS_SCHEDULED_KEY = "borrowing:stripe_events:scheduled"
+
+
+def parse_event(payload: bytes, signature: str) -> dict:
+    """
+    The event in a webhook request body, once its Stripe-Signature
+    header is verified; raises stripe.error.SignatureVerificationError
+    or ValueError otherwise
+    """
+    payload = payload.decode()
+    stripe.WebhookSignature.verify_header(
+        payload,
+        signature,
+        settings.STRIPE_WEBHOOK_SECRET,
+        settings.STRIPE_WEBHOOK_TOLERANCE,
+    )
+    # Plain json rather than stripe.Webhook.construct_event, which
+    # verifies the same header and then builds StripeObjects.
+    event = json.loads(payload)
+    try:
+        event["id"], event["type"], event["data"]["object"]["id"]
+    except (KeyError, TypeError):
+        raise ValueError("Not a Stripe event")
+    return event
+
+
+def record_events(events: list) -> None:
+    """Store events with one INSERT, skipping the event ids already stored"""
+    rows = []
+    for event in events:
+        session = event["data"]["object"]
+        is_session = session.get("object") == "checkout.session"
+        rows.append(
+            StripeEvent(
+                event_id=event["id"],
+                type=event["type"],
+                session_id=session["id"] if is_session else None,
+                payment_status=session.get("payment_status") or "",
+            )
+        )
+    StripeEvent.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def schedule_processing() -> None:
+    """Queue process_stripe_events_task, unless one is already queued"""
+    from borrowing.tasks import process_stripe_events_task
+
+    countdown = settings.STRIPE_EVENTS_COALESCE_SECONDS
+    if cache.add(EVENTS_SCHEDULED_KEY, True, countdown):
+        process_stripe_events_task.apply_async(countdown=countdown)
+
+
+class StripeEventProcessor:
+    """Apply the stored events not yet processed to their payments"""
+
+    def __init__(self):
+        self.batch_size = settings.STRIPE_EVENTS_BATCH_SIZE
+
+    def drain(self) -> dict:
+        """
+        Process the pending events one chunk at a time; settling is
+        idempotent, so events processed twice by concurrent drains
+        change nothing the second time
+        """
+        started = time.perf_counter()
+        metrics = {"events": 0, "paid": 0, "expired": 0}
+        last_id = 0
+        while True:
+            chunk = list(
+                StripeEvent.objects.filter(processed_at=None, id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "type", "session_id", "payment_status")[
+                    : self.batch_size
+                ]
+            )
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            paid = set()
+            expired = set()
+            for _, event_type, session_id, payment_status in chunk:
+                if event_type == SESSION_COMPLETED and payment_status == "paid":
+                    paid.add(session_id)
+                elif event_type == SESSION_EXPIRED:
+                    expired.add(session_id)
+            with transaction.atomic():
+                if paid:
+                    metrics["paid"] += len(
+                        Payment.objects.filter(session_id__in=paid).mark_paid()
+                    )
+                if expired:
+                    pending = Payment.objects.filter(
+                        session_id__in=expired, status=Payment.StatusChoices.PENDING
+                    )
+                    counts = PaymentExpirer().expire(
+                        list(pending.values_list("id", flat=True))
+                    )
+                    metrics["expired"] += counts["expired"]
+                StripeEvent.objects.filter(
+                    id__in=[event_id for event_id, _, _, _ in chunk]
+                ).update(processed_at=timezone.now())
+            metrics["events"] += len(chunk)
+        metrics["duration"] = round(time.perf_counter() - started, 4)
+        return metrics
@@ -0,0 +1,120 @@
+from django.db.models import Expression
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+
+from instrumentation import serializing
+
+
+class LeanSerializer:
+    """
+    Read-only stand-in for a ModelSerializer over many rows: the rows come
+    from queryset.values() and only go through each field's
+    to_representation, without model instances or related lookups.
+
+    Fields other than model fields and primary keys of related rows are
+    read from Meta.value_sources (field name -> values() lookup or
+    expression), and their values are sent as they are.
+    """
+
+    def __init__(self, serializer, field_names=None):
+        fields = serializer.fields
+        if field_names is None:
+            field_names = (
+                name for name, field in fields.items() if not field.write_only
+            )
+        self.field_names = tuple(field_names)
+        sources = getattr(serializer.Meta, "value_sources", {})
+        # Field name -> key of its value in the values() rows.
+        self.keys = {}
+        self.expressions = {}
+        self.converters = {}
+        for name in self.field_names:
+            source = sources.get(name, fields[name].source)
+            if isinstance(source, Expression):
+                # Aliased, as the field may share its name with a relation.
+                self.keys[name] = f"lean_{name}"
+                self.expressions[f"lean_{name}"] = source
+            else:
+                self.keys[name] = source
+            # values() already returns the primary keys of related rows.
+            if name not in sources and not isinstance(
+                fields[name], PrimaryKeyRelatedField
+            ):
+                self.converters[name] = fields[name].to_representation
+
+    def values(self, queryset, *extra_lookups):
+        """The queryset as rows of the fields, plus extra_lookups (ordering)"""
+        lookups = [key for key in self.keys.values() if key not in self.expressions]
+        lookups = dict.fromkeys((*lookups, *extra_lookups))
+        if not lookups and not self.expressions:
+            # values() without lookups would select every column.
+            lookups = {"pk": None}
+        return queryset.values(*lookups, **self.expressions)
+
+    def to_representation(self, rows) -> list:
+        keys = list(self.keys.items())
+        converters = self.converters
+        data = []
+        for row in rows:
+            item = {}
+            for name, key in keys:
+                value = row[key]
+                if value is not None and name in converters:
+                    value = converters[name](value)
+                item[name] = value
+            data.append(item)
+        return data
+
+
+class SparseFieldsetMixin:
+    """
+    Serve the list action through LeanSerializer, limited to the fields
+    named in ?fields= and without those in ?omit=, so that the SQL only
+    selects their columns.
+    """
+
+    fields_param = "fields"
+    omit_param = "omit"
+
+    def get_fieldset(self, serializer) -> tuple:
+        available = [
+            name for name, field in serializer.fields.items() if not field.write_only
+        ]
+        selected = available
+        for param in (self.fields_param, self.omit_param):
+            names = [
+                name.strip()
+                for name in self.request.query_params.get(param, "").split(",")
+                if name.strip()
+            ]
+            unknown = [name for name in names if name not in available]
+            if unknown:
+                raise ValidationError(
+                    {
+                        param: f"Unknown fields: {', '.join(unknown)}. "
+                        f"Choose from: {', '.join(available)}"
+                    }
+                )
+            if names and param == self.fields_param:
+                selected = [name for name in available if name in names]
+            elif names:
+                selected = [name for name in selected if name not in names]
+        return tuple(selected)
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer()
+        lean = LeanSerializer(serializer, self.get_fieldset(serializer))
+        queryset = self.filter_queryset(self.get_queryset())
+
+        ordering = ()
+        if self.paginator is not None and hasattr(self.paginator, "get_ordering"):
+            ordering = self.paginator.get_ordering(request, queryset, self)
+        rows = lean.values(queryset, *(field.lstrip("-") for field in ordering))
+
+        page = self.paginate_queryset(rows)
+        with serializing(request):
+            data = lean.to_representation(rows if page is None else page)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
@@ -0,0 +1,269 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager, nullcontext
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request duration histogram.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+UNRESOLVED = "<unresolved>"
+
+
+class RequestMetrics:
+    """What one request cost, filled in by InstrumentationMiddleware"""
+
+    def __init__(self, method: str):
+        self.endpoint = f"{method} {UNRESOLVED}"
+        self.view_class = None
+        self.action = None
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.render_seconds = 0.0
+        self.total_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Database execute wrapper counting queries and their time"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+    @contextmanager
+    def serializing(self):
+        """Add the time of the block, less its SQL, to serialize_seconds"""
+        start = time.perf_counter()
+        db_seconds = self.db_seconds
+        try:
+            yield
+        finally:
+            self.serialize_seconds += (
+                time.perf_counter() - start - (self.db_seconds - db_seconds)
+            )
+
+    @property
+    def query_budget(self):
+        budgets = getattr(self.view_class, "query_budgets", {})
+        return budgets.get(self.action)
+
+    def server_timing(self) -> str:
+        return ", ".join(
+            (
+                f'db;dur={self.db_seconds * 1000:.2f};desc="{self.queries} queries"',
+                f"serialize;dur={self.serialize_seconds * 1000:.2f}",
+                f"render;dur={self.render_seconds * 1000:.2f}",
+                f"total;dur={self.total_seconds * 1000:.2f}",
+            )
+        )
+
+
+class MetricsRegistry:
+    """Per-process totals of every endpoint, in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Callables returning more metric lines, added by the apps.
+        self.collectors = []
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = defaultdict(int)
+        self.buckets = defaultdict(lambda: [0] * len(DURATION_BUCKETS))
+        self.totals = defaultdict(lambda: defaultdict(float))
+
+    def record(self, metrics: RequestMetrics, status_code: int) -> None:
+        with self.lock:
+            self.requests[(metrics.endpoint, status_code)] += 1
+            buckets = self.buckets[metrics.endpoint]
+            for position, bound in enumerate(DURATION_BUCKETS):
+                if metrics.total_seconds <= bound:
+                    buckets[position] += 1
+            totals = self.totals[metrics.endpoint]
+            totals["count"] += 1
+            totals["seconds"] += metrics.total_seconds
+            totals["queries"] += metrics.queries
+            totals["db_seconds"] += metrics.db_seconds
+            totals["serialize_seconds"] += metrics.serialize_seconds
+            totals["render_seconds"] += metrics.render_seconds
+
+    def render(self) -> str:
+        with self.lock:
+            lines = [
+                "# HELP library_http_requests_total Requests by endpoint and status.",
+                "# TYPE library_http_requests_total counter",
+            ]
+            for (endpoint, status_code), count in sorted(self.requests.items()):
+                labels = f'endpoint="{escape(endpoint)}",status="{status_code}"'
+                lines.append(f"library_http_requests_total{{{labels}}} {count}")
+
+            lines += [
+                "# HELP library_http_request_duration_seconds Request duration.",
+                "# TYPE library_http_request_duration_seconds histogram",
+            ]
+            for endpoint, totals in sorted(self.totals.items()):
+                label = f'endpoint="{escape(endpoint)}"'
+                for bound, count in zip(DURATION_BUCKETS, self.buckets[endpoint]):
+                    lines.append(
+                        "library_http_request_duration_seconds_bucket"
+                        f'{{{label},le="{bound}"}} {count}'
+                    )
+                lines += [
+                    "library_http_request_duration_seconds_bucket"
+                    f'{{{label},le="+Inf"}} {int(totals["count"])}',
+                    f"library_http_request_duration_seconds_sum{{{label}}} "
+                    f'{totals["seconds"]:.6f}',
+                    f"library_http_request_duration_seconds_count{{{label}}} "
+                    f'{int(totals["count"])}',
+                ]
+
+            for name, key, help_text in (
+                ("library_db_queries_total", "queries", "SQL queries run."),
+                ("library_db_duration_seconds_total", "db_seconds", "Time in SQL."),
+                (
+                    "library_serialize_duration_seconds_total",
+                    "serialize_seconds",
+                    "Time serializing response data, less its SQL.",
+                ),
+                (
+                    "library_render_duration_seconds_total",
+                    "render_seconds",
+                    "Time rendering response bodies.",
+                ),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for endpoint, totals in sorted(self.totals.items()):
+                    value = totals[key]
+                    value = int(value) if key == "queries" else f"{value:.6f}"
+                    lines.append(f'{name}{{endpoint="{escape(endpoint)}"}} {value}')
+        for collect in self.collectors:
+            lines += collect()
+        return "\n".join(lines) + "\n"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+registry = MetricsRegistry()
+
+
+class InstrumentationMiddleware:
+    """
+    Record each request's query count, database time, serialization time,
+    render time and total time; send them back in a Server-Timing header
+    and add them to the registry served by metrics_view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = request.metrics = RequestMetrics(request.method)
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(metrics))
+            response = self.get_response(request)
+        metrics.total_seconds = time.perf_counter() - start
+
+        response["Server-Timing"] = metrics.server_timing()
+        response.metrics = metrics
+        registry.record(metrics, response.status_code)
+        budget = metrics.query_budget
+        if budget is not None and metrics.queries > budget:
+            logger.warning(
+                "%s ran %s queries, over its budget of %s",
+                metrics.endpoint,
+                metrics.queries,
+                budget,
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = request.metrics
+        metrics.endpoint = f"{request.method} {request.resolver_match.view_name}"
+        metrics.view_class = getattr(view_func, "cls", None)
+        actions = getattr(view_func, "actions", None) or {}
+        metrics.action = actions.get(request.method.lower(), request.method.lower())
+
+
+def serializing(request):
+    """Context timing serialization for the request, if it is instrumented"""
+    metrics = getattr(request, "metrics", None)
+    return metrics.serializing() if metrics is not None else nullcontext()
+
+
+class TimedSerializationMixin:
+    """
+    List and retrieve of the generic views, with serializer.data timed
+    into the request's serialize_seconds
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(queryset if page is None else page, many=True)
+        with serializing(request):
+            data = serializer.data
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.get_object())
+        with serializing(request):
+            data = serializer.data
+        return Response(data)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            request = (renderer_context or {}).get("request")
+            metrics = getattr(request, "metrics", None)
+            if metrics is not None:
+                metrics.render_seconds += time.perf_counter() - start
+
+
+def metrics_view(request):
+    """Prometheus scrape target, enabled by setting METRICS_TOKEN"""
+    token = settings.METRICS_TOKEN
+    if not token or request.headers.get("Authorization") != f"Bearer {token}":
+        raise Http404
+    return HttpResponse(
+        registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+class QueryBudgetTestMixin:
+    """
+    Test case helper: fail when a response ran more queries than the
+    `query_budgets` declared for its action on the view.
+    """
+
+    def assertWithinQueryBudget(self, response):  # noqa: N802
+        metrics = response.metrics
+        budget = metrics.query_budget
+        self.assertIsNotNone(
+            budget,
+            f"{metrics.view_class} declares no query budget for {metrics.action}",
+        )
+        self.assertLessEqual(
+            metrics.queries,
+            budget,
+            f"{metrics.endpoint} ran {metrics.queries} queries, budget is {budget}",
+        )
+        return metrics
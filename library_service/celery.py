@@ -28,4 +28,28 @@ app.conf.beat_schedule = {
         "task": "borrowing.tasks.overdue_borrowings_task",
         "schedule": crontab(hour="0", minute="0"),
     },
+    "refresh-overdue-loans": {
+        "task": "borrowing.tasks.refresh_overdue_loans_task",
+        "schedule": crontab(hour="0", minute="0"),
+    },
+    "reconcile-payments": {
+        "task": "borrowing.tasks.reconcile_payments_task",
+        "schedule": 5 * 60.0,
+    },
+    "expire-stale-payments": {
+        "task": "borrowing.tasks.expire_stale_payments_task",
+        "schedule": crontab(minute="15"),
+    },
+    "process-stripe-events": {
+        "task": "borrowing.tasks.process_stripe_events_task",
+        "schedule": 60.0,
+    },
+    "flush-expired-tokens": {
+        "task": "user.tasks.flush_expired_tokens_task",
+        "schedule": crontab(minute="30"),
+    },
+    "send-telegram-notifications": {
+        "task": "borrowing.tasks.send_notifications_task",
+        "schedule": 60.0,
+    },
 }
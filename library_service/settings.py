@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "rest_framework",
+    "rest_framework_simplejwt.token_blacklist",
     "book",
     "library_service",
     "borrowing",
@@ -52,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "instrumentation.InstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -81,6 +83,8 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "library_service.wsgi.application"
 
+TEST_RUNNER = "library_service.test_runner.TestRunner"
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -93,6 +97,37 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Cache of the version counters (versioning.py) other processes watch
+# to drop what they hold: catalogue pages, the autocomplete index and
+# the token blacklist filter. It must be shared, i.e. REDIS_URL set.
+VERSION_CACHE_ALIAS = "default"
+CATALOGUE_CACHE_ALIAS = "default"
+CATALOGUE_CACHE_TIMEOUT = int(os.getenv("CATALOGUE_CACHE_TIMEOUT", 300))
+AUTH_CACHE_ALIAS = "default"
+# Seconds a signed-in user is served from the cache without a query.
+AUTH_CACHE_TIMEOUT = int(os.getenv("AUTH_CACHE_TIMEOUT", 60))
+# Distinct titles and authors held by each process's autocomplete index,
+# about 0.75 KB apiece (see manage.py bench_autocomplete).
+AUTOCOMPLETE_MAX_ENTRIES = int(os.getenv("AUTOCOMPLETE_MAX_ENTRIES", 100_000))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -138,10 +173,40 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
 API_TOKEN = os.getenv("API_TOKEN")
+BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
 
+TELEGRAM_TRANSPORT = os.getenv(
+    "TELEGRAM_TRANSPORT", "borrowing.notifications.TelegramTransport"
+)
+TELEGRAM_MAX_CONCURRENCY = int(os.getenv("TELEGRAM_MAX_CONCURRENCY", 8))
+TELEGRAM_MESSAGES_PER_SECOND = float(os.getenv("TELEGRAM_MESSAGES_PER_SECOND", 25))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", 5))
+TELEGRAM_BATCH_SIZE = int(os.getenv("TELEGRAM_BATCH_SIZE", 500))
+TELEGRAM_COALESCE_SECONDS = int(os.getenv("TELEGRAM_COALESCE_SECONDS", 2))
+
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
+STRIPE_CLIENT = os.getenv("STRIPE_CLIENT", "borrowing.session.StripeClient")
+# Pending payments per chunk, and sessions retrieved at once, when
+# reconciling payments with Stripe.
+STRIPE_RECONCILE_BATCH_SIZE = int(os.getenv("STRIPE_RECONCILE_BATCH_SIZE", 500))
+STRIPE_RECONCILE_CONCURRENCY = int(os.getenv("STRIPE_RECONCILE_CONCURRENCY", 8))
+# Signing secret of the webhook endpoint; the endpoint is disabled without it.
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Seconds a signed webhook request stays valid.
+STRIPE_WEBHOOK_TOLERANCE = int(os.getenv("STRIPE_WEBHOOK_TOLERANCE", 300))
+STRIPE_EVENTS_BATCH_SIZE = int(os.getenv("STRIPE_EVENTS_BATCH_SIZE", 1000))
+STRIPE_EVENTS_COALESCE_SECONDS = int(os.getenv("STRIPE_EVENTS_COALESCE_SECONDS", 1))
+# Checkout sessions expire this long after their payments are created,
+# and their pending payments are then expired, in chunks of
+# STRIPE_EXPIRE_BATCH_SIZE; with STRIPE_REGENERATE_EXPIRED_SESSIONS=1,
+# new payments with new sessions replace them.
+STRIPE_SESSION_EXPIRY_HOURS = int(os.getenv("STRIPE_SESSION_EXPIRY_HOURS", 24))
+STRIPE_EXPIRE_BATCH_SIZE = int(os.getenv("STRIPE_EXPIRE_BATCH_SIZE", 1000))
+STRIPE_REGENERATE_EXPIRED_SESSIONS = bool(
+    int(os.getenv("STRIPE_REGENERATE_EXPIRED_SESSIONS", 0))
+)
 
 
 REST_FRAMEWORK = {
@@ -152,23 +217,84 @@ REST_FRAMEWORK = {
     ],
     "DEFAULT_THROTTLE_RATES": {"anon": "100/day", "user": "1000/day"},
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "user.authentication.CachedJWTAuthentication",
+    ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "instrumentation.TimedJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
     ),
 }
 
+# Bearer token Prometheus sends to /metrics/; the endpoint is off without it.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+PAGINATION_PAGE_SIZE = int(os.getenv("PAGINATION_PAGE_SIZE", 20))
+PAGINATION_MAX_PAGE_SIZE = int(os.getenv("PAGINATION_MAX_PAGE_SIZE", 100))
+BULK_BORROWING_MAX_ITEMS = int(os.getenv("BULK_BORROWING_MAX_ITEMS", 100))
+# Threads, and so database connections, serving reads under ASGI.
+ASGI_READ_THREADS = int(os.getenv("ASGI_READ_THREADS", 16))
+# Rows fetched from the database cursor per round trip by the exports.
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 2000))
+
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=2400),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),
     "ROTATE_REFRESH_TOKENS": True,
+    "BLACKLIST_AFTER_ROTATION": True,
+    "TOKEN_OBTAIN_SERIALIZER": "user.serializers.TokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "user.serializers.TokenRefreshSerializer",
+    "TOKEN_VERIFY_SERIALIZER": "user.serializers.TokenVerifySerializer",
 }
-
-CELERY_BROKER_URL = "amqp://localhost:5672"
-CELERY_RESULT_BACKEND = "rpc://localhost:5672"
+# Blacklisted refresh tokens held by each process's bloom filter, about
+# 1.2 bytes apiece; the filter is rebuilt when it holds more. Processes
+# learn of tokens blacklisted elsewhere through the cache, so the filter
+# needs REDIS_URL; with the local memory cache every check is a query.
+TOKEN_BLACKLIST_FILTER_CAPACITY = int(
+    os.getenv("TOKEN_BLACKLIST_FILTER_CAPACITY", 1_000_000)
+)
+
+# "worker" sends tasks to the broker; "eager" runs them in the calling
+# process instead, with no broker, for local development. manage.py test
+# always runs them eagerly (see TEST_RUNNER).
+CELERY_PROFILE = os.getenv("CELERY_PROFILE", "worker")
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "amqp://localhost:5672")
+# Nothing reads task results: tasks log what they did. Set a backend
+# to keep the results of the tasks that return some.
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND") or None
+CELERY_TASK_IGNORE_RESULT = CELERY_RESULT_BACKEND is None
+if CELERY_PROFILE == "eager":
+    CELERY_BROKER_URL = "memory://"
+    CELERY_TASK_ALWAYS_EAGER = True
 CELERY_TIMEZONE = "Europe/Kyiv"
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
-CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_TASK_DEFAULT_QUEUE = "reports"
+# Payment tasks are idempotent and acknowledged once done (acks_late),
+# so the tasks of a worker lost midway are delivered again.
+CELERY_TASK_ROUTES = {
+    "borrowing.tasks.send_notifications_task": {"queue": "notifications"},
+    "borrowing.tasks.create_payment_session_task": {"queue": "payments"},
+    "borrowing.tasks.process_stripe_events_task": {"queue": "payments"},
+    "borrowing.tasks.reconcile_payments_task": {"queue": "payments"},
+    "borrowing.tasks.expire_stale_payments_task": {"queue": "payments"},
+}
+# Worker processes and messages prefetched per process for each queue,
+# as started by `python manage.py run_worker <queue>`.
+CELERY_WORKER_QUEUES = {
+    "notifications": {
+        "concurrency": int(os.getenv("CELERY_NOTIFICATIONS_CONCURRENCY", 2)),
+        "prefetch_multiplier": int(os.getenv("CELERY_NOTIFICATIONS_PREFETCH", 4)),
+    },
+    "payments": {
+        "concurrency": int(os.getenv("CELERY_PAYMENTS_CONCURRENCY", 4)),
+        "prefetch_multiplier": int(os.getenv("CELERY_PAYMENTS_PREFETCH", 1)),
+    },
+    "reports": {
+        "concurrency": int(os.getenv("CELERY_REPORTS_CONCURRENCY", 1)),
+        "prefetch_multiplier": int(os.getenv("CELERY_REPORTS_PREFETCH", 1)),
+    },
+}
 
 
 SPECTACULAR_SETTINGS = {
@@ -0,0 +1,12 @@
+from django.test.runner import DiscoverRunner
+
+from library_service.celery import app
+
+
+class TestRunner(DiscoverRunner):
+    """Run the tests under the "eager" Celery profile, whatever CELERY_PROFILE is"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        # Namespaced keys, as app.conf reads them from the settings.
+        app.conf.update(CELERY_BROKER_URL="memory://", CELERY_TASK_ALWAYS_EAGER=True)
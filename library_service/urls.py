@@ -22,11 +22,14 @@ from drf_spectacular.views import (
     SpectacularRedocView,
 )
 
+from instrumentation import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/borrowing/", include("borrowing.urls", namespace="borrowing")),
     path("api/book/", include("book.urls", namespace="book")),
     path("api/user/", include("user.urls", namespace="user")),
+    path("metrics/", metrics_view, name="metrics"),
     path("api/schema/", SpectacularAPIView.as_view(), name="schema"),
     path(
         "api/doc/swagger/",
@@ -0,0 +1,143 @@
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination keyed on every ordering field instead of only the
+    first one, so the cursor never falls back to an OFFSET scan.
+    The last ordering field must be unique (usually "id").
+    """
+
+    page_size = settings.PAGINATION_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.PAGINATION_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            reverse, current_position = False, None
+        else:
+            reverse, current_position = self.cursor.reverse, self.cursor.position
+
+        if reverse:
+            queryset = queryset.order_by(*_reverse_ordering(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(
+                self.get_keyset_filter(current_position, reverse)
+            )
+
+        # Fetch an extra item to determine if there is a following page.
+        results = list(queryset[: self.page_size + 1])
+        self.page = list(results[: self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(
+                results[-1], self.ordering
+            )
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = current_position is not None
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_keyset_filter(self, position, reverse) -> Q:
+        """
+        Build "(a, b, c) > (x, y, z)" as a chain of OR-ed prefix matches,
+        honouring the direction of every ordering field.
+        """
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        keyset_filter = Q()
+        equal_prefix = Q()
+        for order, value in zip(self.ordering, values):
+            field_name = order.lstrip("-")
+            lookup = "lt" if order.startswith("-") != reverse else "gt"
+            keyset_filter |= equal_prefix & Q(**{f"{field_name}__{lookup}": value})
+            equal_prefix &= Q(**{field_name: value})
+        return keyset_filter
+
+    def _get_position_from_instance(self, instance, ordering):
+        position = []
+        for order in ordering:
+            field_name = order.lstrip("-")
+            if isinstance(instance, dict):
+                attr = instance[field_name]
+            else:
+                attr = getattr(instance, field_name)
+            position.append(str(attr))
+        return json.dumps(position)
+
+
+class BookPagination(KeysetCursorPagination):
+    ordering = ("author", "title", "id")
+    search_ordering = ("search_rank", "id")
+    ordering_param = "ordering"
+    # Every key is backed by an index on the same columns.
+    orderings = {
+        "author": ("author", "title", "id"),
+        "title": ("title", "id"),
+        "daily_fee": ("daily_fee", "id"),
+    }
+
+    def get_ordering(self, request, queryset, view):
+        key = request.query_params.get(self.ordering_param)
+        if key:
+            fields = self.orderings.get(key.lstrip("-"))
+            if fields is None:
+                raise ValidationError(
+                    {self.ordering_param: f"Choose one of: {', '.join(self.orderings)}"}
+                )
+            if key.startswith("-"):
+                fields = tuple(f"-{field}" for field in fields)
+            return fields
+        if "search_rank" in queryset.query.annotations:
+            return self.search_ordering
+        return super().get_ordering(request, queryset, view)
+
+
+class BorrowingPagination(KeysetCursorPagination):
+    ordering = ("borrow_date", "id")
+
+
+class PaymentPagination(KeysetCursorPagination):
+    ordering = ("id",)
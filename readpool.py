@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections, connections
+from django.urls import Resolver404, resolve
+from rest_framework.permissions import SAFE_METHODS
+
+
+class ReadPoolASGIHandler(ASGIHandler):
+    """
+    ASGI handler serving the read endpoints from a pool of threads.
+
+    Django's own ASGI handler runs every sync view and each sync
+    middleware hook in one shared thread, so concurrent requests queue
+    behind each other. Here the whole sync middleware chain runs per
+    request in one thread: GET and HEAD requests to read_views in the
+    pool, the rest in Django's shared thread, as their transactions
+    expect.
+    """
+
+    read_views = frozenset(
+        (
+            "book:book-list",
+            "book:book-detail",
+            "borrowing:borrowing-list",
+            "borrowing:borrowing-detail",
+            "user:manage",
+            "borrowing:borrowing-export",
+            "borrowing:payment-export",
+        )
+    )
+
+    def __init__(self):
+        super().__init__()
+        # Each thread holds its own database connections.
+        self.read_executor = ThreadPoolExecutor(
+            max_workers=settings.ASGI_READ_THREADS, thread_name_prefix="asgi-read"
+        )
+
+    def load_middleware(self, is_async=False):
+        super().load_middleware(is_async=False)
+
+    def is_read(self, request) -> bool:
+        if request.method not in SAFE_METHODS:
+            return False
+        try:
+            return resolve(request.path_info).view_name in self.read_views
+        except Resolver404:
+            return False
+
+    def get_read_response(self, request):
+        """get_response, recycling this thread's connections around it"""
+        close_old_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            close_old_connections()
+
+    async def get_response_async(self, request):
+        if self.is_read(request):
+            response = await sync_to_async(
+                self.get_read_response,
+                thread_sensitive=False,
+                executor=self.read_executor,
+            )(request)
+            response._read_pool = True
+            return response
+        return await sync_to_async(self.get_response, thread_sensitive=True)(request)
+
+    async def send_response(self, response, send):
+        """
+        ASGIHandler.send_response, but reading streaming responses in a
+        thread: Django 4.0 iterates them on the event loop, where the
+        queries of a lazy stream (the exports) are not allowed.
+
+        Read streams get a thread of their own rather than one of the
+        pool, as a cursor must stay in the thread that opened it, and
+        the pool would hand each part to whichever thread is free.
+        """
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+        headers = [
+            (
+                header.encode("ascii") if isinstance(header, str) else header,
+                value.encode("latin1") if isinstance(value, str) else value,
+            )
+            for header, value in response.items()
+        ]
+        headers += [
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        ]
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+        parts = iter(response)
+        if getattr(response, "_read_pool", False):
+            executor = ThreadPoolExecutor(1, thread_name_prefix="asgi-read-stream")
+            in_thread = {"thread_sensitive": False, "executor": executor}
+        else:
+            executor = None
+            in_thread = {"thread_sensitive": True}
+        next_part = sync_to_async(lambda: next(parts, None), **in_thread)
+        try:
+            while True:
+                part = await next_part()
+                if part is None:
+                    break
+                for chunk, _ in self.chunk_bytes(part):
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+        finally:
+            if executor is not None:
+                # The stream's thread ends here, with its connections.
+                await sync_to_async(connections.close_all, **in_thread)()
+                executor.shutdown(wait=False)
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    """django.core.asgi.get_asgi_application with ReadPoolASGIHandler"""
+    django.setup(set_prefix=False)
+    return ReadPoolASGIHandler()
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class UserConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "user"
+
+    def ready(self):
+        import user.signals  # noqa: F401
+        from instrumentation import registry
+        from user.blacklist import blacklist_filter
+
+        registry.collectors.append(blacklist_filter.collect)
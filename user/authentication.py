@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from versioning import bump_versions, get_version
+
+AUTH_VERSION_KEY = "user:{}:auth:version"
+AUTH_USER_KEY = "user:{}:auth:{}"
+
+
+def get_auth_cache():
+    return caches[settings.AUTH_CACHE_ALIAS]
+
+
+def invalidate_user(user_id) -> None:
+    """Drop the user cached by CachedJWTAuthentication"""
+    keys = [AUTH_VERSION_KEY.format(user_id)]
+    bump_versions(keys, settings.AUTH_CACHE_ALIAS)
+    # Bump once more after commit: a request may have cached the
+    # not yet committed row under the version bumped above.
+    transaction.on_commit(lambda: bump_versions(keys, settings.AUTH_CACHE_ALIAS))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication reading the token's user from the cache for
+    AUTH_CACHE_TIMEOUT seconds instead of querying it on every request
+    """
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None:
+            return super().get_user(validated_token)
+
+        cache = get_auth_cache()
+        version = get_version(
+            AUTH_VERSION_KEY.format(user_id), settings.AUTH_CACHE_ALIAS
+        )
+        key = AUTH_USER_KEY.format(user_id, version)
+        user = cache.get(key)
+        if user is None:
+            # Raises for unknown and inactive users, which are not cached.
+            user = super().get_user(validated_token)
+            cache.set(key, user, settings.AUTH_CACHE_TIMEOUT)
+        return user
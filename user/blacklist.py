@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+from hashlib import blake2b
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.tokens import RefreshToken as BaseRefreshToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from versioning import bump_versions, get_version, is_shared
+
+BLACKLIST_VERSION_KEY = "user:blacklist:version"
+# Blacklist rows re-read below the highest id loaded, as rows may commit
+# out of id order.
+RELOAD_OVERLAP = 1000
+# A version recreated after eviction starts from a new timestamp, far
+# from the version loaded; rebuild then, as rows may have been missed.
+VERSION_JUMP = 10**6
+ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """Set of strings that may answer a false "in", never a false "not in" """
+
+    def __init__(self, capacity: int, error_rate: float = ERROR_RATE):
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def positions(self, item: str):
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for number in range(self.hashes):
+            yield (first + number * second) % self.size
+
+    def add(self, item: str) -> None:
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(item)
+        )
+
+
+class BlacklistFilter:
+    """
+    Per-process bloom filter of the jtis of blacklisted refresh tokens,
+    so that checking a token that is not blacklisted needs no query.
+
+    Blacklisting bumps a version in the cache; other processes then load
+    the rows added since, by id. The filter is rebuilt from the unexpired
+    rows once it holds more jtis than it was sized for:
+    TOKEN_BLACKLIST_FILTER_CAPACITY, or twice the live tokens when more.
+    flush_expired_tokens keeps the tables down to the live tokens.
+
+    The version is only seen by other processes through a cache they
+    share; with a per-process cache, every check queries the table.
+    """
+
+    def __init__(self, capacity: int = None, shared_cache: bool = None):
+        self.capacity = capacity or settings.TOKEN_BLACKLIST_FILTER_CAPACITY
+        self._shared_cache = shared_cache
+        self.lock = threading.Lock()
+        self.bloom = None
+        # Jtis the bloom filter was sized for.
+        self.limit = self.capacity
+        self.version = None
+        self.last_id = 0
+        self.count = 0
+        self.checks = 0
+        self.queries = 0
+        self.check_seconds = 0.0
+
+    @property
+    def shared_cache(self) -> bool:
+        if self._shared_cache is None:
+            self._shared_cache = is_shared()
+        return self._shared_cache
+
+    @shared_cache.setter
+    def shared_cache(self, shared: bool) -> None:
+        self._shared_cache = shared
+
+    def refresh(self) -> None:
+        version = get_version(BLACKLIST_VERSION_KEY)
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            rows = BlacklistedToken.objects.order_by("id")
+            if (
+                self.bloom is None
+                or self.count > self.limit
+                or not 0 < version - self.version < VERSION_JUMP
+            ):
+                rows = rows.filter(token__expires_at__gt=aware_utcnow())
+                # Leave room to grow when more tokens are live than
+                # the capacity, so that adding some does not rebuild.
+                self.limit = max(self.capacity, 2 * rows.count())
+                bloom = BloomFilter(self.limit)
+                count = 0
+            else:
+                bloom = self.bloom
+                count = self.count
+                rows = rows.filter(id__gt=self.last_id - RELOAD_OVERLAP)
+            last_id = self.last_id
+            for row_id, jti in rows.values_list("id", "token__jti").iterator():
+                bloom.add(jti)
+                if row_id > self.last_id or bloom is not self.bloom:
+                    count += 1
+                last_id = max(last_id, row_id)
+            self.bloom, self.count, self.last_id = bloom, count, last_id
+            self.version = version
+
+    def is_blacklisted(self, jti: str) -> bool:
+        start = time.perf_counter()
+        if self.shared_cache:
+            self.refresh()
+            blacklisted = jti in self.bloom
+        else:
+            blacklisted = True
+        if blacklisted:
+            # Confirm, as the filter may answer "in" for other jtis.
+            self.queries += 1
+            blacklisted = BlacklistedToken.objects.filter(token__jti=jti).exists()
+        self.checks += 1
+        self.check_seconds += time.perf_counter() - start
+        return blacklisted
+
+    def added(self, jti: str) -> None:
+        """Record a jti blacklisted by this process"""
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+        transaction.on_commit(lambda: bump_versions([BLACKLIST_VERSION_KEY]))
+
+    def collect(self) -> list:
+        """Prometheus lines of the blacklist, for instrumentation.registry"""
+        return [
+            "# HELP library_token_rows Rows of the token blacklist tables.",
+            "# TYPE library_token_rows gauge",
+            'library_token_rows{table="outstanding"} '
+            f"{OutstandingToken.objects.count()}",
+            'library_token_rows{table="blacklisted"} '
+            f"{BlacklistedToken.objects.count()}",
+            "# HELP library_token_blacklist_checks_total Blacklist checks.",
+            "# TYPE library_token_blacklist_checks_total counter",
+            f"library_token_blacklist_checks_total {self.checks}",
+            "# HELP library_token_blacklist_queries_total Checks the filter "
+            "could not answer without a query.",
+            "# TYPE library_token_blacklist_queries_total counter",
+            f"library_token_blacklist_queries_total {self.queries}",
+            "# HELP library_token_blacklist_check_seconds_total Time in checks.",
+            "# TYPE library_token_blacklist_check_seconds_total counter",
+            f"library_token_blacklist_check_seconds_total {self.check_seconds:.6f}",
+        ]
+
+
+blacklist_filter = BlacklistFilter()
+
+
+class RefreshToken(BaseRefreshToken):
+    """RefreshToken checked against blacklist_filter"""
+
+    def check_blacklist(self):
+        if blacklist_filter.is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_("Token is blacklisted"))
+
+    def blacklist(self):
+        result = super().blacklist()
+        blacklist_filter.added(self.payload[api_settings.JTI_CLAIM])
+        return result
+
+
+def flush_expired_tokens(batch_size: int) -> int:
+    """
+    Delete expired outstanding tokens, with their blacklist rows, in
+    batches of batch_size; return how many were deleted. Tokens share
+    one lifetime, so the expired rows are the first ones by id.
+    """
+    now = aware_utcnow()
+    deleted = 0
+    while True:
+        ids = list(
+            OutstandingToken.objects.filter(expires_at__lte=now)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).only("id").delete()
+        deleted += len(ids)
@@ -0,0 +1,108 @@
+import json
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from user.blacklist import BLACKLIST_VERSION_KEY, RefreshToken, blacklist_filter
+from user.serializers import TokenRefreshSerializer, TokenVerifySerializer
+from versioning import bump_versions
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Grow the token blacklist tables and report refresh and verify "
+        "latency at each size, with blacklist_filter and with the plain "
+        "blacklist query; every generated row is rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+        )
+        parser.add_argument("--requests", type=int, default=500)
+
+    def handle(self, *args, **options):
+        # One process: its local cache is shared with every reader.
+        blacklist_filter.shared_cache = True
+        report = []
+        with transaction.atomic():
+            user = get_user_model().objects.create(
+                email="bench-tokens@bench.invalid", password=make_password(None)
+            )
+            rows = 0
+            for size in sorted(options["sizes"]):
+                self.grow(rows, size)
+                rows = size
+
+                bump_versions([BLACKLIST_VERSION_KEY])
+                start = time.perf_counter()
+                blacklist_filter.refresh()
+                load_seconds = time.perf_counter() - start
+
+                count = options["requests"]
+                access = str(RefreshToken.for_user(user).access_token)
+                refresh_tokens = [
+                    str(RefreshToken.for_user(user)) for _ in range(count)
+                ]
+                queries = blacklist_filter.queries
+                report.append(
+                    {
+                        "blacklisted": size,
+                        "filter_load_seconds": round(load_seconds, 3),
+                        "verify": self.latency(
+                            TokenVerifySerializer, "token", [access] * count
+                        ),
+                        "verify_plain_query": self.latency(
+                            jwt_serializers.TokenVerifySerializer,
+                            "token",
+                            [access] * count,
+                        ),
+                        "refresh": self.latency(
+                            TokenRefreshSerializer, "refresh", refresh_tokens
+                        ),
+                        "filter_queries": blacklist_filter.queries - queries,
+                    }
+                )
+            transaction.set_rollback(True)
+        self.stdout.write(json.dumps(report))
+
+    @staticmethod
+    def grow(start: int, stop: int) -> None:
+        """Add blacklisted outstanding tokens numbered start to stop"""
+        expires_at = aware_utcnow() + timedelta(days=7)
+        for first in range(start, stop, BATCH_SIZE):
+            tokens = OutstandingToken.objects.bulk_create(
+                OutstandingToken(
+                    jti=uuid.uuid4().hex, token="bench", expires_at=expires_at
+                )
+                for _ in range(first, min(first + BATCH_SIZE, stop))
+            )
+            BlacklistedToken.objects.bulk_create(
+                BlacklistedToken(token=token) for token in tokens
+            )
+
+    @staticmethod
+    def latency(serializer_class, field: str, tokens: list) -> dict:
+        timings = []
+        for token in tokens:
+            start = time.perf_counter()
+            serializer_class(data={field: token}).is_valid(raise_exception=True)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        return {
+            "p50_ms": round(timings[len(timings) // 2] * 1000, 3),
+            "p99_ms": round(timings[int(len(timings) * 0.99)] * 1000, 3),
+        }
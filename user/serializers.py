@@ -1,5 +1,10 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework_simplejwt import serializers as jwt_serializers
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import UntypedToken
+
+from user.blacklist import RefreshToken, blacklist_filter
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -39,3 +44,21 @@ class UserBorrowingSerializer(serializers.ModelSerializer):
             "email",
         )
         read_only_fields = ("id", "is_staff", "email")
+
+
+class TokenObtainPairSerializer(jwt_serializers.TokenObtainPairSerializer):
+    token_class = RefreshToken
+
+
+class TokenRefreshSerializer(jwt_serializers.TokenRefreshSerializer):
+    token_class = RefreshToken
+
+
+class TokenVerifySerializer(jwt_serializers.TokenVerifySerializer):
+    def validate(self, attrs):
+        """Check the token's signature and expiry, then blacklist_filter"""
+        token = UntypedToken(attrs["token"])
+        jti = token.get(api_settings.JTI_CLAIM)
+        if jti and blacklist_filter.is_blacklisted(jti):
+            raise serializers.ValidationError("Token is blacklisted")
+        return {}
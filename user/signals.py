@@ -0,0 +1,10 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from user.authentication import invalidate_user
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalidate_user_cache(sender, instance, **kwargs) -> None:
+    invalidate_user(instance.pk)
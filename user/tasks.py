@@ -0,0 +1,23 @@
+import time
+
+from celery import shared_task
+from celery.utils.log import get_task_logger
+
+from user.blacklist import flush_expired_tokens
+
+logger = get_task_logger(__name__)
+
+FLUSH_BATCH_SIZE = 1000
+
+
+@shared_task
+def flush_expired_tokens_task() -> dict:
+    """Delete expired outstanding and blacklisted refresh tokens"""
+    started = time.perf_counter()
+    deleted = flush_expired_tokens(FLUSH_BATCH_SIZE)
+    metrics = {
+        "deleted": deleted,
+        "duration": round(time.perf_counter() - started, 4),
+    }
+    logger.info("flush_expired_tokens_task finished: %s", metrics)
+    return metrics
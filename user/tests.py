@@ -1,12 +1,32 @@
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
+from rest_framework_simplejwt.token_blacklist.models import (
+    BlacklistedToken,
+    OutstandingToken,
+)
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from user.blacklist import (
+    BlacklistFilter,
+    BloomFilter,
+    RefreshToken,
+    blacklist_filter,
+)
+from user.tasks import flush_expired_tokens_task
 
 TOKEN_URL = reverse("user:token_obtain_pair")
 DETAIL_URL = reverse("user:manage")
+REFRESH_URL = reverse("user:token_refresh")
+VERIFY_URL = reverse("user:token_verify")
+LOGOUT_URL = reverse("user:logout")
 
 
 class UnauthenticatedUserTest(TestCase):
@@ -52,3 +72,163 @@ class AuthenticatedUserTest(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data.get("email"), self.user.email)
+
+
+class CachedJWTAuthenticationTest(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email="cached@test.com",
+            password="test123456",
+        )
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+
+    def test_user_served_from_cache(self) -> None:
+        with self.assertNumQueries(1):
+            self.client.get(DETAIL_URL)
+        with self.assertNumQueries(0):
+            response = self.client.get(DETAIL_URL)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["email"], self.user.email)
+
+    def test_saving_user_invalidates(self) -> None:
+        self.client.get(DETAIL_URL)
+        self.user.is_staff = True
+        self.user.save()
+
+        with self.assertNumQueries(1):
+            response = self.client.get(DETAIL_URL)
+        self.assertTrue(response.data["is_staff"])
+
+    def test_password_change_invalidates(self) -> None:
+        self.client.patch(DETAIL_URL, {"password": "changed123"})
+
+        with self.assertNumQueries(1):
+            self.client.get(DETAIL_URL)
+        self.assertTrue(
+            self.client.post(
+                TOKEN_URL, {"email": self.user.email, "password": "changed123"}
+            ).data["access"]
+        )
+
+    def test_deactivated_user_rejected(self) -> None:
+        self.client.get(DETAIL_URL)
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get(DETAIL_URL)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenBlacklistTest(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email="blacklist@test.com",
+            password="test123456",
+        )
+        self.client = APIClient()
+        self.tokens = self.client.post(
+            TOKEN_URL, {"email": self.user.email, "password": "test123456"}
+        ).data
+
+    def refresh(self, refresh_token: str):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(REFRESH_URL, {"refresh": refresh_token})
+
+    def test_rotated_refresh_token_blacklisted(self) -> None:
+        response = self.refresh(self.tokens["refresh"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(
+            self.refresh(self.tokens["refresh"]).status_code,
+            status.HTTP_401_UNAUTHORIZED,
+        )
+        self.assertEqual(
+            self.refresh(response.data["refresh"]).status_code, status.HTTP_200_OK
+        )
+
+    def test_logout_blacklists(self) -> None:
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {self.tokens['access']}"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                LOGOUT_URL, {"refresh_token": self.tokens["refresh"]}
+            )
+        self.assertEqual(response.status_code, status.HTTP_205_RESET_CONTENT)
+
+        response = self.client.post(VERIFY_URL, {"token": self.tokens["refresh"]})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_check_without_query(self) -> None:
+        self.addCleanup(setattr, blacklist_filter, "shared_cache", None)
+        blacklist_filter.shared_cache = True
+        self.refresh(self.tokens["refresh"])
+        # The first check loads the refreshed token's blacklisting.
+        self.client.post(VERIFY_URL, {"token": self.tokens["access"]})
+        checks, queries = blacklist_filter.checks, blacklist_filter.queries
+
+        with self.assertNumQueries(0):
+            response = self.client.post(VERIFY_URL, {"token": self.tokens["access"]})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(blacklist_filter.checks, checks + 1)
+        self.assertEqual(blacklist_filter.queries, queries)
+
+    def test_other_process_sees_blacklist(self) -> None:
+        other = BlacklistFilter(shared_cache=True)
+        jti = RefreshToken(self.tokens["refresh"])["jti"]
+        self.assertFalse(other.is_blacklisted(jti))
+
+        self.refresh(self.tokens["refresh"])
+
+        self.assertTrue(other.is_blacklisted(jti))
+
+    def test_local_cache_checks_every_token_with_a_query(self) -> None:
+        local = BlacklistFilter()
+        jti = RefreshToken(self.tokens["refresh"])["jti"]
+        self.assertFalse(local.shared_cache)
+
+        with self.assertNumQueries(1):
+            self.assertFalse(local.is_blacklisted(jti))
+        self.refresh(self.tokens["refresh"])
+
+        self.assertTrue(local.is_blacklisted(jti))
+        self.assertIsNone(local.bloom)
+
+    def test_flush_expired_tokens(self) -> None:
+        self.refresh(self.tokens["refresh"])
+        expired = OutstandingToken.objects.create(
+            jti="expired", token="expired", expires_at=aware_utcnow()
+        )
+        BlacklistedToken.objects.create(token=expired)
+
+        self.assertEqual(
+            flush_expired_tokens_task(), {"deleted": 1, "duration": mock.ANY}
+        )
+        self.assertEqual(OutstandingToken.objects.get().user, self.user)
+        self.assertEqual(BlacklistedToken.objects.count(), 1)
+
+    def test_bloom_filter(self) -> None:
+        bloom = BloomFilter(10_000)
+        for number in range(10_000):
+            bloom.add(f"in-{number}")
+
+        self.assertTrue(all(f"in-{number}" in bloom for number in range(10_000)))
+        false_positives = sum(f"out-{number}" in bloom for number in range(10_000))
+        self.assertLess(false_positives, 200)
+
+    @override_settings(METRICS_TOKEN="scrape")
+    def test_metrics(self) -> None:
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape"
+        )
+
+        body = response.content.decode()
+        self.assertIn('library_token_rows{table="outstanding"} 1', body)
+        self.assertIn("library_token_blacklist_checks_total", body)
@@ -2,9 +2,9 @@ from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework_simplejwt.tokens import RefreshToken
-
+from instrumentation import TimedSerializationMixin
+from user.authentication import CachedJWTAuthentication, invalidate_user
+from user.blacklist import RefreshToken
 from user.serializers import UserSerializer
 
 
@@ -12,9 +12,9 @@ class CreateUserView(generics.CreateAPIView):
     serializer_class = UserSerializer
 
 
-class ManageUserView(generics.RetrieveUpdateAPIView):
+class ManageUserView(TimedSerializationMixin, generics.RetrieveUpdateAPIView):
     serializer_class = UserSerializer
-    authentication_classes = (JWTAuthentication,)
+    authentication_classes = (CachedJWTAuthentication,)
     permission_classes = (IsAuthenticated,)
 
     def get_object(self):
@@ -29,6 +29,7 @@ class LogoutView(APIView):
             refresh_token = request.data["refresh_token"]
             token = RefreshToken(refresh_token)
             token.blacklist()
+            invalidate_user(request.user.id)
 
             return Response(status=status.HTTP_205_RESET_CONTENT)
         except Exception:
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def get_version_cache(alias: str = None):
+    return caches[alias or settings.VERSION_CACHE_ALIAS]
+
+
+def is_shared() -> bool:
+    """Whether other processes see the versions this one bumps"""
+    return not isinstance(get_version_cache(), (LocMemCache, DummyCache))
+
+
+def get_version(key: str, alias: str = None) -> int:
+    """
+    Versions start from a timestamp, so a version evicted from the
+    cache never restarts at a number that older entries were keyed with.
+    They are kept in the VERSION_CACHE_ALIAS cache unless alias is given.
+    """
+    cache = get_version_cache(alias)
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_versions(keys: list, alias: str = None) -> list:
+    """Bump every key and return their new versions"""
+    cache = get_version_cache(alias)
+    versions = []
+    for key in keys:
+        try:
+            versions.append(cache.incr(key))
+        except ValueError:
+            versions.append(time.time_ns())
+            cache.set(key, versions[-1], None)
+    return versions